@@ -0,0 +1,153 @@
+from functools import lru_cache
+import datetime as dt
+import numpy as np
+
+# Distinct datetime strings remembered per process.
+# Carrier exports repeat the same timestamps a lot
+CACHE_SIZE = 65536
+
+# strptime directives the fast path reads by position, and their widths
+FIXED_WIDTH_DIRECTIVES = {"%Y": 4, "%m": 2, "%d": 2,
+                          "%H": 2, "%M": 2, "%S": 2}
+DATE_PARTS = ("%Y", "%m", "%d", "%H", "%M", "%S")
+
+
+def parse_iso_datetime(date_string, date_format_string):
+    """
+    Turn a datetime string in the given strptime format into an iso string.
+    "" stays "", and "iso" formatted strings are passed through untouched
+    """
+    if date_string == "":
+        return ""
+    if date_format_string == "iso":
+        return date_string
+    return _parse_to_iso(date_string, date_format_string)
+
+
+def parse_iso_column(date_strings, date_format_string):
+    """
+    parse_iso_datetime for a whole column at once.
+    Fixed width formats are read with numpy; anything the fast read can't
+    vouch for goes through parse_iso_datetime one value at a time
+    """
+    if date_format_string == "iso":
+        return list(date_strings)
+
+    layout = compile_format(date_format_string)
+    if layout is None or len(date_strings) == 0:
+        return [parse_iso_datetime(value, date_format_string)
+                for value in date_strings]
+
+    width, fields, literals = layout
+    try:
+        raw = np.array(date_strings, dtype=f"S{width + 1}")
+    except UnicodeEncodeError:
+        return [parse_iso_datetime(value, date_format_string)
+                for value in date_strings]
+
+    # One row of bytes per value. Values of the wrong length will have
+    # a stray or missing byte and fail the checks below
+    chars = raw.view(np.uint8).reshape(len(raw), width + 1)
+    is_valid = chars[:, width] == 0
+    for position, byte in literals:
+        is_valid &= chars[:, position] == byte
+
+    digits = chars[:, :width].astype(np.int64) - ord("0")
+    parts = {}
+    for directive, start, end in fields:
+        field_digits = digits[:, start:end]
+        is_valid &= ((field_digits >= 0) & (field_digits <= 9)).all(axis=1)
+        parts[directive] = (field_digits * 10 ** np.arange(
+            end - start - 1, -1, -1)).sum(axis=1)
+
+    year = parts["%Y"]
+    month = parts["%m"]
+    day = parts["%d"]
+    hour = parts.get("%H", np.zeros_like(year))
+    minute = parts.get("%M", np.zeros_like(year))
+    second = parts.get("%S", np.zeros_like(year))
+    is_valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & \
+        (hour < 24) & (minute < 60) & (second < 60)
+
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    days = months.astype("datetime64[D]") + (day - 1)
+    # Days past the end of the month roll into the next one
+    is_valid &= days.astype("datetime64[M]") == months
+
+    values = days.astype("datetime64[s]") + \
+        hour * 3600 + minute * 60 + second
+    iso_strings = np.datetime_as_string(values, unit="s").tolist()
+
+    return [iso_strings[index] if is_valid[index]
+            else parse_iso_datetime(value, date_format_string)
+            for index, value in enumerate(date_strings)]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_to_iso(date_string, date_format_string):
+    layout = compile_format(date_format_string)
+    if layout is not None and len(date_string) == layout[0]:
+        parsed = _read_fixed_width(date_string, layout)
+        if parsed is not None:
+            return parsed.isoformat()
+    return dt.datetime.strptime(date_string, date_format_string).isoformat()
+
+
+def _read_fixed_width(date_string, layout):
+    """
+    Read a value by position, or None if it doesn't fit the layout exactly
+    """
+    _, fields, literals = layout
+    for position, byte in literals:
+        if ord(date_string[position]) != byte:
+            return None
+    parts = {}
+    for directive, start, end in fields:
+        field = date_string[start:end]
+        if not (field.isascii() and field.isdigit()):
+            return None
+        parts[directive] = int(field)
+    try:
+        return dt.datetime(*(parts.get(directive, 0)
+                             for directive in DATE_PARTS))
+    except ValueError:
+        # Let strptime raise its own error
+        return None
+
+
+@lru_cache(maxsize=None)
+def compile_format(date_format_string):
+    """
+    Layout of a fixed width strptime format:
+        (width, [(directive, start, end)], [(position, literal byte)])
+    None if the format has anything but zero padded numeric fields
+    and single byte separators, or lacks a full date
+    """
+    width = 0
+    fields = []
+    literals = []
+    index = 0
+    while index < len(date_format_string):
+        if date_format_string[index] == "%":
+            directive = date_format_string[index:index + 2]
+            if directive not in FIXED_WIDTH_DIRECTIVES:
+                return None
+            field_width = FIXED_WIDTH_DIRECTIVES[directive]
+            fields.append((directive, width, width + field_width))
+            width += field_width
+            index += 2
+            continue
+
+        literal = date_format_string[index]
+        # strptime reads whitespace as "any amount of whitespace"
+        if not literal.isascii() or literal.isspace() and literal != " ":
+            return None
+        literals.append((width, ord(literal)))
+        width += 1
+        index += 1
+
+    directives = [directive for directive, _, _ in fields]
+    if len(set(directives)) != len(directives) or \
+       not {"%Y", "%m", "%d"}.issubset(directives):
+        return None
+    return width, fields, literals
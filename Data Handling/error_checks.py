@@ -0,0 +1,244 @@
+"""
+The checks run_error_checks puts each month's orders through, as an
+ordered pipeline of rules.
+
+An order goes through the rules in ERROR_RULES order and stops at the
+first one it fails, which decides its error code and where it is filed:
+    dirty_data or fyi_data, with the error code on the order,
+    and for some rules also clean_data, with status "wh_data_only".
+Orders that pass every rule are clean.
+
+Each rule is given every order of the month still in the pipeline at once,
+so a rule can check the whole batch in one go.
+"""
+from pathlib import Path
+import csv
+import datetime as dt
+import json
+import sys
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "aop_report"))
+from timezone_offsets import offset_table  # noqa: E402
+
+PL_TIMEZONE = "Europe/Warsaw"
+
+
+class CheckConfig:
+    """
+    The config files the checks look orders up in
+    """
+
+    def __init__(self, country_data, status_data):
+        self.country_data = country_data
+        self.status_data = status_data
+        self.ship_to_codes = {country: frozenset(data["carrier_slas"])
+                              for country, data in country_data.items()}
+
+
+def read_check_config():
+    with open("./Shared Config Files/countries.json", mode="r") as file:
+        country_data = json.load(file)
+
+    with open("./Shared Config Files/statuses.csv", mode="r") as file:
+        status_data = {}
+        status_data_reader = csv.DictReader(file)
+        for row in status_data_reader:
+            status_data.update({row["status_message"]: "is_delivered"})
+
+    return CheckConfig(country_data, status_data)
+
+
+class ErrorRule:
+    """
+    One check of the pipeline.
+    find(records, config) yields (position, detail) for each record of the
+    batch that fails the check. prepare(records), if given, is run on the
+    batch first, for changes every order reaching the rule gets
+    """
+
+    def __init__(self, error_code, find, tier="dirty_data",
+                 wh_data_only=True, keep_clean=True, prepare=None):
+        self.error_code = error_code
+        self.find = find
+        self.tier = tier
+        self.wh_data_only = wh_data_only
+        self.keep_clean = keep_clean
+        self.prepare = prepare
+
+
+def find_no_dataextract_data(records, config):
+    for position, data in enumerate(records):
+        if not data.get("country", False):
+            yield position, ""
+
+
+def find_missing_warehouse_data(records, config):
+    # i.e.: Does it have valid ship import date
+    for position, data in enumerate(records):
+        if data.is_blank("ship_datetime") or\
+           data.is_blank("import_datetime"):
+            yield position, \
+                f"invoice datetime={data['invoice_datetime']}"
+
+
+def find_invalid_country(records, config):
+    country_data = config.country_data
+    for position, data in enumerate(records):
+        if data["country"].lower() not in country_data:
+            yield position, data["country"]
+
+
+def find_no_delivery_date(records, config):
+    for position, data in enumerate(records):
+        if data['delivery_datetime'] == '':
+            yield position, data.get("country", "") + "," + \
+                data.get("import_datetime", "")
+
+
+def find_delivered_before_shipped(records, config):
+    # Whole seconds settle it, unless they are the same second
+    # or a datetime is not one seconds can be read from
+    ship_seconds = np.array([data.seconds("ship_datetime")
+                             for data in records], dtype=float)
+    delivery_seconds = np.array([data.seconds("delivery_datetime")
+                                 for data in records], dtype=float)
+    is_early = delivery_seconds < ship_seconds
+    is_unsure = ~(is_early | (delivery_seconds > ship_seconds))
+
+    for position in np.flatnonzero(is_early | is_unsure):
+        data = records[position]
+        ship_dt = data.datetime("ship_datetime")
+        delivery_dt = data.datetime("delivery_datetime")
+        if delivery_dt < ship_dt:
+            yield position, \
+                f"Shipped: {ship_dt.isoformat()}, " + \
+                f"Delivered: {delivery_dt.isoformat()}"
+
+
+def find_unknown_delivery_status(records, config):
+    status_data = config.status_data
+    for position, data in enumerate(records):
+        if data['latest_status'] not in status_data:
+            yield position, data['latest_status']
+
+
+def find_package_not_delivered(records, config):
+    # Looking up a status returns the "is_valid" value
+    status_data = config.status_data
+    for position, data in enumerate(records):
+        if not status_data[data['latest_status']]:
+            yield position, ""
+
+
+def find_invalid_ship_to_code(records, config):
+    ship_to_codes = config.ship_to_codes
+    for position, data in enumerate(records):
+        ship_q = data['ship_q']
+        country = data['country'].lower()
+        if ship_q not in ship_to_codes[country]:
+            yield position, f"Country: {country}, Ship-to: {ship_q}"
+
+
+def convert_to_pl_time(datetime_obj):
+    """
+    Sometimes we get our datetime objects in Z time, and need to convert them
+    to local time. Poland is the only one who does this, though.
+    """
+    # If datetime string has a + or a Z in it, convert it to native PL time.
+    # Warsaw is +1 in winter and +2 in summer
+    return offset_table(PL_TIMEZONE).to_local(datetime_obj)
+
+
+def to_pl_time(field):
+    """
+    A prepare step converting the field to PL time where it has a timezone.
+    The batch's aware values are converted together, as one UTC array
+    """
+    def prepare(records):
+        aware = []
+        utc_datetimes = []
+        for data in records:
+            field_dt = data.datetime(field)
+            if field_dt.tzinfo is not None:
+                aware.append(data)
+                utc_datetimes.append(field_dt.astimezone(dt.timezone.utc)
+                                     .replace(tzinfo=None))
+        if len(aware) == 0:
+            return
+        local_times = offset_table(PL_TIMEZONE).to_local_array(
+            np.array(utc_datetimes, dtype='datetime64[us]'))
+        for data, local_dt in zip(aware, local_times.astype(object)):
+            data[field] = local_dt.isoformat()
+    return prepare
+
+
+ERROR_RULES = (
+    ErrorRule("No DataExtract Data", find_no_dataextract_data,
+              wh_data_only=False, keep_clean=False),
+    ErrorRule("Missing Warehouse Data", find_missing_warehouse_data,
+              tier="fyi_data", wh_data_only=False, keep_clean=False),
+    ErrorRule("Invalid Country", find_invalid_country,
+              wh_data_only=False, keep_clean=False),
+    ErrorRule("No Delivery Date", find_no_delivery_date,
+              prepare=to_pl_time("ship_datetime")),
+    ErrorRule("Delivered Before Shipped", find_delivered_before_shipped,
+              keep_clean=False, prepare=to_pl_time("delivery_datetime")),
+    ErrorRule("Unknown Delivery Status", find_unknown_delivery_status),
+    ErrorRule("Package Not Delivered", find_package_not_delivered),
+    ErrorRule("Invalid Ship-to Code for Country", find_invalid_ship_to_code)
+)
+
+
+def check_month(month_data, config, rules=ERROR_RULES):
+    """
+    Sort one month of orders into clean, dirty and fyi data
+    """
+    order_nums = list(month_data.keys())
+    records = list(month_data.values())
+    failed_rules = [None] * len(records)
+
+    # Positions of the orders still in the pipeline
+    remaining = list(range(len(records)))
+    for rule in rules:
+        if len(remaining) == 0:
+            break
+        batch = [records[position] for position in remaining]
+        if rule.prepare is not None:
+            rule.prepare(batch)
+        failures = dict(rule.find(batch, config))
+        if len(failures) == 0:
+            continue
+        for batch_position, detail in failures.items():
+            failed_rules[remaining[batch_position]] = (rule, detail)
+        remaining = [position for batch_position, position
+                     in enumerate(remaining)
+                     if batch_position not in failures]
+
+    # Filed in the order the orders came in
+    sorted_month = {"clean_data": {}, "dirty_data": {}, "fyi_data": {}}
+    clean_data = sorted_month["clean_data"]
+    for order, data, failed_rule in zip(order_nums, records, failed_rules):
+        if failed_rule is None:
+            if data.get("status", True):
+                data.update({"status": "clean"})
+            clean_data.update({order: data})
+            continue
+
+        rule, detail = failed_rule
+        update_error_dict(sorted_month[rule.tier], order, data,
+                          rule.error_code, detail)
+        if rule.wh_data_only:
+            data.update({"status": "wh_data_only"})
+        if rule.keep_clean:
+            clean_data.update({order: data})
+
+    return sorted_month
+
+
+def update_error_dict(dict, order_num, order_data, err_code, detail=""):
+    dict.update({order_num: order_data})
+    if detail != "":
+        err_code += ": " + detail
+    dict[order_num].update({"error_code": err_code})
+    return
@@ -0,0 +1,127 @@
+from pathlib import Path
+import hashlib
+import json
+from order_record import as_order_records, encode_order_record
+
+MANIFEST_PATH = Path("./Program Data/ingestion_manifest.json")
+CACHE_DIR = Path("./Program Data/ingestion_cache")
+
+
+class IngestionManifest:
+    """
+    Record of every input file already read into the program data:
+    its size, modification time and content hash, and the orders it held.
+
+    The orders each file was read into are cached as json, named by the
+    file's hash, so orders touched by a new file can be rebuilt from the
+    older files without reading those CSVs again.
+    """
+
+    def __init__(self, manifest_path=MANIFEST_PATH, cache_dir=CACHE_DIR):
+        self.manifest_path = Path(manifest_path)
+        self.cache_dir = Path(cache_dir)
+        self.files = {}
+        self._digests = {}
+        self._order_sets = {}
+
+        if self.manifest_path.is_file():
+            with open(self.manifest_path, mode="r",
+                      encoding="utf-8-sig") as f:
+                self.files = json.load(f)["files"]
+
+    def is_unchanged(self, file):
+        """
+        True if the file was read before and has not changed since.
+        The hash is only computed when the size matches but the
+        modification time does not
+        """
+        entry = self.files.get(str(file))
+        if entry is None:
+            return False
+
+        stat = file.stat()
+        if entry["size"] != stat.st_size:
+            return False
+        if entry["mtime_ns"] == stat.st_mtime_ns:
+            return True
+
+        if self._digest(file) != entry["sha256"]:
+            return False
+        # Touched but not edited
+        entry["mtime_ns"] = stat.st_mtime_ns
+        return True
+
+    def orders(self, file):
+        """
+        Set of the order numbers the file held when it was last read
+        """
+        key = str(file)
+        if key not in self.files:
+            return set()
+        if key not in self._order_sets:
+            self._order_sets.update({key: set(self.files[key]["orders"])})
+        return self._order_sets[key]
+
+    def forget_missing(self, present_files):
+        """
+        Drop files that are no longer in Input Data.
+        Returns the orders they held, which need rebuilding
+        """
+        present = {str(file) for file in present_files}
+        lost_orders = set()
+        for key in list(self.files.keys()):
+            if key not in present:
+                lost_orders.update(self.orders(key))
+                del self.files[key]
+                self._order_sets.pop(key, None)
+        return lost_orders
+
+    def record_file(self, file, input_type, file_data):
+        """
+        Store a freshly read file's orders and its current state
+        """
+        digest = self._digest(file)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / f"{digest}.json",
+                  mode="w", encoding="utf-8-sig") as f:
+            json.dump(file_data, f, default=encode_order_record)
+
+        stat = file.stat()
+        self.files.update({str(file): {
+            "input_type": input_type,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": digest,
+            "orders": list(file_data.keys())
+        }})
+        self._order_sets.pop(str(file), None)
+
+    def load_file_data(self, file):
+        digest = self.files[str(file)]["sha256"]
+        with open(self.cache_dir / f"{digest}.json",
+                  mode="r", encoding="utf-8-sig") as f:
+            return as_order_records(json.load(f))
+
+    def save(self):
+        # Cache files no file points at any more are removed
+        used = {entry["sha256"] for entry in self.files.values()}
+        if self.cache_dir.is_dir():
+            for cache_file in self.cache_dir.glob("*.json"):
+                if cache_file.stem not in used:
+                    cache_file.unlink()
+
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        with open(temp_path, mode="w", encoding="utf-8-sig") as f:
+            json.dump({"files": self.files}, f)
+        temp_path.replace(self.manifest_path)
+
+    def _digest(self, file):
+        key = str(file)
+        if key not in self._digests:
+            sha256 = hashlib.sha256()
+            with open(file, mode="rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    sha256.update(block)
+            self._digests.update({key: sha256.hexdigest()})
+        return self._digests[key]
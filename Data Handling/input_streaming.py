@@ -0,0 +1,220 @@
+from pathlib import Path
+import json
+import shutil
+from order_record import OrderRecord, ORDER_ENCODER
+from source_join import order_partition
+
+SPILL_DIR = Path("./Program Data/ingestion_spill")
+MONTH_SPILL_DIR = Path("./Program Data/month_spill")
+
+# Rough in-memory cost of an order, used to decide when to spill.
+# An OrderRecord and its order number sit around these sizes
+BYTES_PER_ORDER = 200
+BYTES_PER_FIELD = 40
+
+
+class StreamingOrderMerger:
+    """
+    Merges input records into a single order store as they are read,
+    following the combine_data rules (see source_join):
+        a field is added if the order does not have it yet,
+        and replaced only by input types that overwrite it.
+    Input types must be added in their precedence order.
+
+    When the estimated size of the store passes max_memory_mb, the
+    partially merged orders are written out to shard files (split by a
+    hash of the order number) and memory is cleared.
+    shards() then merges each shard file back together, one at a time,
+    so peak memory stays around the ceiling no matter how much input
+    there is.
+
+    Every order is numbered the first time it is added, and the number
+    is spilled with it, so the orders of any shard can be put back in the
+    order they were first seen in.
+    """
+
+    def __init__(self, max_memory_mb, spill_dir=SPILL_DIR, num_shards=16):
+        self.max_bytes = max_memory_mb * 1024 * 1024
+        self.spill_dir = Path(spill_dir)
+        self.num_shards = num_shards
+        self.orders = {}
+        # First seen number of each order in memory
+        self.sequences = {}
+        self.next_sequence = 0
+        # Fields each order got from an input type that overwrites them.
+        # These win over anything already spilled for the same order
+        self.forced = {}
+        self.estimated_bytes = 0
+        self.has_spilled = False
+        self._key_sets = {}
+
+        if self.spill_dir.is_dir():
+            shutil.rmtree(self.spill_dir)
+
+    def add(self, order_num, record, rule):
+        """
+        Merge the record of an input type, following its SourceRule
+        """
+        if order_num not in self.orders:
+            self.orders.update({order_num: record})
+            self.sequences.update({order_num: self.next_sequence})
+            self.next_sequence += 1
+            self.estimated_bytes += BYTES_PER_ORDER + \
+                BYTES_PER_FIELD * len(record)
+        else:
+            current = self.orders[order_num]
+            field_count = len(current)
+            rule.merge(current, record)
+            self.estimated_bytes += BYTES_PER_FIELD * \
+                (len(current) - field_count)
+
+        if rule.overwrites_any:
+            keys = frozenset(key for key in record.keys()
+                             if rule.overwrites(key))
+            if order_num in self.forced:
+                keys = keys | self.forced[order_num]
+            # Most orders share the same few key sets, so keep one copy
+            self.forced.update(
+                {order_num: self._key_sets.setdefault(keys, keys)})
+
+    def is_over_limit(self):
+        return self.estimated_bytes > self.max_bytes
+
+    def spill(self):
+        """
+        Append every order in memory to its shard file and clear memory
+        """
+        if len(self.orders) == 0:
+            return
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        shard_files = [open(self._shard_path(shard), mode="a",
+                            encoding="utf-8")
+                       for shard in range(self.num_shards)]
+        try:
+            for order_num, record in self.orders.items():
+                forced_keys = sorted(self.forced.get(order_num, ()))
+                shard_files[self._shard_of(order_num)].write(
+                    ORDER_ENCODER.encode([self.sequences[order_num],
+                                          order_num, record, forced_keys])
+                    + "\n")
+        finally:
+            for shard_file in shard_files:
+                shard_file.close()
+
+        self.orders = {}
+        self.sequences = {}
+        self.forced = {}
+        self.estimated_bytes = 0
+        self.has_spilled = True
+
+    def shards(self):
+        """
+        Yield the fully merged orders as one or more
+        ({order number: record}, {order number: first seen number}) pairs.
+        Each order is in exactly one of them, and each dictionary of
+        orders is in first seen order
+        """
+        if not self.has_spilled:
+            yield self.orders, self.sequences
+            return
+
+        self.spill()
+        for shard in range(self.num_shards):
+            shard_path = self._shard_path(shard)
+            if not shard_path.is_file():
+                continue
+            yield self._merge_shard(shard_path)
+            shard_path.unlink()
+        shutil.rmtree(self.spill_dir)
+
+    def _merge_shard(self, shard_path):
+        merged = {}
+        sequences = {}
+        with open(shard_path, mode="r", encoding="utf-8") as shard_file:
+            for line in shard_file:
+                sequence, order_num, record, forced_keys = json.loads(line)
+                if order_num not in merged:
+                    # Spills are appended in order, so an order's first
+                    # partial has its first seen number
+                    merged.update({order_num: OrderRecord(record)})
+                    sequences.update({order_num: sequence})
+                    continue
+                # Later partials only replace fields they were forced to
+                current = merged[order_num]
+                for key, value in record.items():
+                    if key not in current or key in forced_keys:
+                        current.update({key: value})
+        merged = {order_num: merged[order_num] for order_num
+                  in sorted(merged, key=sequences.__getitem__)}
+        return merged, sequences
+
+    def _shard_of(self, order_num):
+        return order_partition(order_num, self.num_shards)
+
+    def _shard_path(self, shard):
+        return self.spill_dir / f"shard-{shard:03d}.jsonl"
+
+
+class MonthPartitions:
+    """
+    Merged orders bucketed into one spill file per import month.
+    Orders are appended a batch at a time as they come out of
+    StreamingOrderMerger.shards(), so only one month has to be in memory
+    again when it is checked and saved.
+    Each month is read back in first seen order, whatever order its
+    batches were added in
+    """
+
+    def __init__(self, spill_dir=MONTH_SPILL_DIR):
+        self.spill_dir = Path(spill_dir)
+        self.order_counts = {}
+        self.first_sequences = {}
+
+        if self.spill_dir.is_dir():
+            shutil.rmtree(self.spill_dir)
+
+    def add(self, grouped_data, sequences):
+        """
+        Append {month: {order number: data}} to the month files.
+        sequences: {order number: first seen number}
+        """
+        self.spill_dir.mkdir(parents=True, exist_ok=True)
+        for month, month_data in grouped_data.items():
+            if len(month_data) == 0:
+                continue
+            with open(self._month_path(month), mode="a",
+                      encoding="utf-8") as month_file:
+                for order_num, record in month_data.items():
+                    month_file.write(ORDER_ENCODER.encode(
+                        [sequences[order_num], order_num, record]) + "\n")
+            first_sequence = min(sequences[order_num]
+                                 for order_num in month_data)
+            self.order_counts.update(
+                {month: self.order_counts.get(month, 0) + len(month_data)})
+            self.first_sequences.update({month: min(
+                first_sequence,
+                self.first_sequences.get(month, first_sequence))})
+
+    def months(self):
+        """
+        The months with orders, in the order their first orders were seen
+        """
+        return sorted(self.order_counts,
+                      key=self.first_sequences.__getitem__)
+
+    def read_month(self, month):
+        entries = []
+        with open(self._month_path(month), mode="r",
+                  encoding="utf-8") as month_file:
+            for line in month_file:
+                entries.append(json.loads(line))
+        entries.sort(key=lambda entry: entry[0])
+        return {order_num: OrderRecord(record)
+                for _, order_num, record in entries}
+
+    def remove(self):
+        if self.spill_dir.is_dir():
+            shutil.rmtree(self.spill_dir)
+
+    def _month_path(self, month):
+        return self.spill_dir / f"{month}.jsonl"
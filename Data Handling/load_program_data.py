@@ -1,18 +1,27 @@
 import datetime as dt
 from pathlib import Path
+import argparse
 import json
 import os
+import sys
+from month_index import read_month_range
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / "aop_report"))
+from order_store import OrderStore, COMBINED_STORE_PATH  # noqa: E402
 
-def query_program_data():
+MONTH_DIR = "./Program Data/data_by_month/"
+
+
+def query_program_data(start_dt=None, end_dt=None, output_format="both"):
     """
-    Prepare program data and error reports based on user-selected date range
+    Prepare program data and error reports for a date range.
+    The user is asked for the range when it is not given
     """
-    raw_program_data = read_program_data()
+    raw_program_data = read_program_data(start_dt, end_dt)
     prepare_error_reports(raw_program_data)
 
     # Finalize object
-    prepare_program_data(raw_program_data)
+    prepare_program_data(raw_program_data, output_format)
 
 
 def prepare_error_reports(raw_program_data):
@@ -150,63 +159,98 @@ This is the code for writing the FYI file:
 """
 
 
-def read_program_data():
+def read_program_data(start_dt=None, end_dt=None, month_cache=None):
     """
-    Get a start date and an end date from the user.
+    Get a start date and an end date from the user, unless given.
     Prepare filtered program data objects using those dates.
+    A month_index.MonthCache keeps the month files in memory between calls
     """
-    print("Note: Regardless of date entered, entire month will be included!")
-    start_date_str =\
-        input("Input the start date (inclusive; format: yyyy-mm-dd):\n")
-    end_date_str =\
-        input("Input the end date (exclusive; format: yyyy-mm-dd):\n")
-
-    start_dt = dt.datetime.fromisoformat(start_date_str)
-    end_dt = dt.datetime.fromisoformat(end_date_str)
-    start_file = str(start_dt.year) + "-" + str(start_dt.month) + ".json"
-    end_file = str(end_dt.year) + "-" + str(end_dt.month) + ".json"
-    curr_file = start_file
-    next_month = start_dt.month
-    year_offset = 0
+    if start_dt is None:
+        start_date_str =\
+            input("Input the start date (inclusive; format: yyyy-mm-dd):\n")
+        start_dt = dt.datetime.fromisoformat(start_date_str)
+    if end_dt is None:
+        end_date_str =\
+            input("Input the end date (exclusive; format: yyyy-mm-dd):\n")
+        end_dt = dt.datetime.fromisoformat(end_date_str)
 
     raw_program_data = {}
-    break_flag = False
-    while True:
-        if curr_file == end_file:
-            break_flag = True
-
-        curr_file_path = Path("./Program Data/data_by_month/" + curr_file)
+    for curr_file in month_file_names(start_dt, end_dt):
+        curr_file_path = Path(MONTH_DIR + curr_file)
         if not curr_file_path.is_file():
             print(f"Warning! Missing file: {curr_file_path.name}. Skipping.")
+            continue
+
+        # Only the orders imported inside the range are read
+        if month_cache is None:
+            file_data = read_month_range(curr_file_path, start_dt, end_dt)
         else:
-            with open(curr_file_path, mode="r", encoding="utf-8-sig") as f:
-                file_data = json.load(f)
-                raw_program_data.update({curr_file: file_data})
+            file_data = month_cache.read_range(curr_file_path,
+                                               start_dt, end_dt)
+        raw_program_data.update({curr_file: file_data})
 
-        next_month += 1
-        if next_month == 13:
-            next_month = 1
-            year_offset += 1
+    return raw_program_data
 
-        curr_file = str(start_dt.year + year_offset) +\
-            "-" + str(next_month) + ".json"
 
-        if break_flag:
-            return raw_program_data
+def month_file_names(start_dt, end_dt):
+    """
+    Names of the month files from the start date's month
+    to the end date's month, both included
+    """
+    year = start_dt.year
+    month = start_dt.month
+    while (year, month) <= (end_dt.year, end_dt.month):
+        yield f"{year}-{month}.json"
+        month += 1
+        if month == 13:
+            month = 1
+            year += 1
 
 
-def prepare_program_data(raw_program_data):
+def prepare_program_data(raw_program_data, output_format="both"):
+    """
+    Combine the clean orders of every loaded month for the reports.
+    output_format:
+        "json"     - combined-filtered.json
+        "columnar" - combined-filtered.store, a directory of .npy columns
+                     that the reports memory map instead of parsing
+        "both"     - write both
+    """
     program_data_path =\
         Path("./Program Data/combined_files/combined-filtered.json")
 
+    clean_data = combine_clean_data(raw_program_data)
+
+    if output_format in ("json", "both"):
+        with open(program_data_path, mode="w", encoding="utf-8-sig") as f:
+            json.dump(clean_data, f)
+
+    if output_format in ("columnar", "both"):
+        OrderStore.from_dict(clean_data).save(COMBINED_STORE_PATH)
+
+
+def combine_clean_data(raw_program_data):
+    """
+    The clean orders of every loaded month in one dictionary
+    """
     clean_data = {}
     for month_data in raw_program_data.values():
         clean_data.update(month_data["clean_data"])
-
-    with open(program_data_path, mode="w", encoding="utf-8-sig") as f:
-        json.dump(clean_data, f)
+    return clean_data
 
 
 if __name__ == "__main__":
-    query_program_data()
+    parser = argparse.ArgumentParser(
+        description="Load a date range of program data for the reports. "
+                    "Dates not given are asked for")
+    parser.add_argument("--start", type=dt.datetime.fromisoformat,
+                        help="start date, inclusive (yyyy-mm-dd)")
+    parser.add_argument("--end", type=dt.datetime.fromisoformat,
+                        help="end date, exclusive (yyyy-mm-dd)")
+    parser.add_argument("--output-format", default="both",
+                        choices=["json", "columnar", "both"],
+                        help="combined order files to write")
+    args = parser.parse_args()
+
+    query_program_data(args.start, args.end, args.output_format)
     print("Program data loaded - Check Error Reports")
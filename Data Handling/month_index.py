@@ -0,0 +1,224 @@
+from bisect import bisect_left
+from pathlib import Path
+import datetime as dt
+import json
+import os
+from order_record import OrderRecord, ORDER_ENCODER
+
+INDEX_VERSION = 1
+UTF8_BOM = b"\xef\xbb\xbf"
+EPOCH = dt.datetime(1970, 1, 1)
+ONE_SECOND = dt.timedelta(seconds=1)
+
+
+def index_path(month_path):
+    """
+    The index sidecar of a month file: 2024-1.json -> 2024-1.index.json
+    """
+    month_path = Path(month_path)
+    return month_path.with_name(month_path.stem + ".index.json")
+
+
+def order_timestamp(data):
+    """
+    Whole seconds since 1970 of the order's import datetime, falling back
+    to the invoice datetime. None if it has neither.
+    Timezone offsets are dropped, keeping the wall clock time
+    """
+    if isinstance(data, OrderRecord):
+        for field in ("import_datetime", "invoice_datetime"):
+            seconds = data.seconds(field)
+            if seconds is not None:
+                return seconds
+        return None
+    if not isinstance(data, dict):
+        return None
+    for field in ("import_datetime", "invoice_datetime"):
+        try:
+            value = dt.datetime.fromisoformat(data.get(field, ""))
+        except (ValueError, TypeError):
+            continue
+        return _seconds(value)
+    return None
+
+
+def write_indexed_month(month_path, month_data):
+    """
+    Write a month file and its index.
+
+    The month file holds exactly what json.dump would write, but is written
+    one order at a time so the byte span of every order is known.
+    The index lists those spans per tier, sorted by order_timestamp, along
+    with the size and modification time of the month file it describes.
+
+    Both are written to temporary files and renamed into place, the month
+    file first. An index left over from an older month file no longer
+    matches its size and time, and is ignored.
+    """
+    month_path = Path(month_path)
+    temp_path = month_path.with_name(month_path.name + ".tmp")
+
+    tiers = {}
+    with open(temp_path, mode="wb") as month_f:
+        month_f.write(UTF8_BOM)
+        position = len(UTF8_BOM)
+
+        # json.dumps escapes everything outside ascii,
+        # so characters and bytes line up
+        def write(text):
+            nonlocal position
+            month_f.write(text.encode("ascii"))
+            position += len(text)
+
+        write("{")
+        for tier_number, (tier, orders) in enumerate(month_data.items()):
+            if tier_number > 0:
+                write(", ")
+            write(json.dumps(tier) + ": {")
+
+            dated = []
+            undated = []
+            for entry_number, (order_num, data) in enumerate(orders.items()):
+                if entry_number > 0:
+                    write(", ")
+                start = position
+                write(json.dumps(order_num) + ": " +
+                      ORDER_ENCODER.encode(data))
+                timestamp = order_timestamp(data)
+                if timestamp is None:
+                    undated.append([start, position])
+                else:
+                    dated.append((timestamp, start, position))
+            write("}")
+
+            dated.sort()
+            tiers.update({tier: {
+                "timestamps": [timestamp for timestamp, _, _ in dated],
+                "spans": [[start, end] for _, start, end in dated],
+                "undated_spans": undated
+            }})
+        write("}")
+
+    stat = temp_path.stat()
+    index = {
+        "version": INDEX_VERSION,
+        "month_size": stat.st_size,
+        "month_mtime_ns": stat.st_mtime_ns,
+        "tiers": tiers
+    }
+    temp_index_path = index_path(month_path).with_suffix(".tmp")
+    with open(temp_index_path, mode="w", encoding="utf-8") as index_f:
+        json.dump(index, index_f)
+
+    os.replace(temp_path, month_path)
+    os.replace(temp_index_path, index_path(month_path))
+
+
+def read_month_range(month_path, start_dt, end_dt):
+    """
+    Read the orders of a month file whose order_timestamp is in
+    [start_dt, end_dt): start inclusive, end exclusive.
+    Orders are compared in whole seconds.
+    Orders without a timestamp are always included.
+
+    With an up to date index only those orders' bytes are read and parsed.
+    Otherwise the whole file is loaded and filtered, with the same result
+    """
+    start = _seconds(start_dt)
+    end = _seconds(end_dt)
+
+    index = read_month_index(month_path)
+    if index is None:
+        with open(month_path, mode="r", encoding="utf-8-sig") as month_f:
+            file_data = json.load(month_f)
+        return {tier: {order_num: data for order_num, data in orders.items()
+                       if order_timestamp(data) is None
+                       or start <= order_timestamp(data) < end}
+                for tier, orders in file_data.items()}
+
+    month_data = {}
+    with open(month_path, mode="rb") as month_f:
+        for tier, tier_index in index["tiers"].items():
+            timestamps = tier_index["timestamps"]
+            first = bisect_left(timestamps, start)
+            last = bisect_left(timestamps, end)
+            # Back in file order, so the orders keep the order they
+            # were written in
+            spans = sorted(tier_index["spans"][first:last] +
+                           tier_index["undated_spans"])
+            month_data.update({tier: read_spans(month_f, spans)})
+    return month_data
+
+
+def read_month_index(month_path):
+    """
+    The month file's index, or None if it is missing or out of date
+    """
+    month_index_path = index_path(month_path)
+    if not month_index_path.is_file():
+        return None
+    with open(month_index_path, mode="r", encoding="utf-8") as index_f:
+        index = json.load(index_f)
+
+    stat = Path(month_path).stat()
+    if index.get("version") != INDEX_VERSION or \
+       index["month_size"] != stat.st_size or \
+       index["month_mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return index
+
+
+def read_spans(month_f, spans):
+    """
+    Parse the '"order": {...}' entries at the given byte spans into one
+    dictionary. Neighbouring spans are read together
+    """
+    pieces = []
+    run_start = None
+    run_end = None
+    for start, end in spans:
+        # Entries are only separated by ", "
+        if run_start is not None and start == run_end + 2:
+            run_end = end
+            continue
+        if run_start is not None:
+            month_f.seek(run_start)
+            pieces.append(month_f.read(run_end - run_start))
+        run_start, run_end = start, end
+    if run_start is not None:
+        month_f.seek(run_start)
+        pieces.append(month_f.read(run_end - run_start))
+
+    return json.loads(b"{" + b", ".join(pieces) + b"}")
+
+
+class MonthCache:
+    """
+    Whole month files kept in memory, for runs that read many date ranges.
+    Each file is read once; every range after that is filtered from memory
+    with the same rules as read_month_range
+    """
+
+    def __init__(self):
+        self.months = {}
+
+    def read_range(self, month_path, start_dt, end_dt):
+        key = str(month_path)
+        if key not in self.months:
+            with open(month_path, mode="r", encoding="utf-8-sig") as month_f:
+                file_data = json.load(month_f)
+            self.months.update({key: {
+                tier: [(order_num, data, order_timestamp(data))
+                       for order_num, data in orders.items()]
+                for tier, orders in file_data.items()}})
+
+        start = _seconds(start_dt)
+        end = _seconds(end_dt)
+        return {tier: {order_num: data
+                       for order_num, data, timestamp in orders
+                       if timestamp is None or start <= timestamp < end}
+                for tier, orders in self.months[key].items()}
+
+
+def _seconds(datetime_obj):
+    return (datetime_obj.replace(tzinfo=None) - EPOCH) // ONE_SECOND
@@ -0,0 +1,410 @@
+from collections.abc import MutableMapping
+from functools import lru_cache
+from itertools import repeat
+from operator import attrgetter
+import datetime as dt
+import json
+import sys
+
+EPOCH = dt.datetime(1970, 1, 1)
+EPOCH_DATE = EPOCH.date()
+ONE_SECOND = dt.timedelta(seconds=1)
+SECONDS_PER_DAY = 86400
+
+# Held as whole seconds since 1970 when the value is a naive, whole second
+# iso string, the form the input files are parsed into. Anything else
+# (timezone offsets, fractions of a second, "") is kept as it was given
+DATETIME_FIELDS = ("invoice_datetime", "import_datetime",
+                   "ship_datetime", "delivery_datetime")
+# A handful of values repeated across every order, kept as one shared copy
+CATEGORICAL_FIELDS = ("country", "ship_q", "status", "latest_status")
+SLOT_FIELDS = ("id",) + DATETIME_FIELDS + CATEGORICAL_FIELDS + \
+    ("error_code",)
+
+# How each slot field's string values are stored
+_PLAIN = 0
+_DATETIME = 1
+_CATEGORICAL = 2
+_ERROR_CODE = 3
+_FIELD_KINDS = {"id": _PLAIN, "error_code": _ERROR_CODE}
+_FIELD_KINDS.update({field: _DATETIME for field in DATETIME_FIELDS})
+_FIELD_KINDS.update({field: _CATEGORICAL for field in CATEGORICAL_FIELDS})
+
+
+class _KeyOrder:
+    """
+    The keys of a record in the order they were added.
+    One instance is shared by every record with the same keys,
+    and remembers which instance adding a key leads to
+    """
+    __slots__ = ("keys", "key_set", "datetime_positions", "getter",
+                 "_added")
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.key_set = frozenset(keys)
+        self.datetime_positions = tuple(
+            position for position, key in enumerate(keys)
+            if _FIELD_KINDS.get(key) == _DATETIME)
+        # Reads every value in one call when they all live in slots
+        self.getter = None
+        if len(keys) > 1 and all(key in _FIELD_KINDS for key in keys):
+            self.getter = attrgetter(*keys)
+        self._added = {}
+
+    def add(self, key):
+        added = self._added.get(key)
+        if added is None:
+            added = _key_order(self.keys + (key,))
+            self._added[key] = added
+        return added
+
+
+_KEY_ORDERS = {}
+
+
+def _key_order(keys):
+    key_order = _KEY_ORDERS.get(keys)
+    if key_order is None:
+        key_order = _KeyOrder(keys)
+        _KEY_ORDERS[keys] = key_order
+    return key_order
+
+
+_NO_KEYS = _key_order(())
+
+
+class OrderRecord(MutableMapping):
+    """
+    One order's data, used in place of a dictionary from the moment an
+    input row is read until the order is written to its month file.
+
+    It behaves as a dictionary of strings, keys in the order they were
+    added, but the usual fields live in slots instead of a hash table:
+        datetimes are ints (see DATETIME_FIELDS) and only turned back
+        into iso strings when read,
+        categorical values and bare error codes are interned,
+        the key order is shared between records.
+    Fields outside SLOT_FIELDS are kept in a small dictionary.
+
+    json cannot write it directly: use ORDER_ENCODER, or pass
+    default=encode_order_record
+    """
+    __slots__ = SLOT_FIELDS + ("_keys", "_extra")
+
+    def __init__(self, items=()):
+        self._keys = _NO_KEYS
+        self._extra = None
+        if type(items) is dict:
+            items = items.items()
+        elif type(items) is OrderRecord:
+            items = items.raw_items()
+        for key, value in items:
+            self[key] = value
+
+    @classmethod
+    def from_columns(cls, fields, columns, count):
+        """
+        Yield count records from columns of count values each,
+        the fields in the given order. Each column is compacted in one go
+        """
+        columns = [compact_column(field, column)
+                   for field, column in zip(fields, columns)]
+        rows = zip(*columns) if len(columns) > 0 else repeat((), count)
+        if not all(field in _FIELD_KINDS for field in fields):
+            for row in rows:
+                yield cls(zip(fields, row))
+            return
+
+        key_order = _key_order(tuple(fields))
+        setters = [getattr(cls, field).__set__ for field in fields]
+        for row in rows:
+            record = cls.__new__(cls)
+            record._keys = key_order
+            record._extra = None
+            for setter, value in zip(setters, row):
+                setter(record, value)
+            yield record
+
+    def __getitem__(self, key):
+        kind = _FIELD_KINDS.get(key)
+        if kind is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+        if kind == _DATETIME and type(value) is int:
+            return format_seconds(value)
+        return value
+
+    def __setitem__(self, key, value):
+        kind = _FIELD_KINDS.get(key)
+        if kind is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            if type(value) is str:
+                if kind == _DATETIME:
+                    value = compact_datetime(value)
+                elif kind == _CATEGORICAL or \
+                        (kind == _ERROR_CODE and ": " not in value):
+                    value = sys.intern(value)
+            setattr(self, key, value)
+        if key not in self._keys.key_set:
+            self._keys = self._keys.add(key)
+
+    def __delitem__(self, key):
+        if key not in self._keys.key_set:
+            raise KeyError(key)
+        if key in _FIELD_KINDS:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+        self._keys = _key_order(tuple(existing for existing
+                                      in self._keys.keys if existing != key))
+
+    def __contains__(self, key):
+        return key in self._keys.key_set
+
+    def __iter__(self):
+        return iter(self._keys.keys)
+
+    def __len__(self):
+        return len(self._keys.keys)
+
+    def __eq__(self, other):
+        if type(other) is OrderRecord:
+            return dict(self.raw_items()) == dict(other.raw_items())
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"OrderRecord({self.as_dict()!r})"
+
+    def __reduce__(self):
+        # Rebuilt from the raw values, so datetimes stay ints
+        return (OrderRecord, (self.raw_items(),))
+
+    def get(self, key, default=None):
+        # __getitem__ written out again, this is called a lot
+        if key not in self._keys.key_set:
+            return default
+        kind = _FIELD_KINDS.get(key)
+        if kind is None:
+            return self._extra[key]
+        value = getattr(self, key)
+        if kind == _DATETIME and type(value) is int:
+            return format_seconds(value)
+        return value
+
+    def keys(self):
+        return self._keys.keys
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys.keys]
+
+    def values(self):
+        return [self[key] for key in self._keys.keys]
+
+    def update(self, other=(), **kwargs):
+        if type(other) is dict:
+            other = other.items()
+        elif type(other) is OrderRecord:
+            other = other.raw_items()
+        elif isinstance(other, MutableMapping):
+            other = other.items()
+        for key, value in other:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def merge(self, other, overwrite=False, overwrite_fields=None):
+        """
+        Add the fields of another record this one does not have yet.
+        With overwrite, its fields replace the ones this one has too;
+        overwrite_fields ({field: bool}) decides it field by field instead.
+        Values are copied as they are held, without converting datetimes
+        """
+        key_set = self._keys.key_set
+        for key, value in other.raw_items():
+            if key not in key_set or (
+                    overwrite if overwrite_fields is None
+                    else overwrite_fields.get(key, overwrite)):
+                self._set_raw(key, value)
+
+    def raw_items(self):
+        """
+        (key, value) pairs with datetimes left as they are held
+        """
+        return list(zip(self._keys.keys, self._raw_values()))
+
+    def as_dict(self):
+        key_order = self._keys
+        values = self._raw_values()
+        for position in key_order.datetime_positions:
+            if type(values[position]) is int:
+                values[position] = format_seconds(values[position])
+        return dict(zip(key_order.keys, values))
+
+    def is_blank(self, field):
+        """
+        data.get(field, "") == "", without turning a datetime into a string
+        """
+        if field not in self._keys.key_set:
+            return True
+        value = self._raw(field)
+        return type(value) is str and value == ""
+
+    def datetime(self, field):
+        """
+        The field as a datetime, None if it is missing or "".
+        Strings that are not iso datetimes raise ValueError, as
+        datetime.fromisoformat would
+        """
+        if field not in self._keys.key_set:
+            return None
+        value = self._raw(field)
+        if type(value) is int:
+            return EPOCH + dt.timedelta(seconds=value)
+        if value is None or value == "":
+            return None
+        return dt.datetime.fromisoformat(value)
+
+    def seconds(self, field):
+        """
+        Whole seconds since 1970 of the field's wall clock time,
+        None if it is missing or not a datetime
+        """
+        if field not in self._keys.key_set:
+            return None
+        value = self._raw(field)
+        if type(value) is int:
+            return value
+        try:
+            value = dt.datetime.fromisoformat(value)
+        except (ValueError, TypeError):
+            return None
+        return (value.replace(tzinfo=None) - EPOCH) // ONE_SECOND
+
+    def _raw_values(self):
+        key_order = self._keys
+        if key_order.getter is not None:
+            return list(key_order.getter(self))
+        return [self._raw(key) for key in key_order.keys]
+
+    def _set_raw(self, key, value):
+        if key in _FIELD_KINDS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        if key not in self._keys.key_set:
+            self._keys = self._keys.add(key)
+
+    def _raw(self, field):
+        if field in _FIELD_KINDS:
+            return getattr(self, field)
+        return self._extra[field]
+
+
+def compact_column(field, values):
+    """
+    A column of values as an OrderRecord would hold them
+    """
+    kind = _FIELD_KINDS.get(field)
+    if kind == _DATETIME:
+        return [compact_datetime(value) if type(value) is str else value
+                for value in values]
+    if kind == _CATEGORICAL:
+        return [sys.intern(value) if type(value) is str else value
+                for value in values]
+    if kind == _ERROR_CODE:
+        return [sys.intern(value)
+                if type(value) is str and ": " not in value else value
+                for value in values]
+    return list(values)
+
+
+def compact_datetime(value):
+    """
+    Whole seconds for a naive 'yyyy-mm-ddThh:mm:ss' string,
+    the string itself for anything else.
+    The date and the time of day are looked up separately, as both
+    repeat across many orders
+    """
+    if len(value) != 19 or value[10] != "T":
+        return value
+    day = _day_number(value[:10])
+    second = _second_of_day(value[11:])
+    if day is None or second is None:
+        return value
+    return day * SECONDS_PER_DAY + second
+
+
+def format_seconds(seconds):
+    """
+    The iso string compact_datetime was given for these seconds
+    """
+    day, second = divmod(seconds, SECONDS_PER_DAY)
+    return _date_prefix(day) + _time_of_day(second)
+
+
+@lru_cache(maxsize=2 ** 17)
+def _day_number(date_string):
+    if date_string[4] != "-" or date_string[7] != "-":
+        return None
+    try:
+        return (dt.date.fromisoformat(date_string) - EPOCH_DATE).days
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=2 ** 17)
+def _second_of_day(time_string):
+    if time_string[2] != ":" or time_string[5] != ":":
+        return None
+    try:
+        parsed = dt.time.fromisoformat(time_string)
+    except ValueError:
+        return None
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+
+@lru_cache(maxsize=2 ** 17)
+def _date_prefix(day):
+    return (EPOCH_DATE + dt.timedelta(days=day)).isoformat() + "T"
+
+
+@lru_cache(maxsize=SECONDS_PER_DAY)
+def _time_of_day(second):
+    return f"{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}"
+
+
+def encode_order_record(obj):
+    """
+    json default hook: json.dump(data, f, default=encode_order_record)
+    """
+    if type(obj) is OrderRecord:
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} "
+                    "is not JSON serializable")
+
+
+# Writes the same text as json.dumps, records included
+ORDER_ENCODER = json.JSONEncoder(default=encode_order_record)
+
+
+def as_order_records(orders):
+    """
+    {order number: data} with every order's data an OrderRecord
+    """
+    return {order_num: data if type(data) is OrderRecord
+            else OrderRecord(data) for order_num, data in orders.items()}
@@ -1,39 +1,113 @@
 from pathlib import Path
+import argparse
+import itertools
 import json
 import csv
+import sys
 import datetime as dt
-
-
-def prepare_program_data():
+from concurrent.futures import ProcessPoolExecutor
+from input_streaming import StreamingOrderMerger, MonthPartitions
+from ingestion_manifest import IngestionManifest
+from month_index import write_indexed_month
+from datetime_parsing import parse_iso_column
+from order_record import OrderRecord
+from error_checks import read_check_config, check_month
+from source_join import source_rules, join_sources, \
+    join_sources_partitioned
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "aop_report"))
+from instrumentation import span, start_tracing, finish_tracing, \
+    add_trace_arguments  # noqa: E402
+
+# Streaming ingestion: rows read between memory checks,
+# and the default ceiling before merged orders spill to disk
+STREAM_CHUNK_ROWS = 10000
+DEFAULT_MAX_MEMORY_MB = 1024
+
+# Input rows whose datetime columns are parsed in one go
+DATETIME_BATCH_ROWS = 5000
+
+MONTH_DIR = "./Program Data/data_by_month/"
+MONTH_TIERS = ("clean_data", "dirty_data", "fyi_data")
+
+
+def prepare_program_data(streaming=False,
+                         max_memory_mb=DEFAULT_MAX_MEMORY_MB, workers=1,
+                         incremental=False):
     """
     This function reads all the files in the Input Data folder,
     Maps the headers, and saves the useful data into json objects.
     Check for errors.
     Saves objects live in the Program Data folder for later use
+
+    streaming: merge rows into one order store as they are read instead
+               of building a dictionary per input type. Past max_memory_mb
+               the store spills to disk, is split into months there and
+               is checked and saved one month at a time
+    workers: number of processes used to read the input files, to combine
+             and check them and to update the month files
+    incremental: only read input files that are new or changed since the
+                 last incremental run, as recorded in the ingestion manifest
     """
     with open(Path('./Shared Config Files/headers.json'),
               mode="r", encoding="utf-8-sig") as json_file:
         headers_dict = json.load(json_file)
 
+    if streaming:
+        with span("stream_program_data"):
+            stream_program_data(headers_dict, max_memory_mb, workers)
+        return
+
+    if incremental:
+        with span("ingest_changed_input_data"):
+            ingest_changed_input_data(headers_dict, workers)
+        return
+
     # Read input files and extract meaningful data
+    with span("read_input_data") as stage:
+        if workers > 1:
+            all_input_data = read_input_data_parallel(headers_dict, workers)
+        else:
+            all_input_data = read_input_data(headers_dict)
+        stage.rows = sum(len(input_data)
+                         for input_data in all_input_data.values())
+
+    with span("combine_data") as stage:
+        combined_data = combine_data(all_input_data, headers_dict, workers)
+        stage.rows = len(combined_data)
+    with span("group_input_data", rows=len(combined_data)):
+        grouped_data = group_input_data(combined_data)
+    with span("run_error_checks",
+              rows=sum(len(orders) for orders in grouped_data.values())):
+        sorted_group_data = run_error_checks(grouped_data, workers)
+
+    # Line commened out, as reports are to include "pure" SLA, not adjusted
+    # filtered_data = perform_exceptional_date_swap(filtered_data)
+    with span("update_program_data",
+              rows=sum(len(orders)
+                       for month_data in sorted_group_data.values()
+                       for orders in month_data.values())):
+        update_program_data(sorted_group_data, workers)
+
+
+def read_input_data(headers_dict):
+    """
+    Read the files of every input type, one after the other
+    """
     input_data = {}
     all_input_data = {}
-    for input_type in Path("./Input Data/").iterdir():
+    for input_type in sorted(Path("./Input Data/").iterdir()):
         input_data = {}
         print(f"\nReading {input_type.name} files")
-        if input_type.name == "data_extract":
-            input_data = prepare_dataextract_data()
-        else:
-            input_data = jsonify_data(headers_dict, input_type.name)
+        with span(f"read {input_type.name}") as stage:
+            if input_type.name == "data_extract":
+                input_data = prepare_dataextract_data()
+            else:
+                input_data = jsonify_data(headers_dict, input_type.name)
+            stage.rows = len(input_data)
         all_input_data.update({input_type.name: input_data})
 
-    combined_data = combine_data(all_input_data, headers_dict)
-    grouped_data = group_input_data(combined_data)
-    sorted_group_data = run_error_checks(grouped_data)
-
-    # Line commened out, as reports are to include "pure" SLA, not adjusted
-    # filtered_data = perform_exceptional_date_swap(filtered_data)
-    update_program_data(sorted_group_data)
+    return all_input_data
 
 
 def jsonify_data(headers_dict, file_type):
@@ -47,358 +121,438 @@ def jsonify_data(headers_dict, file_type):
                    Specified directory will be iterated through for
                    data files. Also specifies which header mapping set to use.
     """
-    # These headers will be looped through for each file type.
-    # This allows us to store other data in the headers config file besides,
-    # Just the header mappings like time offset
-    normal_headers = headers_dict["normal_headers"]
     return_dict = {}
-    temp_dict = {}
-    headers_set = headers_dict[file_type]
-    try:
-        for file in Path(f"./Input Data/{file_type}/").iterdir():
-            with open(file, mode="r", encoding="utf-8-sig",
-                      newline="") as file:
-                print(f"    Now processing {file.name}")
-                csv_reader = csv.DictReader(file)
-                for entry in csv_reader:
-                    order_num = entry[headers_set['order_number']]\
-                                .replace("DT", "")\
-                                .replace("_DOTERRA", "")
-
-                    if order_num not in return_dict:
-                        for header in normal_headers:
-                            if header in headers_set.keys():
-                                if "datetime" in header:
-                                    good_date = return_iso_date(
-                                        entry[headers_set[header]],
-                                        headers_set["datetime_format"])
-                                    temp_dict.update({header: good_date})
-                                else:
-                                    temp_dict.update(
-                                        {header: entry[headers_set[header]]})
-
-                        return_dict.update({order_num: temp_dict})
-                        temp_dict = {}
-                    else:
-                        # Compare the two entry's data.
-                        # If one is empty, take the one with data.
-                        # If both have data, stick with what was entered first
-                        # by taking no action
-                        for header in normal_headers:
-                            if return_dict[order_num].get(header) is None \
-                             and header in headers_set.keys():
-                                if "datetime" in header:
-                                    good_date = return_iso_date(
-                                        entry[headers_set[header]],
-                                        headers_set["datetime_format"])
-                                    return_dict[order_num][header] =\
-                                        good_date
-                                else:
-                                    return_dict[order_num][header] = \
-                                        entry[headers_set[header]]
-    except KeyError as e:
-        print(f"Uh oh! I can't find the column header {e.args[0]}")
-        print("Make sure the data in the Settings/headers.json file match the "
-              "data in every file, then rerun.\n")
-        print(e)
-        exit()
-    except UnicodeDecodeError as e:
-        print("Error! I'm having trouble decoding the file.\n"
-              "Copy the data over to a new excel, save as .csv then rerun\n.")
-        print(e)
-        exit()
-    except Exception as e:
-        print("An error that I wasn't prepared for has occured!")
-        print(f"Current File: {file.name}\n")
-        print(e)
-        exit()
+    for file in sorted(Path(f"./Input Data/{file_type}/").iterdir()):
+        print(f"    Now processing {file.name}")
+        try:
+            file_data = read_input_file(file, file_type, headers_dict)
+        except Exception as e:
+            exit_on_input_error(e, file.name)
+        merge_input_file_data(return_dict, file_data)
 
     return return_dict
 
 
 def prepare_dataextract_data():
-    dataextract_data_dict = {}
-    temp_dict = {}
-    for file in Path("./Input Data/data_extract/").iterdir():
-        print(f"    Now processing {file.name}")
-        with open(file, mode="r",
-                  encoding="utf-8-sig", newline="") as dataextract_csv_file:
-            csv_reader = csv.DictReader(dataextract_csv_file)
+    return jsonify_data({}, "data_extract")
 
-            for entry in csv_reader:
-                # ignore all orders that were ship verified by an agent
-                if entry['order_verify_init'] != "":
-                    continue
-                if entry['order_number'] not in dataextract_data_dict:
-                    temp_dict = {}
-                    temp_dict.update({"id": entry['dist_id']})
-
-                    read_invoice_date = \
-                        dt.date.fromisoformat(entry['invoice_date'])
-                    read_invoice_time =\
-                        dt.time.fromisoformat(entry['invoice_time']) if \
-                        entry['invoice_time'] != "::" else \
-                        dt.time(0, 0)
-
-                    # Offset invoice time by 7 hours if country is UK
-                    # 8 if Europe
-                    invoice_datetime = dt.datetime.combine(read_invoice_date,
-                                                           read_invoice_time)
-
-                    match entry['ship_to_country']:
-                        case "EO":
-                            temp_dict.update(
-                                {"country": entry['ship_to_addr_3'].lower()})
-                        case "GBR":
-                            temp_dict.update({"country": "uk"})
-                        case "MDA":
-                            temp_dict.update({"country": "moldova"})
-                        case "DEU":
-                            temp_dict.update({"country": "germany"})
-                        case "ITA":
-                            temp_dict.update({"country": "italy"})
-                        case "ISR":
-                            temp_dict.update({"country": "israel"})
-                        case "FRA":
-                            temp_dict.update({"country": "france"})
-                        case "POL":
-                            temp_dict.update({"country": "poland"})
-                        case _:
-                            temp_dict.update({"country": "missing from prepare_program_data"})
-
-                    temp_dict.update(
-                        {"invoice_datetime": invoice_datetime.isoformat()})
-
-                    if entry['ship_via'].lower().find("stan") == -1:
-                        temp_dict.update({"ship_q": "prem"})
-                    else:
-                        temp_dict.update({"ship_q": "stand"})
-
-                    dataextract_data_dict.update(
-                        {entry['order_number']: temp_dict})
-    return dataextract_data_dict
-
-
-def return_iso_date(date_string, date_format_string):
-    if date_string == "":
-        return ""
-    if date_format_string == "iso":
-        return date_string
-    return dt.datetime.strptime(date_string, date_format_string).isoformat()
-
-
-def combine_data(combined_file_data, headers_dict):
+
+def read_input_data_parallel(headers_dict, workers):
     """
-    Combine all data into a single JSON object.
-    Loops through all DataExtract data and adds transit and WH data
+    Read every input file in a pool of worker processes.
+    Each worker turns one file into a partial order dictionary. The partials
+    are merged here in the same file order as the serial read, so the result
+    does not depend on which worker finishes first.
     """
-    print("\nCombining input data")
-    consolidated_dict = {}
-
-    # Add transit and other input data
-    for type, dict in combined_file_data.items():
-        for order, data in dict.items():
-            # If the data does not exist in the consolidated dict, add it
-            if order not in consolidated_dict:
-                consolidated_dict.update({order: data})
-            else:
-                # If it does, check each key in the data dict.
-                for key in data.keys():
-                    if key not in consolidated_dict[order].keys():
-                        # If the key doesn't exist in the dict, add it
-                        consolidated_dict[order].update(
-                            {key: data[key]}
-                        )
-                    else:
-                        # Check if the overwrite tag.
-                        # If true, overwrrite, and if not, ignore
-                        if headers_dict[type].get("overwrite", False):
-                            consolidated_dict[order].update(
-                                {key: data[key]}
-                            )
+    all_input_data = {}
+    tasks = []
+    for input_type in sorted(Path("./Input Data/").iterdir()):
+        all_input_data.update({input_type.name: {}})
+        for file in sorted(input_type.iterdir()):
+            tasks.append((input_type.name, file))
 
-    return consolidated_dict
+    print(f"\nReading {len(tasks)} input files with {workers} workers")
+    for file_type, file, file_data in read_input_files(tasks, headers_dict,
+                                                       workers):
+        merge_input_file_data(all_input_data[file_type], file_data)
 
+    return all_input_data
 
-def run_error_checks(grouped_data):
+
+def read_input_files(tasks, headers_dict, workers=1):
     """
-    Run checks on the data and remove "unclean" data to a log file
+    Yield (file type, file, order dictionary) for each (file type, file)
+    task, in task order. Files are read in a process pool if workers > 1
     """
-    print("Running error checks\n")
-    with open("./Shared Config Files/countries.json", mode="r") as file:
-        country_data = json.load(file)
-
-    with open("./Shared Config Files/statuses.csv", mode="r") as file:
-        status_data = {}
-        status_data_reader = csv.DictReader(file)
-        for row in status_data_reader:
-            status_data.update({row["status_message"]: "is_delivered"})
-
-    sorted_data = {}
-
-    # Missing data by period (yyyy-m)
-    for month, month_data in grouped_data.items():
-        fyi_dict = {}
-        dirty_data = {}
-        clean_data = {}
-        for order, data in month_data.items():
-
-            # Check for dataextract data
-            if not data.get("country", False):
-                update_error_dict(dirty_data, order,
-                                  data, "No DataExtract Data")
-                continue
-
-            # Check if data has warehouse data
-            # i.e.: Does it have valid ship import date
-            if data.get("ship_datetime", "") == "" or\
-               data.get("import_datetime", "") == "":
-                order_year = dt.datetime.fromisoformat(
-                    data["invoice_datetime"]).year
-                order_month = dt.datetime.fromisoformat(
-                    data["invoice_datetime"]).month
-                date_stamp = f"{order_year}-{order_month}"
-
-                if date_stamp not in fyi_dict:
-                    fyi_dict.update({date_stamp: {}})
-
-                update_error_dict(fyi_dict, order,
-                                  data, "Missing Warehouse Data",
-                                  ("invoice datetime"
-                                   f"={data['invoice_datetime']}"))
-
-                fyi_dict["Missing Warehouse Data"][date_stamp].update({
-                    order: data["invoice_datetime"]
-                    })
-                continue
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        if workers > 1:
+            results = executor.map(read_input_file,
+                                   [file for _, file in tasks],
+                                   [file_type for file_type, _ in tasks],
+                                   itertools.repeat(headers_dict))
+        else:
+            results = (read_input_file(file, file_type, headers_dict)
+                       for file_type, file in tasks)
 
-            # Check if country is valid
-            if data["country"].lower() not in country_data.keys():
-                update_error_dict(dirty_data, order,
-                                  data, "Invalid Country", data["country"])
-                continue
+        for file_type, file in tasks:
+            try:
+                file_data = next(results)
+            except Exception as e:
+                exit_on_input_error(e, file.name)
+            print(f"    Processed {file_type}/{file.name}")
+            yield file_type, file, file_data
 
-            ship_dt = dt.datetime.fromisoformat(data['ship_datetime'])
-            if ship_dt.tzinfo is not None:
-                ship_dt = convert_to_pl_time(ship_dt)
-                data['ship_datetime'] = ship_dt.isoformat()
 
-            # Check for delivery status.
-            if data['delivery_datetime'] == '':
-                data_string = data.get("country", "") + "," + \
-                    data.get("import_datetime", "")
+def ingest_changed_input_data(headers_dict, workers=1):
+    """
+    Incremental version of prepare_program_data.
+    Only input files that are new or changed since the last run are read.
+    The orders in them are rebuilt from the cached data of every file that
+    has them, then merged into the month files by update_program_data.
+    """
+    manifest = IngestionManifest()
+    tasks = []
+    changed_tasks = []
+    for input_type in sorted(Path("./Input Data/").iterdir()):
+        for file in sorted(input_type.iterdir()):
+            tasks.append((input_type.name, file))
+            if not manifest.is_unchanged(file):
+                changed_tasks.append((input_type.name, file))
+
+    # Orders from deleted or edited files are rebuilt without their old rows
+    affected_orders = manifest.forget_missing([file for _, file in tasks])
+    for _, file in changed_tasks:
+        affected_orders.update(manifest.orders(file))
+
+    if len(changed_tasks) == 0 and len(affected_orders) == 0:
+        print("\nNo new or changed input files")
+        manifest.save()
+        return
+
+    print(f"\nReading {len(changed_tasks)} new or changed input files")
+    fresh_data = {}
+    for file_type, file, file_data in read_input_files(
+            changed_tasks, headers_dict, workers):
+        manifest.record_file(file, file_type, file_data)
+        affected_orders.update(file_data.keys())
+        fresh_data.update({str(file): file_data})
+
+    # Rebuild each affected order from every file that has it,
+    # in the usual read order
+    print(f"Rebuilding {len(affected_orders)} orders")
+    all_input_data = {}
+    for file_type, file in tasks:
+        if file_type not in all_input_data:
+            all_input_data.update({file_type: {}})
+        if manifest.orders(file).isdisjoint(affected_orders):
+            continue
 
-                update_error_dict(dirty_data, order,
-                                  data, "No Delivery Date", data_string)
+        file_data = fresh_data.get(str(file))
+        if file_data is None:
+            file_data = manifest.load_file_data(file)
+        merge_input_file_data(all_input_data[file_type],
+                              {order_num: record
+                               for order_num, record in file_data.items()
+                               if order_num in affected_orders})
 
-                data.update({"status": "wh_data_only"})
-                clean_data.update({order: data})
-                continue
+    combined_data = combine_data(all_input_data, headers_dict, workers)
+    grouped_data = group_input_data(combined_data)
+    sorted_group_data = run_error_checks(grouped_data, workers)
+    update_program_data(sorted_group_data, workers)
 
-            # Check if delivery time is after shipping time
-            delivery_dt = dt.datetime.fromisoformat(data['delivery_datetime'])
-            if delivery_dt.tzinfo is not None:
-                delivery_dt = convert_to_pl_time(delivery_dt)
-                data['delivery_datetime'] = delivery_dt.isoformat()
+    # Only saved once the month files are updated, so a failed run
+    # reads the same files again next time
+    manifest.save()
 
-            if delivery_dt < ship_dt:
-                detail_string = ""
-                detail_string = \
-                    f"Shipped: {ship_dt.isoformat()}, " + \
-                    f"Delivered: {delivery_dt.isoformat()}"
 
-                update_error_dict(dirty_data, order,
-                                  data, "Delivered Before Shipped",
-                                  detail_string)
+def read_input_file(file, file_type, headers_dict):
+    """
+    Read one input file into {order number: record},
+    keeping the first row of each order
+    """
+    return dict(iter_file_records(file, file_type, headers_dict, set()))
 
-                data.update({"status": "wh_data_only"})
-                continue
 
-            # Check if status exists in statuses dict
-            if data['latest_status'] not in status_data.keys():
-                update_error_dict(dirty_data, order, data,
-                                  "Unknown Delivery Status",
-                                  data['latest_status'])
-                data.update({"status": "wh_data_only"})
+def merge_input_file_data(return_dict, file_data):
+    """
+    Add one file's orders to the data read so far for its input type.
+    Compare the two entry's data.
+    If one is empty, take the one with data.
+    If both have data, stick with what was entered first
+    by taking no action
+    """
+    for order_num, record in file_data.items():
+        if order_num not in return_dict:
+            return_dict.update({order_num: record})
+            continue
+        for header, value in record.items():
+            if return_dict[order_num].get(header) is None:
+                return_dict[order_num][header] = value
 
-                clean_data.update({order: data})
-                continue
 
-            # Check if status is a delivery status
-            # Looking up a status returns the "is_valid" value
-            if not status_data[data['latest_status']]:
-                update_error_dict(dirty_data, order, data,
-                                  "Package Not Delivered")
+def iter_file_records(file, file_type, headers_dict, seen_orders):
+    """
+    Yield (order number, record) for the first row of each order in the file
+    that is not already in seen_orders
+    """
+    # These headers will be looped through for each file type.
+    # This allows us to store other data in the headers config file besides,
+    # Just the header mappings like time offset
+    normal_headers = headers_dict.get("normal_headers", [])
+    headers_set = headers_dict.get(file_type, {})
+    # Rows waiting for their datetime columns to be parsed together
+    batch = []
+    with open(file, mode="r", encoding="utf-8-sig", newline="") as csv_file:
+        for entry in csv.DictReader(csv_file):
+            if file_type == "data_extract":
+                # ignore all orders that were ship verified by an agent
+                if entry['order_verify_init'] != "":
+                    continue
+                order_num = entry['order_number']
+            else:
+                order_num = read_order_number(entry, headers_set)
 
-                data.update({"status": "wh_data_only"})
-                clean_data.update({order: data})
+            if order_num in seen_orders:
                 continue
+            seen_orders.add(order_num)
 
-            # Check if shipping estimate time exists
-            ship_q = data['ship_q']
-            country = data['country'].lower()
-            if ship_q not in country_data[country]['carrier_slas']:
-                detail_string = ""
-                detail_string = f"Country: {country}, Ship-to: {ship_q}"
-                update_error_dict(dirty_data, order, data,
-                                  "Invalid Ship-to Code for Country",
-                                  detail_string)
-
-                data.update({"status": "wh_data_only"})
-                clean_data.update({order: data})
+            if file_type == "data_extract":
+                yield order_num, build_dataextract_record(entry)
                 continue
 
-            if data.get("status", True):
-                data.update({"status": "clean"})
-            clean_data.update({order: data})
+            batch.append((order_num, entry))
+            if len(batch) == DATETIME_BATCH_ROWS:
+                yield from build_input_records(batch, headers_set,
+                                               normal_headers)
+                batch = []
 
-        sorted_data.update({month: {}})
-        sorted_data[month].update({"clean_data": clean_data})
-        sorted_data[month].update({"dirty_data": dirty_data})
-        sorted_data[month].update({"fyi_data": fyi_dict})
+    yield from build_input_records(batch, headers_set, normal_headers)
 
-    return sorted_data
 
+def exit_on_input_error(error, file_name):
+    """
+    Explain why an input file could not be read, then stop
+    """
+    if isinstance(error, KeyError):
+        print(f"Uh oh! I can't find the column header {error.args[0]}")
+        print("Make sure the data in the Settings/headers.json file match the "
+              "data in every file, then rerun.\n")
+    elif isinstance(error, UnicodeDecodeError):
+        print("Error! I'm having trouble decoding the file.\n"
+              "Copy the data over to a new excel, save as .csv then rerun\n.")
+    else:
+        print("An error that I wasn't prepared for has occured!")
+        print(f"Current File: {file_name}\n")
+    print(error)
+    exit()
+
+
+def stream_program_data(headers_dict, max_memory_mb, workers=1):
+    """
+    Streaming version of prepare_program_data.
+    Rows are read in chunks and merged straight into one order store,
+    so no per input type dictionaries are built.
+    """
+    merger = StreamingOrderMerger(max_memory_mb)
+    input_types = [input_type.name
+                   for input_type in sorted(Path("./Input Data/").iterdir())]
+    # Read in precedence order, as combine_data joins them
+    for rule in source_rules(headers_dict, input_types):
+        print(f"\nReading {rule.name} files")
+        records = iter_input_records(headers_dict, rule.name)
+        while True:
+            chunk = list(itertools.islice(records, STREAM_CHUNK_ROWS))
+            if len(chunk) == 0:
+                break
+            for order_num, record in chunk:
+                merger.add(order_num, record, rule)
+            if merger.is_over_limit():
+                print("    Memory limit reached, spilling orders to disk")
+                merger.spill()
+
+    no_invoice_orders = []
+    if not merger.has_spilled:
+        grouped_data = group_input_data(merger.orders, no_invoice_orders)
+        sorted_group_data = run_error_checks(grouped_data, workers)
+        update_program_data(sorted_group_data, workers)
+    else:
+        # Each shard holds whole orders, which are bucketed by month on
+        # disk. Months are then checked and saved one at a time, so memory
+        # is bounded by the largest month rather than the whole history
+        # Every month and the undated orders are put back in first seen
+        # order, as a run that does not spill gives them
+        partitions = MonthPartitions()
+        no_invoice_sequences = []
+        for combined_data, sequences in merger.shards():
+            shard_no_invoice = []
+            partitions.add(group_input_data(combined_data, shard_no_invoice),
+                           sequences)
+            no_invoice_sequences += [(sequences[order_num], order_num)
+                                     for order_num in shard_no_invoice]
+        no_invoice_orders = [order_num for _, order_num
+                             in sorted(no_invoice_sequences)]
+        update_partitioned_months(partitions, workers)
+        partitions.remove()
+    write_no_invoice_date_errors(no_invoice_orders)
+
+
+def update_partitioned_months(partitions, workers=1):
+    """
+    Check and save every month of a MonthPartitions,
+    with workers > 1 several months at once
+    """
+    months = partitions.months()
+    if workers > 1 and len(months) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(update_partitioned_month,
+                              itertools.repeat(partitions), months))
+    else:
+        for month in months:
+            with span(f"month {month}",
+                      rows=partitions.order_counts[month]):
+                update_partitioned_month(partitions, month)
+
+
+def update_partitioned_month(partitions, month):
+    month_data = partitions.read_month(month)
+    sorted_group_data = run_error_checks({month: month_data})
+    update_program_data(sorted_group_data)
+
+
+def iter_input_records(headers_dict, file_type):
+    """
+    Yield (order number, record) for the first row of each order in the
+    input type's files. These are the records jsonify_data and
+    prepare_dataextract_data keep, read one at a time.
+    """
+    seen_orders = set()
+    for file in sorted(Path(f"./Input Data/{file_type}/").iterdir()):
+        print(f"    Now processing {file.name}")
+        try:
+            yield from iter_file_records(file, file_type, headers_dict,
+                                         seen_orders)
+        except Exception as e:
+            exit_on_input_error(e, file.name)
 
-def update_error_dict(dict, order_num, order_data, err_code, detail=""):
-    dict.update({order_num: order_data})
-    if detail != "":
-        err_code += ": " + detail
-    dict[order_num].update({"error_code": err_code})
-    return
 
+def read_order_number(entry, headers_set):
+    """
+    Order number of an input row, without the carrier's prefix and suffix
+    """
+    return entry[headers_set['order_number']]\
+        .replace("DT", "")\
+        .replace("_DOTERRA", "")
+
+
+def build_input_records(batch, headers_set, normal_headers):
+    """
+    Map a batch of (order number, input row) pairs to the normal headers
+    their file type provides.
+    Each datetime column is parsed in one call instead of row by row
+    """
+    columns = []
+    for header in normal_headers:
+        if header in headers_set.keys():
+            values = [entry[headers_set[header]] for _, entry in batch]
+            if "datetime" in header:
+                values = parse_iso_column(values,
+                                          headers_set["datetime_format"])
+            columns.append((header, values))
+
+    records = OrderRecord.from_columns(
+        [header for header, _ in columns],
+        [values for _, values in columns], len(batch))
+    for (order_num, _), record in zip(batch, records):
+        yield order_num, record
+
+
+def build_dataextract_record(entry):
+    """
+    Map one DataExtract row to the order data kept from it
+    """
+    temp_dict = {}
+    temp_dict.update({"id": entry['dist_id']})
+
+    read_invoice_date = \
+        dt.date.fromisoformat(entry['invoice_date'])
+    read_invoice_time =\
+        dt.time.fromisoformat(entry['invoice_time']) if \
+        entry['invoice_time'] != "::" else \
+        dt.time(0, 0)
+
+    # Offset invoice time by 7 hours if country is UK
+    # 8 if Europe
+    invoice_datetime = dt.datetime.combine(read_invoice_date,
+                                           read_invoice_time)
+
+    match entry['ship_to_country']:
+        case "EO":
+            temp_dict.update(
+                {"country": entry['ship_to_addr_3'].lower()})
+        case "GBR":
+            temp_dict.update({"country": "uk"})
+        case "MDA":
+            temp_dict.update({"country": "moldova"})
+        case "DEU":
+            temp_dict.update({"country": "germany"})
+        case "ITA":
+            temp_dict.update({"country": "italy"})
+        case "ISR":
+            temp_dict.update({"country": "israel"})
+        case "FRA":
+            temp_dict.update({"country": "france"})
+        case "POL":
+            temp_dict.update({"country": "poland"})
+        case _:
+            temp_dict.update(
+                {"country": "missing from prepare_program_data"})
+
+    temp_dict.update(
+        {"invoice_datetime": invoice_datetime.isoformat()})
+
+    if entry['ship_via'].lower().find("stan") == -1:
+        temp_dict.update({"ship_q": "prem"})
+    else:
+        temp_dict.update({"ship_q": "stand"})
+
+    return OrderRecord(temp_dict)
+
+
+def combine_data(combined_file_data, headers_dict, workers=1):
+    """
+    Combine all data into a single JSON object.
+    The input types are joined on order number in their precedence order
+    (see source_join), with workers > 1 one hash partition of the order
+    numbers per worker
+    """
+    print("\nCombining input data")
+    rules = source_rules(headers_dict, combined_file_data.keys())
+    sources = [combined_file_data[rule.name] for rule in rules]
+
+    if workers > 1:
+        return join_sources_partitioned(rules, sources, workers, workers)
+    return join_sources(rules, sources)
 
-def convert_to_pl_time(datetime_obj):
+
+def run_error_checks(grouped_data, workers=1):
     """
-    Sometimes we get our datetime objects in Z time, and need to convert them
-    to local time. Poland is the only one who does this, though.
+    Run checks on the data and remove "unclean" data to a log file.
+    Each month is put through the error_checks rules on its own,
+    with workers > 1 in parallel processes
     """
-    # If datetime string has a + or a Z in it, convert it to native PL time.
+    print("Running error checks\n")
+    config = read_check_config()
+    months = list(grouped_data.keys())
 
-    pl_timezone = dt.timezone(dt.timedelta(hours=2))
-    new_time = datetime_obj.astimezone(pl_timezone)
-    new_time = new_time.replace(tzinfo=None)
-    return new_time
+    if workers > 1 and len(months) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            sorted_months = list(executor.map(
+                check_month, [grouped_data[month] for month in months],
+                itertools.repeat(config)))
+    else:
+        sorted_months = [check_month(grouped_data[month], config)
+                         for month in months]
 
+    return dict(zip(months, sorted_months))
 
-def group_input_data(combined_dict):
+
+def group_input_data(combined_dict, no_invoice_orders=None):
     """
     Take the dictionary and orders sub-dictionaries files by import months
+    Orders without a usable import date are written to the batch error file,
+    or added to no_invoice_orders when the caller writes that file itself
     """
     print("Grouping input data\n")
-    ERROR_PATH = Path("./Program Data/Input Data Errors"
-                      "/batch_errors/no_invoice_date.txt")
     return_dict = {}
     error_dict = {}
 
     for order_num, data in combined_dict.items():
         datetime_valid_flag = True
         try:
-            import_datetime =\
-                dt.datetime.fromisoformat(data.get("import_datetime", ""))
+            import_datetime = data.datetime("import_datetime")
         except ValueError:
             datetime_valid_flag = False
-        if "import_datetime" not in data or not datetime_valid_flag:
+        if not datetime_valid_flag or import_datetime is None:
             error_dict.update({order_num: data})
             continue
         import_date = import_datetime
@@ -410,19 +564,28 @@ def group_input_data(combined_dict):
         if order_num not in return_dict[date_str].keys():
             return_dict[date_str].update({order_num: data})
 
+    if no_invoice_orders is None:
+        write_no_invoice_date_errors(error_dict.keys())
+    else:
+        no_invoice_orders.extend(error_dict.keys())
+
+    return return_dict
+
+
+def write_no_invoice_date_errors(order_nums):
+    ERROR_PATH = Path("./Program Data/Input Data Errors"
+                      "/batch_errors/no_invoice_date.txt")
     with open(ERROR_PATH, mode="w", encoding="utf-8-sig") as file:
         file.write("Total number of orders without invoice"
-                   f"date in input batch: {len(error_dict.keys())}\n")
+                   f"date in input batch: {len(order_nums)}\n")
         file.write("Orders without warehouse data from Dataextract"
                    "from the most recent run? Bad datetime format?")
         file.write("Orders:\n")
-        for order_num in error_dict.keys():
+        for order_num in order_nums:
             file.write(f"{order_num},")
 
-    return return_dict
-
 
-def update_program_data(sorted_data):
+def update_program_data(sorted_data, workers=1):
     """
     Read in the month's .json file, if it exists,
     and update it with the data from the input files
@@ -430,67 +593,138 @@ def update_program_data(sorted_data):
     clean > dirty > fyi
     If data can move up a tier, move and delete the data in the previous tier
     If not, just update the one in the list
+
+    Months are independent, so with workers > 1 they are updated in
+    parallel processes. Months without any orders in this batch are skipped
     """
     print("Updating program data files\n")
-    DIR_STRING = "./Program Data/data_by_month/"
 
-    for month, month_data in sorted_data.items():
-        file_name = month + ".json"
+    months = [month for month, month_data in sorted_data.items()
+              if any(len(month_data[tier]) > 0 for tier in MONTH_TIERS)]
+    if workers > 1 and len(months) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(update_month_file, months,
+                              [sorted_data[month] for month in months]))
+    else:
+        for month in months:
+            with span(f"update month {month}",
+                      rows=sum(len(sorted_data[month][tier])
+                               for tier in MONTH_TIERS)):
+                update_month_file(month, sorted_data[month])
+
+
+def update_month_file(month, month_data):
+    """
+    Merge one month of new data into its month file.
+    Returns False if the file was left as it was
+    """
+    month_path = Path(MONTH_DIR) / (month + ".json")
 
-        if not Path(DIR_STRING + file_name).is_file():
-            with open(Path(DIR_STRING + file_name),
-                      mode="w", encoding="utf-8-sig") as month_f:
-                json.dump(month_data, month_f)
-            continue
+    if not month_path.is_file():
+        write_month_file(month_path, month_data)
+        return True
 
-        with open(Path(DIR_STRING + file_name),
-                  mode="r", encoding="utf-8-sig") as month_f:
+    with open(month_path, mode="r", encoding="utf-8-sig") as month_f:
+        file_data = json.load(month_f)
 
-            file_data = json.load(month_f)
+    changed = False
 
-        # Cleans
-        for order_num, data in month_data["clean_data"].items():
-            file_data["clean_data"].update({order_num: data})
+    def set_order(tier, order_num, data):
+        nonlocal changed
+        if file_data[tier].get(order_num) != data:
+            file_data[tier].update({order_num: data})
+            changed = True
 
-            if order_num in file_data["dirty_data"]:
-                del file_data["dirty_data"][order_num]
-                continue
+    def remove_order(tier, order_num):
+        nonlocal changed
+        del file_data[tier][order_num]
+        changed = True
 
-            if order_num in file_data["fyi_data"]:
-                del file_data["fyi_data"][order_num]
-                continue
+    # Cleans
+    for order_num, data in month_data["clean_data"].items():
+        set_order("clean_data", order_num, data)
 
-        # Dirties
-        for order_num, data in month_data["dirty_data"].items():
-            if order_num in file_data["clean_data"]:
-                continue
+        # Orders also in this batch's dirty data are updated there below
+        if order_num in file_data["dirty_data"] and\
+           order_num not in month_data["dirty_data"]:
+            remove_order("dirty_data", order_num)
+            continue
 
-            if order_num in file_data["dirty_data"]:
-                file_data["dirty_data"].update({order_num: data})
-                continue
+        if order_num in file_data["fyi_data"]:
+            remove_order("fyi_data", order_num)
+            continue
 
-            if order_num in file_data["fyi_data"]:
-                del file_data["fyi_data"][order_num]
-                file_data["dirty_data"].update({order_num: data})
-                continue
+    # Dirties
+    # Orders this batch put in both clean and dirty (no delivery date,
+    # unknown status...) keep their error, same as in a new month file
+    for order_num, data in month_data["dirty_data"].items():
+        if order_num in file_data["clean_data"] and\
+           order_num not in month_data["clean_data"]:
+            continue
 
-        # FYI's
-        for order_num, data in month_data["fyi_data"].items():
-            if order_num in file_data["clean_data"]:
-                continue
+        if order_num in file_data["dirty_data"]:
+            set_order("dirty_data", order_num, data)
+            continue
 
-            if order_num in file_data["dirty_data"]:
-                continue
+        if order_num in file_data["fyi_data"]:
+            remove_order("fyi_data", order_num)
+            set_order("dirty_data", order_num, data)
+            continue
 
-            if order_num in file_data["fyi_data"]:
-                file_data["fyi_data"].update({order_num: data})
-                continue
+        # New to this month
+        set_order("dirty_data", order_num, data)
+
+    # FYI's
+    for order_num, data in month_data["fyi_data"].items():
+        if order_num in file_data["clean_data"]:
+            continue
+
+        if order_num in file_data["dirty_data"]:
+            continue
 
-        with open(Path(DIR_STRING + file_name),
-                  mode="w", encoding="utf-8-sig") as month_f:
-            json.dump(file_data, month_f)
+        # Either an update or new to this month
+        set_order("fyi_data", order_num, data)
+
+    if changed:
+        write_month_file(month_path, file_data)
+    return changed
+
+
+def write_month_file(month_path, month_data):
+    """
+    Write to a temporary file first and rename it over the month file,
+    so a crash part way through never leaves a half written month.
+    The month's index, used for date range loading, is written with it
+    """
+    write_indexed_month(month_path, month_data)
 
 
 if __name__ == "__main__":
-    prepare_program_data()
+    parser = argparse.ArgumentParser(
+        description="Read the Input Data files into the program data files")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--streaming", action="store_true",
+                      help="merge rows as they are read and spill to disk "
+                           "past the memory limit")
+    mode.add_argument("--incremental", action="store_true",
+                      help="only read input files that are new or changed "
+                           "since the last incremental run")
+    parser.add_argument("--max-memory-mb", type=int,
+                        default=DEFAULT_MAX_MEMORY_MB,
+                        help="memory ceiling for --streaming, in MB")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes used to read, combine, "
+                             "check and update files")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    start_tracing(args.trace, args.chrome_trace, args.trace_memory)
+    try:
+        with span("prepare_program_data"):
+            prepare_program_data(streaming=args.streaming,
+                                 max_memory_mb=args.max_memory_mb,
+                                 workers=args.workers,
+                                 incremental=args.incremental)
+    finally:
+        finish_tracing()
     print("Program Data Prepared")
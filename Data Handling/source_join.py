@@ -0,0 +1,122 @@
+"""
+Joins the orders of every input type (source) on their order number.
+
+Which source's value an order keeps is declared in headers.json:
+    "source_order": ["data_extract", "wh_pl", "carrier_dpd"]
+        the order sources are joined in. Sources not listed follow in
+        name order; without it every source is joined in name order
+    "<source>": {"overwrite": true}
+        this source's fields replace values from sources before it.
+        Otherwise a field keeps the value of the first source that had it
+    "<source>": {"overwrite_fields": {"latest_status": false}}
+        the same, field by field, over the source's "overwrite"
+
+So a field ends up with the value of the last source that overwrites it,
+or if none does, of the first source that has it. Orders and their fields
+are listed in the order they are first met.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import zlib
+
+
+class SourceRule:
+    """
+    How one source's fields are merged into what earlier sources gave
+    """
+
+    def __init__(self, name, overwrite=False, overwrite_fields=None):
+        self.name = name
+        self.overwrite = overwrite
+        self.overwrite_fields = overwrite_fields or None
+        self.overwrites_any = overwrite or \
+            any((overwrite_fields or {}).values())
+
+    def overwrites(self, field):
+        if self.overwrite_fields is None:
+            return self.overwrite
+        return self.overwrite_fields.get(field, self.overwrite)
+
+    def merge(self, current, record):
+        """
+        Merge record into the order's current data, in place
+        """
+        if hasattr(current, "merge"):
+            current.merge(record, self.overwrite, self.overwrite_fields)
+            return
+        for key, value in record.items():
+            if key not in current or self.overwrites(key):
+                current.update({key: value})
+
+
+def source_rules(headers_dict, source_names):
+    """
+    A SourceRule for each source, in the order they are joined
+    """
+    declared = headers_dict.get("source_order", [])
+    for name in declared:
+        if name not in headers_dict:
+            raise ValueError(f"source_order lists {name}, "
+                             "which has no entry in headers.json")
+    ordered = [name for name in declared if name in source_names] + \
+        sorted(name for name in source_names if name not in declared)
+
+    rules = []
+    for name in ordered:
+        settings = headers_dict.get(name, {})
+        rules.append(SourceRule(name, settings.get("overwrite", False),
+                                settings.get("overwrite_fields")))
+    return rules
+
+
+def order_partition(order_num, partitions):
+    """
+    The partition an order number belongs to.
+    crc32 rather than hash(), which changes between interpreter runs
+    """
+    return zlib.crc32(order_num.encode("utf-8")) % partitions
+
+
+def join_sources(rules, sources):
+    """
+    Join {order number: record} dictionaries, one per rule.
+    The first record met for an order becomes its combined record
+    """
+    joined = {}
+    for rule, source_data in zip(rules, sources):
+        for order_num, record in source_data.items():
+            current = joined.get(order_num)
+            if current is None:
+                joined[order_num] = record
+            else:
+                rule.merge(current, record)
+    return joined
+
+
+def join_sources_partitioned(rules, sources, partitions, workers=1):
+    """
+    join_sources, run separately on each hash partition of the order
+    numbers, with up to workers processes. An order's records are all in
+    the same partition, so the result is the same as one join
+    """
+    partitioned = [[{} for _ in sources] for _ in range(partitions)]
+    for source_number, source_data in enumerate(sources):
+        for order_num, record in source_data.items():
+            partitioned[order_partition(order_num, partitions)][
+                source_number][order_num] = record
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(join_sources,
+                                      [rules] * partitions, partitioned))
+    else:
+        parts = [join_sources(rules, part_sources)
+                 for part_sources in partitioned]
+
+    # Back in the order a single join meets the orders in
+    first_met = {}
+    for source_data in sources:
+        first_met.update(dict.fromkeys(source_data))
+    combined = {}
+    for part in parts:
+        combined.update(part)
+    return {order_num: combined[order_num] for order_num in first_met}
@@ -1,60 +1,137 @@
 from pathlib import Path
-import json
+import argparse
 from datetime import datetime
-from prepare_otd_report import prepare_otd_report
-from prepare_dwell_time_report import prepare_dwell_time_report
-from prepare_c2f_report import prepare_c2f_report
+from helper_functions import REPORT_DIR
+from report_engine import run_reports, read_report_configs, \
+    run_job_file, ReportJobRunner, REPORT_NAMES
+from business_calendar import load_calendar_registry
+from order_store import read_combined_orders
+from instrumentation import span, start_tracing, finish_tracing, \
+    add_trace_arguments
 
 
-def main():
+def main(report_names=None, start_dt=None, end_dt=None,
+         output_dir=REPORT_DIR, job_file=None, ranges=None,
+         use_cache=True):
     """
     Script for preparing aop report, creating a month-by-month performance %
     of 3 key indicators:
         Click to Delivery
         On-time delivery
         Click to fuilfill
+
+    With no arguments the user picks the reports, which are prepared from
+    the loaded program data (see load_program_data).
+    Given a date range, the orders are read straight from the month files.
+    Given several (start, end) ranges, or a job file, every range is
+    prepared from one load of the months they cover.
+    Date ranges and job files reuse the cached results of months that
+    have not changed, unless use_cache is False
     """
 
     start_time = datetime.now()
 
+    if job_file is not None:
+        run_job_file(job_file, use_cache=use_cache)
+    elif ranges:
+        # One sub directory per range
+        report_names = report_names or list(REPORT_NAMES)
+        ReportJobRunner(use_cache=use_cache).run_many([
+            (range_start, range_end, report_names,
+             Path(output_dir) / f"{range_start.date()} to {range_end.date()}")
+            for range_start, range_end in ranges])
+    elif start_dt is not None and end_dt is not None:
+        ReportJobRunner(use_cache=use_cache).run(
+            start_dt, end_dt, report_names or list(REPORT_NAMES), output_dir)
+    else:
+        prepare_loaded_reports(report_names, output_dir)
+
+    end_time = datetime.now()
+    duration = end_time - start_time
+
+    print(f'Report(s) prepared in in {str(duration.seconds)} seconds')
+
+
+def prepare_loaded_reports(report_names=None, output_dir=REPORT_DIR):
+    """
+    Prepare reports from the combined program data files.
+    The user picks the reports when report_names is not given
+    """
     # Read in program data files
-    with open(Path('./Program Data/combined_files/combined-filtered.json'),
-              mode="r", encoding="utf-8-sig") as json_file:
-        composite_dictionary = json.load(json_file)
+    # The columnar store is used when it is at least as new as the json
+    with span("read_combined_orders") as stage:
+        composite_dictionary = read_combined_orders()
+        stage.rows = len(composite_dictionary)
 
     # Read in needed config files
-    with open(Path('./Shared Config Files/countries.json'), mode="r",
-              encoding="utf-8-sig") as json_file:
-        country_config_data = json.load(json_file)
+    country_config_data, warehouse_config_data = read_report_configs()
+
+    # Business day calendars are shared by all reports
+    calendars = load_calendar_registry()
 
-    with open(Path('./Shared Config Files/warehouses.json'), mode="r",
-              encoding="utf-8-sig") as json_file:
-        warehouse_config_data = json.load(json_file)
+    if report_names is None:
+        report_names = ask_for_reports()
 
+    # Every report selected is prepared from one pass over the orders
+    run_reports(report_names, country_config_data, warehouse_config_data,
+                composite_dictionary, calendars, output_dir)
+
+
+def ask_for_reports():
     print("O - OTD Report")
     print("D - Dwell Time Report")
     print("C - CTF Report")
     print("All - All reports")
     user_input = input("Which reports do you want?\n").lower()
 
+    report_names = []
     if user_input.find("o") != -1 or user_input.find("a") != -1:
-        print("Preparing OTD Report")
-        prepare_otd_report(country_config_data, composite_dictionary)
-
+        report_names.append("otd")
     if user_input.find("d") != -1 or user_input.find("a") != -1:
-        print("Preparing Dwell Time Report")
-        prepare_dwell_time_report(composite_dictionary, country_config_data)
-
+        report_names.append("dwell")
     if user_input.find("c") != -1 or user_input.find("a") != -1:
-        print("Preparing C2F Report")
-        prepare_c2f_report(country_config_data, warehouse_config_data,
-                           composite_dictionary)
+        report_names.append("c2f")
+    return report_names
 
-    end_time = datetime.now()
-    duration = end_time - start_time
 
-    print(f'Report(s) prepared in in {str(duration.seconds)} seconds')
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prepare the aop reports. Without arguments, asks "
+                    "which reports to prepare from the loaded program data")
+    parser.add_argument("--reports", nargs="+",
+                        choices=list(REPORT_NAMES) + ["all"],
+                        help="reports to prepare")
+    parser.add_argument("--start", type=datetime.fromisoformat,
+                        help="start date, inclusive (yyyy-mm-dd). Reads "
+                             "the month files instead of the loaded data")
+    parser.add_argument("--end", type=datetime.fromisoformat,
+                        help="end date, exclusive (yyyy-mm-dd)")
+    parser.add_argument("--range", nargs=2, action="append", dest="ranges",
+                        type=datetime.fromisoformat, metavar=("START", "END"),
+                        help="a start (inclusive) and end (exclusive) date. "
+                             "Repeat for more ranges, all prepared from one "
+                             "load, each in its own sub directory")
+    parser.add_argument("--output-dir", type=Path, default=REPORT_DIR,
+                        help="directory the reports are written to")
+    parser.add_argument("--job-file", type=Path,
+                        help="json file listing report jobs to run")
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache",
+                        help="work out every month again instead of using "
+                             "the cached results of unchanged months")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
 
+    if (args.start is None) != (args.end is None):
+        parser.error("--start and --end go together")
 
-if __name__ == "__main__":
-    main()
+    report_names = args.reports
+    if report_names is not None and "all" in report_names:
+        report_names = list(REPORT_NAMES)
+
+    start_tracing(args.trace, args.chrome_trace, args.trace_memory)
+    try:
+        with span("aop_report"):
+            main(report_names, args.start, args.end, args.output_dir,
+                 args.job_file, args.ranges, args.use_cache)
+    finally:
+        finish_tracing()
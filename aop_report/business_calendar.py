@@ -0,0 +1,77 @@
+from pathlib import Path
+import json
+import numpy as np
+
+
+class CalendarRegistry:
+    """
+    Builds numpy business day calendars from the holiday config files
+    and hands them out by country or warehouse.
+    Each calendar is built the first time it is asked for, then reused.
+
+    Country calendars: holidays.json "all" + the country's list
+    Warehouse calendars: warehouses.json holidays "all" + the warehouse's list
+    Neither: weekends only
+    """
+
+    def __init__(self, holiday_data, wh_config_data):
+        self.holiday_data = holiday_data
+        self.wh_holiday_data = wh_config_data['holidays']
+        self._holidays = {}
+        self._calendars = {}
+
+    def holidays(self, country=None, warehouse=None):
+        """
+        The combined list of holiday date strings, as written in the config
+        """
+        key = (country, warehouse)
+        if key not in self._holidays:
+            current_holidays = []
+            if warehouse is not None:
+                current_holidays += self.wh_holiday_data['all']
+                current_holidays += self.wh_holiday_data[warehouse]
+            elif country is not None:
+                current_holidays += self.holiday_data['all']
+                if country in self.holiday_data:
+                    current_holidays += self.holiday_data[country]
+            self._holidays.update({key: current_holidays})
+        return self._holidays[key]
+
+    def calendar(self, country=None, warehouse=None):
+        key = (country, warehouse)
+        if key not in self._calendars:
+            self._calendars.update({key: np.busdaycalendar(
+                holidays=self.holidays(country, warehouse))})
+        return self._calendars[key]
+
+    def count(self, begin_dates, end_dates, country=None, warehouse=None):
+        """
+        numpy.busday_count against the country's or warehouse's calendar.
+        Takes single dates or whole arrays of them
+        """
+        return np.busday_count(begin_dates, end_dates,
+                               busdaycal=self.calendar(country, warehouse))
+
+    def offset(self, dates, offsets, roll='forward',
+               country=None, warehouse=None):
+        """
+        numpy.busday_offset against the country's or warehouse's calendar.
+        Takes single dates or whole arrays of them
+        """
+        return np.busday_offset(dates, offsets, roll=roll,
+                                busdaycal=self.calendar(country, warehouse))
+
+
+def load_calendar_registry(config_dir="./Shared Config Files"):
+    """
+    Read holidays.json and warehouses.json and build a registry from them
+    """
+    with open(Path(config_dir) / "holidays.json",
+              mode="r", newline='', encoding="utf-8-sig") as f:
+        holiday_data = json.load(f)
+
+    with open(Path(config_dir) / "warehouses.json",
+              mode="r", encoding="utf-8-sig") as f:
+        wh_config_data = json.load(f)
+
+    return CalendarRegistry(holiday_data, wh_config_data)
@@ -1,15 +1,111 @@
+from bisect import bisect_right
 from datetime import datetime
+from pathlib import Path
+import numpy as np
 
+# Where the aop reports are written unless told otherwise
+REPORT_DIR = Path('./aop_report/Completed Reports')
 
-def get_order_warehouse(wh_data, country_data, import_datetime, order_country):
-    order_country = order_country.lower()
-    order_warehouse = country_data[order_country]['warehouse']
 
-    if order_country in wh_data['warehouse_swap_dates']:
-        swap_date = datetime.fromisoformat(
-            wh_data['warehouse_swap_dates'][order_country]['date'])
+class WarehouseRouter:
+    """
+    The warehouse each country's orders go to over time, built once from
+    the country and warehouse config files.
 
-        if import_datetime >= swap_date:
-            order_warehouse = \
-                wh_data['warehouse_swap_dates'][order_country]['swap_to']
-    return order_warehouse
+    A country starts at its countries.json warehouse, and changes at each
+    of its warehouse_swap_dates. A swap is either one
+    {"date": ..., "swap_to": ...} or a list of them, in any order.
+    Orders dated on or after a swap date go to its warehouse
+    """
+
+    def __init__(self, wh_data, country_data):
+        self.routes = {}
+        swap_dates = wh_data.get('warehouse_swap_dates', {})
+        for country, country_config in country_data.items():
+            swaps = swap_dates.get(country, [])
+            if isinstance(swaps, dict):
+                swaps = [swaps]
+            swaps = sorted((datetime.fromisoformat(swap['date']),
+                            swap['swap_to']) for swap in swaps)
+
+            self.routes.update({country: (
+                [swap_date for swap_date, _ in swaps],
+                [country_config['warehouse']] +
+                [warehouse for _, warehouse in swaps])})
+
+    def resolve(self, order_country, order_datetime):
+        """
+        The warehouse of one order
+        """
+        swap_dates, warehouses = self.routes[order_country.lower()]
+        return warehouses[bisect_right(swap_dates, order_datetime)]
+
+    def resolve_array(self, order_countries, order_datetimes):
+        """
+        The warehouse of each (country, datetime) pair, for sequences of
+        countries and datetime64 values, as an object array
+        """
+        order_countries = np.asarray(order_countries)
+        order_datetimes = np.asarray(order_datetimes, dtype='datetime64[s]')
+        order_warehouses = np.empty(len(order_countries), dtype=object)
+
+        unique_countries, country_keys = np.unique(order_countries,
+                                                   return_inverse=True)
+        for country_key, order_country in enumerate(unique_countries):
+            swap_dates, warehouses = self.routes[str(order_country).lower()]
+            is_country = country_keys == country_key
+            positions = np.searchsorted(
+                np.array(swap_dates, dtype='datetime64[s]'),
+                order_datetimes[is_country], side='right')
+            order_warehouses[is_country] = \
+                np.array(warehouses, dtype=object)[positions]
+        return order_warehouses
+
+
+def to_day_array(datetime_strings):
+    """
+    Convert a sequence of iso datetime strings into a datetime64[D] array
+    holding the calendar date of each, i.e. datetime.fromisoformat(x).date()
+    Empty strings become NaT
+    """
+    # The date is the first 10 characters of an extended iso string.
+    # Anything numpy can't read that way goes through fromisoformat instead
+    day_strings = np.array(datetime_strings, dtype='U10')
+    try:
+        return day_strings.astype('datetime64[D]')
+    except ValueError:
+        return np.array([datetime.fromisoformat(value).date()
+                         if value != "" else None
+                         for value in datetime_strings],
+                        dtype='datetime64[D]')
+
+
+def first_seen_counts(keys):
+    """
+    Count the occurrences of each integer key.
+    Returns (unique keys, counts), ordered by where each key first appears,
+    which matches the order a dict would be filled in by a per-order loop
+    """
+    unique_keys, first_index, counts = np.unique(keys, return_index=True,
+                                                 return_counts=True)
+    order = np.argsort(first_index, kind='stable')
+    return unique_keys[order], counts[order]
+
+
+def to_datetime_array(datetime_strings):
+    """
+    Convert a sequence of iso datetime strings into a datetime64[s] array.
+    Timezone offsets are dropped, keeping the wall clock time, the same as
+    datetime.fromisoformat(x).replace(tzinfo=None). Empty strings become NaT
+    """
+    # 'yyyy-mm-ddThh:mm:ss' is the first 19 characters of an extended iso
+    # string; fractions of a second and offsets come after it
+    second_strings = np.array(datetime_strings, dtype='U19')
+    try:
+        return second_strings.astype('datetime64[s]')
+    except ValueError:
+        return np.array([datetime.fromisoformat(value)
+                         .replace(tzinfo=None, microsecond=0)
+                         if value != "" else None
+                         for value in datetime_strings],
+                        dtype='datetime64[s]')
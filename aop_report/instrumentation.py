@@ -0,0 +1,261 @@
+"""
+Nested timing spans for the ingestion and report scripts.
+
+    with span("combine_data") as stage:
+        combined_data = combine_data(all_input_data, headers_dict)
+        stage.rows = len(combined_data)
+
+Each span records its wall and CPU seconds, the rows it handled, rows per
+second, the growth of the process's peak RSS and, with trace_memory, the
+tracemalloc delta and peak of python allocations inside it. Spans opened
+inside a span become its children.
+
+Tracing is off unless start_tracing is called, either with a trace path
+(the --trace options of the scripts) or with the AOP_TRACE environment
+variable set. While it is off, span costs next to nothing.
+finish_tracing writes the span tree as json and, if asked, as a Chrome
+trace-event file (open it in chrome://tracing or ui.perfetto.dev).
+
+Work done in worker processes (--workers) is timed as a whole by the span
+around it, but its CPU time is not counted.
+"""
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import datetime as dt
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows
+    resource = None
+
+TRACE_ENV = "AOP_TRACE"
+CHROME_TRACE_ENV = "AOP_CHROME_TRACE"
+TRACE_MEMORY_ENV = "AOP_TRACE_MEMORY"
+
+
+class Span:
+    """
+    One timed stage. rows may be set while the span is open
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.children = []
+        self.wall_start = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+        self.peak_rss_growth_mb = None
+        self.traced_start = None
+        self.traced_peak = None
+        self.traced_delta_mb = None
+        self.traced_peak_mb = None
+
+    def as_dict(self):
+        rows_per_second = None
+        if self.rows is not None and self.wall_seconds:
+            rows_per_second = round(self.rows / self.wall_seconds, 1)
+        span_dict = {
+            "name": self.name,
+            "wall_seconds": round(self.wall_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            "rows": self.rows,
+            "rows_per_second": rows_per_second,
+            "peak_rss_mb": self.peak_rss_mb,
+            "peak_rss_growth_mb": self.peak_rss_growth_mb
+        }
+        if self.traced_peak_mb is not None:
+            span_dict.update({"traced_delta_mb": self.traced_delta_mb,
+                              "traced_peak_mb": self.traced_peak_mb})
+        span_dict.update({"children": [child.as_dict()
+                                       for child in self.children]})
+        return span_dict
+
+
+class Tracer:
+    """
+    Keeps the tree of spans of one run
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.started_at = dt.datetime.now()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self._open_spans = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name, rows=None):
+        stage = Span(name, rows)
+        parent = self._open_spans[-1] if self._open_spans else None
+        (parent.children if parent is not None else self.spans).append(stage)
+
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for this span, so the open spans
+            # keep the peak they had reached so far
+            for open_span in self._open_spans:
+                open_span.traced_peak = max(open_span.traced_peak, peak)
+            tracemalloc.reset_peak()
+            stage.traced_start = current
+            stage.traced_peak = current
+
+        self._open_spans.append(stage)
+        rss_start = peak_rss_mb()
+        cpu_start = time.process_time()
+        stage.wall_start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.wall_seconds = time.perf_counter() - stage.wall_start
+            stage.cpu_seconds = time.process_time() - cpu_start
+            stage.peak_rss_mb = peak_rss_mb()
+            if rss_start is not None:
+                stage.peak_rss_growth_mb = round(
+                    stage.peak_rss_mb - rss_start, 2)
+            self._open_spans.pop()
+
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                stage.traced_peak = max(stage.traced_peak, peak)
+                stage.traced_delta_mb = round(
+                    (current - stage.traced_start) / 2 ** 20, 3)
+                stage.traced_peak_mb = round(
+                    (stage.traced_peak - stage.traced_start) / 2 ** 20, 3)
+                if parent is not None:
+                    parent.traced_peak = max(parent.traced_peak,
+                                             stage.traced_peak)
+
+    def as_dict(self):
+        return {
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "command": sys.argv,
+            "trace_memory": self.trace_memory,
+            "spans": [stage.as_dict() for stage in self.spans]
+        }
+
+    def write(self, trace_path, chrome_trace_path=None):
+        """
+        Write the spans as a json tree, and as Chrome trace events
+        """
+        with open(trace_path, mode="w", encoding="utf-8") as trace_file:
+            json.dump(self.as_dict(), trace_file, indent=4)
+
+        if chrome_trace_path is not None:
+            with open(chrome_trace_path, mode="w",
+                      encoding="utf-8") as trace_file:
+                json.dump({"traceEvents": self.chrome_events(),
+                           "displayTimeUnit": "ms"}, trace_file)
+
+    def chrome_events(self):
+        """
+        One complete ("X") event per span, in microseconds from the start
+        """
+        events = []
+        pending = list(self.spans)
+        while len(pending) > 0:
+            stage = pending.pop()
+            pending += stage.children
+            args = {key: value for key, value in stage.as_dict().items()
+                    if key not in ("name", "children", "wall_seconds")}
+            events.append({
+                "name": stage.name,
+                "ph": "X",
+                "ts": round((stage.wall_start - self.origin) * 1e6),
+                "dur": round(stage.wall_seconds * 1e6),
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": args
+            })
+        events.sort(key=lambda event: (event["ts"], -event["dur"]))
+        return events
+
+
+class _NullSpan:
+    rows = None
+
+
+_tracer = None
+_trace_paths = (None, None)
+
+
+def start_tracing(trace_path=None, chrome_trace_path=None,
+                  trace_memory=False):
+    """
+    Turn tracing on if a trace path is given here or in AOP_TRACE.
+    AOP_CHROME_TRACE and AOP_TRACE_MEMORY=1 fill in the other two
+    """
+    global _tracer, _trace_paths
+    trace_path = trace_path or os.environ.get(TRACE_ENV)
+    chrome_trace_path = chrome_trace_path or \
+        os.environ.get(CHROME_TRACE_ENV)
+    trace_memory = trace_memory or \
+        os.environ.get(TRACE_MEMORY_ENV, "") not in ("", "0")
+    if trace_path is None and chrome_trace_path is None:
+        return None
+
+    _tracer = Tracer(trace_memory)
+    _trace_paths = (trace_path, chrome_trace_path)
+    return _tracer
+
+
+def finish_tracing():
+    """
+    Write the trace files, if tracing was started
+    """
+    global _tracer
+    if _tracer is None:
+        return
+    trace_path, chrome_trace_path = _trace_paths
+    if trace_path is None:
+        # Chrome trace only
+        trace_path = Path(chrome_trace_path).with_suffix(".spans.json")
+    _tracer.write(trace_path, chrome_trace_path)
+    print(f"Trace written to {trace_path}")
+    _tracer = None
+
+
+def span(name, rows=None):
+    """
+    A span of the running trace, or a stand in when tracing is off
+    """
+    if _tracer is None:
+        return nullcontext(_NullSpan())
+    return _tracer.span(name, rows)
+
+
+def add_trace_arguments(parser):
+    """
+    The --trace options shared by the scripts
+    """
+    parser.add_argument("--trace", type=Path,
+                        help="write a json trace of each stage's time "
+                             f"and memory (or set {TRACE_ENV})")
+    parser.add_argument("--chrome-trace", type=Path,
+                        help="also write a Chrome trace-event file "
+                             f"(or set {CHROME_TRACE_ENV})")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="trace python allocations too, slower "
+                             f"(or set {TRACE_MEMORY_ENV}=1)")
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of the process so far, None where unknown
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return round(peak / 2 ** 20, 2)
+    return round(peak / 2 ** 10, 2)
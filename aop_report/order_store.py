@@ -0,0 +1,182 @@
+from pathlib import Path
+import json
+import numpy as np
+from helper_functions import to_datetime_array
+
+COMBINED_JSON_PATH = Path("./Program Data/combined_files/"
+                          "combined-filtered.json")
+COMBINED_STORE_PATH = Path("./Program Data/combined_files/"
+                           "combined-filtered.store")
+
+# Fields held as datetime64[s] columns. Every other field is categorical
+DATETIME_FIELDS = ("invoice_datetime", "import_datetime",
+                   "ship_datetime", "delivery_datetime")
+
+STORE_VERSION = 1
+
+
+class OrderStore:
+    """
+    Column-oriented set of orders, the binary alternative to
+    combined-filtered.json.
+
+    On disk it is a directory of .npy files:
+        order_numbers.npy         fixed width string table
+        <datetime field>.npy      datetime64[s] (int64 seconds), NaT if empty
+        <field>.codes.npy         int32 category codes, -1 if missing
+        <field>.categories.npy    the category strings
+        manifest.json             field lists and the order count
+    Loading memory maps every column, so nothing is parsed or copied
+    until a report reads it.
+    """
+
+    def __init__(self, order_numbers, datetime_columns,
+                 categorical_columns, field_order):
+        self.order_numbers = order_numbers
+        self.datetime_columns = datetime_columns
+        self.categorical_columns = categorical_columns
+        self.field_order = field_order
+
+    def __len__(self):
+        return len(self.order_numbers)
+
+    @classmethod
+    def from_dict(cls, orders):
+        """
+        Build a store from a {order_number: order data} dictionary
+        """
+        return cls.from_records(list(orders.keys()), list(orders.values()))
+
+    @classmethod
+    def from_records(cls, order_numbers, records):
+        """
+        Build a store from matching lists of order numbers and order data.
+        Unlike a dictionary, an order number may appear more than once
+        """
+        field_order = []
+        for data in records:
+            for field in data.keys():
+                if field not in field_order:
+                    field_order.append(field)
+
+        datetime_columns = {}
+        categorical_columns = {}
+        for field in field_order:
+            if field in DATETIME_FIELDS:
+                datetime_columns.update({field: to_datetime_array(
+                    [data.get(field, "") for data in records])})
+                continue
+
+            categories = {}
+            codes = np.fromiter(
+                (categories.setdefault(data[field], len(categories))
+                 if field in data else -1 for data in records),
+                dtype=np.int32, count=len(records))
+            categorical_columns.update(
+                {field: (codes, np.array(list(categories.keys()), dtype=str))})
+
+        order_numbers = np.array(order_numbers, dtype=str)
+        return cls(order_numbers, datetime_columns,
+                   categorical_columns, field_order)
+
+    def save(self, store_dir):
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        (store_dir / "manifest.json").unlink(missing_ok=True)
+
+        np.save(store_dir / "order_numbers.npy", self.order_numbers)
+        for field, values in self.datetime_columns.items():
+            np.save(store_dir / f"{field}.npy", values)
+        for field, (codes, categories) in self.categorical_columns.items():
+            np.save(store_dir / f"{field}.codes.npy", codes)
+            np.save(store_dir / f"{field}.categories.npy", categories)
+
+        # The manifest is removed first and written last,
+        # so a half written store is never loaded
+        manifest = {
+            "version": STORE_VERSION,
+            "count": len(self),
+            "field_order": self.field_order,
+            "datetime_fields": list(self.datetime_columns.keys()),
+            "categorical_fields": list(self.categorical_columns.keys())
+        }
+        with open(store_dir / "manifest.json",
+                  mode="w", encoding="utf-8-sig") as f:
+            json.dump(manifest, f)
+
+    @classmethod
+    def load(cls, store_dir, mmap_mode='r'):
+        store_dir = Path(store_dir)
+        with open(store_dir / "manifest.json",
+                  mode="r", encoding="utf-8-sig") as f:
+            manifest = json.load(f)
+
+        order_numbers = np.load(store_dir / "order_numbers.npy",
+                                mmap_mode=mmap_mode)
+        datetime_columns = {}
+        for field in manifest["datetime_fields"]:
+            datetime_columns.update({field: np.load(
+                store_dir / f"{field}.npy", mmap_mode=mmap_mode)})
+        categorical_columns = {}
+        for field in manifest["categorical_fields"]:
+            codes = np.load(store_dir / f"{field}.codes.npy",
+                            mmap_mode=mmap_mode)
+            categories = np.load(store_dir / f"{field}.categories.npy")
+            categorical_columns.update({field: (codes, categories)})
+
+        return cls(order_numbers, datetime_columns,
+                   categorical_columns, manifest["field_order"])
+
+    def datetimes(self, field):
+        """
+        datetime64[s] column, NaT where the order has no value
+        """
+        if field not in self.datetime_columns:
+            return np.full(len(self), np.datetime64("NaT"),
+                           dtype='datetime64[s]')
+        return self.datetime_columns[field]
+
+    def dates(self, field):
+        return self.datetimes(field).astype('datetime64[D]')
+
+    def codes(self, field):
+        return self.categorical_columns[field][0]
+
+    def categories(self, field):
+        return self.categorical_columns[field][1]
+
+    def values(self, field):
+        """
+        String column, empty where the order does not have the field
+        """
+        if field not in self.categorical_columns:
+            return np.full(len(self), "", dtype=str)
+        codes, categories = self.categorical_columns[field]
+        # Code -1 picks up the trailing empty string
+        return np.append(categories, "")[codes]
+
+
+def as_order_store(orders):
+    """
+    Reports accept either the combined dictionary or an OrderStore
+    """
+    if isinstance(orders, OrderStore):
+        return orders
+    return OrderStore.from_dict(orders)
+
+
+def read_combined_orders(json_path=COMBINED_JSON_PATH,
+                         store_path=COMBINED_STORE_PATH):
+    """
+    Load the combined order data, preferring the columnar store unless
+    the json file has been written since
+    """
+    store_manifest = Path(store_path) / "manifest.json"
+    json_path = Path(json_path)
+    if store_manifest.is_file() and (
+            not json_path.is_file()
+            or store_manifest.stat().st_mtime >= json_path.stat().st_mtime):
+        return OrderStore.load(store_path)
+
+    with open(json_path, mode="r", encoding="utf-8-sig") as json_file:
+        return OrderStore.from_dict(json.load(json_file))
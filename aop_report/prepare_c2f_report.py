@@ -1,12 +1,19 @@
 from pathlib import Path
-from datetime import datetime
-from numpy import busday_count
-from helper_functions import get_order_warehouse
-from zoneinfo import ZoneInfo
+from helper_functions import WarehouseRouter, first_seen_counts, REPORT_DIR
+from business_calendar import load_calendar_registry
+from order_store import as_order_store
+from timezone_offsets import offset_table
+import numpy as np
+
+# Invoice times are recorded in Denver time
+US_TIMEZONE = "America/Denver"
+
+# C2F has always allowed this many days over a country's otd_days
+OTD_DAYS_ALLOWANCE = 2
 
 
 def prepare_c2f_report(country_data_json, warehouse_config_data,
-                       composite_dict):
+                       composite_dict, calendars=None):
     """
     Input: json objects with each warehouse's data
     Output: A text file with what percent of orders
@@ -17,8 +24,129 @@ def prepare_c2f_report(country_data_json, warehouse_config_data,
         (i.e. no returned status) - the invoice date is
         equal to or lower than the
         "on-time threshold" provided on the config file.
+
+    Orders are handled in one batch: the invoice timezone shift and the
+    business day counts are worked out on whole columns.
+    """
+
+    if calendars is None:
+        calendars = load_calendar_registry()
+
+    write_report_data(*compute_c2f_report(
+        country_data_json, warehouse_config_data, composite_dict,
+        calendars))
+
+
+def compute_c2f_report(country_data_json, warehouse_config_data,
+                       composite_dict, calendars):
+    """
+    The monthly on time and late counts per warehouse and per country.
+    Returns (wh_dict, wh_list, country_dict, country_list)
+    """
+    orders = as_order_store(composite_dict)
+    c2f_orders = classify_c2f_orders(country_data_json,
+                                     warehouse_config_data, orders, calendars)
+    return summarize_c2f_orders(c2f_orders, np.arange(len(orders)),
+                                country_data_json, warehouse_config_data)
+
+
+def classify_c2f_orders(country_data_json, warehouse_config_data, orders,
+                        calendars):
+    """
+    Work out every order's C2F result once. Returns a dict of columns,
+    one value per order in the store:
+        measured        True for clean orders, the only ones counted
+        warehouses, countries (lower case)
+        months          invoice month, as datetime64[M] integers
+        is_late
+    Columns are only filled in where measured.
+    summarize_c2f_orders then counts any selection of these orders
+    """
+    measured = orders.values('status') == "clean"
+    selected = np.flatnonzero(measured)
+    countries = np.char.lower(orders.values('country'))
+    selected_countries = countries[selected]
+
+    # Included here to account for the American invoice date
+    invoice_datetimes = orders.datetimes('invoice_datetime')[selected]
+    invoice_dates = (invoice_datetimes + daylight_savings_time_adjustments(
+        invoice_datetimes, selected_countries)).astype('datetime64[D]')
+    latest_status_dates = orders.dates('delivery_datetime')[selected]
+
+    # Get num of business days:
+    # C2F has always counted weekends only, so no holiday calendar is used
+    # and one call covers every country
+    num_business_days = calendars.count(invoice_dates, latest_status_dates)
+
+    # Get the needed sla
+    otd_days = lookup_c2f_otd_days(country_data_json, selected_countries,
+                                   orders.values('ship_q')[selected])
+
+    # Get order warehouse, taking into account the days the warehouses
+    # Were swapped
+    router = WarehouseRouter(warehouse_config_data, country_data_json)
+    warehouses = np.full(len(orders), "", dtype=object)
+    warehouses[selected] = router.resolve_array(
+        selected_countries, invoice_dates.astype('datetime64[s]'))
+
+    months = np.zeros(len(orders), dtype=np.int64)
+    months[selected] = invoice_dates.astype('datetime64[M]')\
+        .astype(np.int64)
+    is_late = np.zeros(len(orders), dtype=bool)
+    is_late[selected] = num_business_days > otd_days + OTD_DAYS_ALLOWANCE
+
+    return {
+        'measured': measured,
+        'warehouses': warehouses,
+        'countries': countries,
+        'months': months,
+        'is_late': is_late
+    }
+
+
+def lookup_c2f_otd_days(country_data_json, countries, ship_qs):
+    """
+    otd_days for each order's country and ship_q, as an int array.
+    A pair missing from the config raises KeyError
     """
+    pairs = np.char.add(np.char.add(countries, "|"), ship_qs)
+    _, first_index, pair_codes = np.unique(pairs, return_index=True,
+                                           return_inverse=True)
+    pair_days = np.array(
+        [country_data_json[str(countries[index])]['otd_days']
+         [str(ship_qs[index])] for index in first_index.tolist()],
+        dtype=np.int64)
+    return pair_days[pair_codes]
+
+
+def summarize_c2f_orders(c2f_orders, rows, country_data_json,
+                         warehouse_config_data):
+    """
+    Count the classified orders at the given row positions, in that order.
+    Returns (wh_dict, wh_list, country_dict, country_list)
+    """
+    wh_dict, wh_list, country_dict, country_list = empty_c2f_results(
+        country_data_json, warehouse_config_data)
+
+    rows = rows[c2f_orders['measured'][rows]]
+    if len(rows) == 0:
+        return wh_dict, wh_list, country_dict, country_list
+
+    months = c2f_orders['months'][rows]
+    is_late = c2f_orders['is_late'][rows]
+    record_c2f_counts(wh_dict, c2f_orders['warehouses'][rows].astype(str),
+                      months, is_late)
+    record_c2f_counts(country_dict, c2f_orders['countries'][rows],
+                      months, is_late)
 
+    return wh_dict, wh_list, country_dict, country_list
+
+
+def empty_c2f_results(country_data_json, warehouse_config_data):
+    """
+    The C2F results with no order counted yet:
+    every configured warehouse and country, in config order
+    """
     # Prepare result dictionaries
     wh_dict = {}
     wh_list = []
@@ -40,95 +168,33 @@ def prepare_c2f_report(country_data_json, warehouse_config_data,
 
         country_dict.update({country: temp_dict})
 
-    for order, data in composite_dict.items():
-
-        if data["status"] != "clean":
-            continue
-
-        result = determine_late_or_ontime(order, data, country_data_json)
-
-        # Get the yyyy-mm dictionary key
-        invoice_date = result['invoice_date']
-        date_key = invoice_date[:7]
-
-        # Get order warehouse, taking into account the days the warehouses
-        # Were swapped
-        order_wh = get_order_warehouse(warehouse_config_data,
-                                       country_data_json,
-                                       datetime.fromisoformat(invoice_date),
-                                       data['country'])
-        # Get order country
-        country = data['country'].lower()
-
-        # Decide destination dict
-        if result['result'] == 'on time':
-            dest_dict = 'on_time_deliveries'
-        elif result['result'] == 'late':
-            dest_dict = 'late_deliveries'
-
-        # Update the warehouse dictionaries
-        if date_key in wh_dict[order_wh][dest_dict]:
-            wh_dict[order_wh][dest_dict][date_key] += 1
-        else:
-            wh_dict[order_wh][dest_dict].update({date_key: 1})
-
-        # Update the country dictionaries
-        if date_key in country_dict[country][dest_dict]:
-            country_dict[country][dest_dict][date_key] += 1
-        else:
-            country_dict[country][dest_dict].update({date_key: 1})
-
-    write_report_data(wh_dict, wh_list, country_dict, country_list)
-
-
-def determine_late_or_ontime(order, data,
-                             country_config_json):
-    return_dict = {}
-    return_dict.update({'invoice_date': ''})
-    return_dict.update({'result': ''})
-
-    # Get the ship_q method and country
-    ship_q = data['ship_q']
-    country = data['country'].lower()
-
-    # For each order, get the shipping date and latest status date
-    # Data is stored in datetime strings,
-    # but numpy requries iso strings, hence the weird conversion
-    invoice_date_datetime = datetime.fromisoformat(
-        data['invoice_datetime'])
-
-    # Included here to account for the American invoice date
-    time_zone_diff = daylight_savings_time_adjustment(
-        invoice_date_datetime, country)
-
-    invoice_date = (invoice_date_datetime + time_zone_diff)\
-        .date() \
-        .isoformat()
-
-    latest_status_date = datetime.fromisoformat(data['delivery_datetime'])\
-        .date() \
-        .isoformat()
-
-    # Get num of business days:
-    num_business_days = busday_count(invoice_date, latest_status_date)
-
-    # Get the needed sla
-    otd_days = country_config_json[country]['otd_days'][ship_q]
+    return wh_dict, wh_list, country_dict, country_list
 
-    # Assign results
-    if num_business_days <= (otd_days + 2):
-        return_dict['result'] = 'on time'
-    else:
-        return_dict['result'] = 'late'
 
-    return_dict['invoice_date'] = invoice_date
-
-    return return_dict
-
-
-def write_report_data(wh_dict, wh_list, country_dict, ctry_list):
+def record_c2f_counts(result_dict, names, months, is_late):
+    """
+    Group orders by name, on-time/late and yyyy-mm and add each group's
+    count to result_dict[name], in the order the groups are first seen
+    """
+    unique_names, name_codes = np.unique(names, return_inverse=True)
+    first_month = months.min()
+    month_span = int(months.max() - first_month + 1)
+    keys = (name_codes * 2 + is_late) * month_span + (months - first_month)
+
+    unique_keys, counts = first_seen_counts(keys)
+    for key, count in zip(unique_keys.tolist(), counts.tolist()):
+        group, month_offset = divmod(key, month_span)
+        code, late = divmod(group, 2)
+        date_key = str(np.datetime64(int(first_month) + month_offset, 'M'))
+        dest_dict = 'late_deliveries' if late else 'on_time_deliveries'
+        result_dict[str(unique_names[code])][dest_dict].update(
+            {date_key: count})
+
+
+def write_report_data(wh_dict, wh_list, country_dict, ctry_list,
+                      output_dir=REPORT_DIR):
     # Write out warheouse report data
-    with open(Path('./aop_report/Completed Reports/c2f wh report.csv'),
+    with open(Path(output_dir) / 'c2f wh report.csv',
               mode='w') as report_file:
         report_file.write("On time deliveries per month: \n")
 
@@ -146,7 +212,7 @@ def write_report_data(wh_dict, wh_list, country_dict, ctry_list):
         report_file.write("\n")
 
     # Write out country report data
-    with open(Path('./aop_report/Completed Reports/c2f country report.csv'),
+    with open(Path(output_dir) / 'c2f country report.csv',
               mode='w') as report_file:
         report_file.write("On time deliveries per month: \n")
 
@@ -164,20 +230,22 @@ def write_report_data(wh_dict, wh_list, country_dict, ctry_list):
         report_file.write("\n")
 
 
-def daylight_savings_time_adjustment(date_time, country):
+def daylight_savings_time_adjustments(date_times, countries):
     """
-    Apply daylight savings to report data
+    Apply daylight savings to report data, for whole columns:
+    a datetime64 array and the matching array of lower case countries.
+    Returns a timedelta64[s] array
     """
-    eu_tz_name = "Europe/Warsaw"
-    if country == 'uk':
-        eu_tz_name = "Europe/London"
-    eu_tz = ZoneInfo(eu_tz_name)
-    us_tz = ZoneInfo("America/Denver")
+    us_offsets = offset_table(US_TIMEZONE).local_offsets(date_times)
+    eu_offsets = np.where(
+        countries == 'uk',
+        offset_table(eu_timezone_name('uk')).local_offsets(date_times),
+        offset_table(eu_timezone_name('')).local_offsets(date_times))
 
-    dt_aware_eu = date_time.replace(tzinfo=eu_tz)
-    dt_aware_us = date_time.replace(tzinfo=us_tz)
+    return np.abs(eu_offsets - us_offsets).astype('timedelta64[s]')
 
-    offset_eu = dt_aware_eu.utcoffset()
-    offset_us = dt_aware_us.utcoffset()
 
-    return abs(offset_eu - offset_us)
+def eu_timezone_name(country):
+    if country == 'uk':
+        return "Europe/London"
+    return "Europe/Warsaw"
@@ -1,11 +1,22 @@
 from pathlib import Path
 import json
-import datetime as dt
-from numpy import busday_offset
-from helper_functions import get_order_warehouse
+import numpy as np
+from helper_functions import WarehouseRouter, first_seen_counts, REPORT_DIR
+from business_calendar import load_calendar_registry
+from order_store import as_order_store
 
+# Orders imported after the cutoff on a Friday get an extra day
+CUTOFF_SECOND = 17 * 3600
+FRIDAY = 4
 
-def prepare_dwell_time_report(composite_dictionary, country_data):
+# Status messages, indexed by receipt code * 2 + is_late
+RECEIPT_PREFIXES = ("", "received on weekend: ", "received on holiday: ")
+STATUS_MESSAGES = tuple(prefix + result for prefix in RECEIPT_PREFIXES
+                        for result in ("shipped on time", "shipped late"))
+
+
+def prepare_dwell_time_report(composite_dictionary, country_data,
+                              calendars=None):
     """
     Input:
     Output: A text file with what percent of orders are processed on time.
@@ -13,6 +24,9 @@ def prepare_dwell_time_report(composite_dictionary, country_data):
     Logic:
     On time is one day, and out before the end of the next
     accounting for some holidays and a few exceptional date swaps.
+
+    Orders are handled in one batch, with one busday_offset call
+    per warehouse calendar.
     """
 
     # Read in wh dict
@@ -20,56 +34,132 @@ def prepare_dwell_time_report(composite_dictionary, country_data):
               mode="r") as json_file:
         wh_config_data = json.load(json_file)
 
-    summary_dict = {}
-    order_dict = {}
+    if calendars is None:
+        calendars = load_calendar_registry()
 
-    # Constants
-    # Cutoff time is in LOCAL time
-    # If we add a cutoff time:
-    # time.fromisoformat(country_data_dict['universal_cutoff_time'])
-
-    # Calculate a status add it to the count dictionary
-    # Keys: yyyy-mm and status key
-    for order, data in composite_dictionary.items():
-        country = data['country'].lower()
-        import_datetime = dt.datetime.fromisoformat(data['import_datetime'])
-        import_datetime = import_datetime.replace(tzinfo=None)
-
-        warehouse = get_order_warehouse(wh_config_data, country_data,
-                                        import_datetime, country)
-
-        ship_datetime = dt.datetime.fromisoformat(data['ship_datetime'])
-
-        # Begin status message construction
-        status_message = ""
-
-        # Set holidays
-        holidays = []
-        holidays += wh_config_data['holidays']['all']
-        holidays += wh_config_data['holidays'][warehouse]
-
-        # Set early, on-time, or late string:
-        # used in status message where order is not shipped the same day,
-        # or where order was received on holiday/weekend
-        early_on_late_string = get_early_on_late_string(import_datetime,
-                                                        ship_datetime,
-                                                        holidays)
-
-        # Check if the order was received on a holiday or weekend
-        # If so,  append message:
-        if import_datetime.date() in holidays\
-           or import_datetime.date().isoweekday() > 5:
-            if import_datetime.date() in holidays:
-                status_message += "received on holiday: "
-            elif import_datetime.date().isoweekday() > 5:
-                status_message += "received on weekend: "
-
-        status_message += early_on_late_string
-        record_status(status_message, import_datetime,
-                      summary_dict, order, warehouse, order_dict)
+    write_dwell_report(*compute_dwell_report(
+        country_data, wh_config_data, composite_dictionary, calendars))
+
+
+def compute_dwell_report(country_data, wh_config_data, composite_dictionary,
+                         calendars):
+    """
+    The dwell time counts and every order's status.
+    Returns (summary_dict, order_dict)
+    """
+    orders = as_order_store(composite_dictionary)
+    dwell_orders = classify_dwell_orders(country_data, wh_config_data,
+                                         orders, calendars)
+    return summarize_dwell_orders(dwell_orders, np.arange(len(orders)))
 
+
+def classify_dwell_orders(country_data, wh_config_data, orders, calendars):
+    """
+    Work out every order's dwell time status once. Returns a dict of
+    columns, one value per order in the store:
+        order_numbers, warehouses,
+        months          import month, as datetime64[M] integers
+        status_codes    index into STATUS_MESSAGES
+    summarize_dwell_orders then counts any selection of these orders.
+
+    An order is on time if shipped by the next business day of its
+    warehouse after it was imported, or the one after that for orders
+    imported on a Friday after 17:00 or on a weekend.
+    Orders imported on a weekend are marked as such. Receipts on a
+    warehouse holiday are only marked when warehouses.json sets
+    "flag_holiday_receipts": true
+    """
+    import_datetimes = orders.datetimes('import_datetime')
+    import_days = import_datetimes.astype('datetime64[D]')
+    ship_days = orders.dates('ship_datetime')
+
+    day_numbers = import_days.astype(np.int64)
+    # 1970-01-01 was a Thursday
+    weekdays = (day_numbers + 3) % 7
+    seconds_of_day = import_datetimes.astype(np.int64) - day_numbers * 86400
+    is_weekend = weekdays >= 5
+    offsets = np.where(
+        is_weekend | ((weekdays == FRIDAY) & (seconds_of_day > CUTOFF_SECOND)),
+        2, 1)
+
+    router = WarehouseRouter(wh_config_data, country_data)
+    warehouses = router.resolve_array(orders.values('country'),
+                                      import_datetimes)
+
+    # One business day offset per warehouse calendar
+    next_business_days = np.empty(len(orders), dtype='datetime64[D]')
+    receipt_codes = is_weekend.astype(np.int64)
+    flag_holiday_receipts = wh_config_data.get('flag_holiday_receipts',
+                                               False)
+    for warehouse in dict.fromkeys(warehouses.tolist()):
+        in_warehouse = warehouses == warehouse
+        next_business_days[in_warehouse] = calendars.offset(
+            import_days[in_warehouse], offsets[in_warehouse], 'forward',
+            warehouse=warehouse)
+        if flag_holiday_receipts:
+            holidays = np.array(calendars.holidays(warehouse=warehouse),
+                                dtype='datetime64[D]')
+            is_holiday = np.isin(import_days[in_warehouse], holidays)
+            receipt_codes[np.flatnonzero(in_warehouse)[is_holiday]] = 2
+
+    is_late = ~(ship_days <= next_business_days)
+
+    return {
+        'order_numbers': orders.order_numbers,
+        'warehouses': warehouses,
+        'months': import_days.astype('datetime64[M]').astype(np.int64),
+        'status_codes': receipt_codes * 2 + is_late
+    }
+
+
+def summarize_dwell_orders(dwell_orders, rows):
+    """
+    Count the classified orders at the given row positions, in that order.
+    Returns (summary_dict, order_dict):
+        summary_dict    {warehouse: {'yyyy - m': {status message: count}}}
+        order_dict      {order number: status message}
+    """
+    summary_dict = {}
+    order_dict = {}
+    if len(rows) == 0:
+        return summary_dict, order_dict
+
+    warehouse_names, warehouse_codes = np.unique(
+        dwell_orders['warehouses'][rows].astype(str), return_inverse=True)
+    months = dwell_orders['months'][rows]
+    status_codes = dwell_orders['status_codes'][rows]
+
+    first_month = months.min()
+    month_span = int(months.max() - first_month + 1)
+    keys = (warehouse_codes * month_span + (months - first_month)) * \
+        len(STATUS_MESSAGES) + status_codes
+
+    unique_keys, counts = first_seen_counts(keys)
+    for key, count in zip(unique_keys.tolist(), counts.tolist()):
+        group, status_code = divmod(key, len(STATUS_MESSAGES))
+        code, month_offset = divmod(group, month_span)
+        warehouse = str(warehouse_names[code])
+        month = int(first_month) + month_offset
+        date_key = f'{month // 12 + 1970} - {month % 12 + 1}'
+
+        if warehouse not in summary_dict:
+            summary_dict.update({warehouse: {}})
+        if date_key not in summary_dict[warehouse]:
+            summary_dict[warehouse].update({date_key: {}})
+        summary_dict[warehouse][date_key].update(
+            {STATUS_MESSAGES[status_code]: count})
+
+    order_numbers = dwell_orders['order_numbers'][rows].tolist()
+    for order_num, status_code in zip(order_numbers, status_codes.tolist()):
+        if order_num not in order_dict:
+            order_dict.update({order_num: STATUS_MESSAGES[status_code]})
+
+    return summary_dict, order_dict
+
+
+def write_dwell_report(summary_dict, order_dict, output_dir=REPORT_DIR):
     # Write results to files
-    with open(Path('./aop_report/Completed Reports/Dwell Time Report.csv'),
+    with open(Path(output_dir) / 'Dwell Time Report.csv',
               mode="w", encoding="utf-8-sig", newline="") as results_file:
         results_file.write("facility,time,status,count\n")
         for facility, date_stamps in summary_dict.items():
@@ -79,60 +169,7 @@ def prepare_dwell_time_report(composite_dictionary, country_data):
                                        f"{message},{count}\n")
 
     # Write order breakdown
-    with open(Path('./aop_report/Completed Reports/'
-                   'Dwell Time Order Details.txt'), mode="w")\
-         as order_details_file:
+    with open(Path(output_dir) / 'Dwell Time Order Details.txt',
+              mode="w") as order_details_file:
         for order, status in order_dict.items():
             order_details_file.write(f"{order}: {status}\n")
-
-
-def record_status(status_message, import_datetime, summary_dict,
-                  order_num, order_warehouse, order_dict):
-    """
-    Record the status of an order in the summary_dict
-    """
-
-    if order_warehouse not in summary_dict:
-        summary_dict.update({order_warehouse: {}})
-
-    date_key = f'{import_datetime.year} - {import_datetime.month}'
-
-    if date_key not in summary_dict[order_warehouse]:
-        summary_dict[order_warehouse].update({date_key: {}})
-
-    if status_message not in summary_dict[order_warehouse][date_key]:
-        summary_dict[order_warehouse][date_key].update({status_message: 1})
-    else:
-        summary_dict[order_warehouse][date_key][status_message] += 1
-
-    if order_num not in order_dict:
-        order_dict.update({order_num: status_message})
-
-
-def get_early_on_late_string(import_datetime,
-                             ship_datetime, holidays):
-    """
-    Take in a workday and list of holidays to provide a date object that
-    represents the next day that package should be shipped
-    """
-
-    CUTOFF_TIME = dt.time(17, 0)
-    import_day = import_datetime.date()
-    import_time = import_datetime.time()
-
-    bus_day_offset = 1
-    if import_time > CUTOFF_TIME and import_day.weekday() == 4:
-        bus_day_offset = 2
-
-    if import_day.weekday() == 5 or import_day.weekday() == 6:
-        bus_day_offset = 2
-
-    next_business_day = dt.date.fromisoformat(
-        str(busday_offset(import_day.isoformat(), bus_day_offset, 'forward',
-                          holidays=holidays)))
-
-    ship_date = ship_datetime.date()
-    if ship_date <= next_business_day:
-        return "shipped on time"
-    if ship_date > next_business_day:
-        return "shipped late"
@@ -1,11 +1,15 @@
 from pathlib import Path
-import json
-import datetime as dt
-from numpy import busday_count
+import numpy as np
 import csv
+from helper_functions import first_seen_counts, REPORT_DIR
+from order_store import as_order_store
+from business_calendar import load_calendar_registry
 
+LATE_ORDER_FIELDS = ("order_number", "country", "paige_day",
+                     "shipping_date", "latest_status_date")
 
-def prepare_otd_report(country_config, composite_dict):
+
+def prepare_otd_report(country_config, composite_dict, calendars=None):
     '''
     Input: json objects with each warehouse's data
     Output: A text file with what percent of orders are on-time
@@ -15,86 +19,129 @@ def prepare_otd_report(country_config, composite_dict):
     Ontime is defined as when the valid delivery date (i.e. no returned status)
     the shipping date is equal to or lower than the 'on-time threshold'
     as provided in the config file.
+
+    Orders are handled in one batch: dates are pulled into numpy arrays,
+    business days are counted with one busday_count call per country and
+    the monthly counts are built by grouping those arrays.
     '''
 
-    with open(Path("./Shared Config Files/holidays.json"),
-              "r", newline='', encoding="utf-8-sig") as f:
-        holiday_data = json.load(f)
+    if calendars is None:
+        calendars = load_calendar_registry()
+
+    otd_report_data, late_order_data = compute_otd_report(
+        country_config, composite_dict, calendars)
+    write_otd_report(otd_report_data, late_order_data)
+
+
+def compute_otd_report(country_config, composite_dict, calendars):
+    """
+    The monthly on time and late counts per country, and the late orders.
+    Returns (otd_report_data, late_order_data)
+    """
+    orders = as_order_store(composite_dict)
+    otd_orders = classify_otd_orders(country_config, orders, calendars)
+    return summarize_otd_orders(otd_orders, np.arange(len(orders)))
+
+
+def classify_otd_orders(country_config, orders, calendars):
+    """
+    Work out every order's OTD result once. Returns a dict of columns,
+    one value per order in the store:
+        measured            False for wh_data_only and unknown ship_q orders
+        num_business_days   shipping to latest status, 0 if not measured
+        otd_days            the order's deadline in days, None if not measured
+    plus its order number, lower case country and the two dates.
+    summarize_otd_orders then counts any selection of these orders
+    """
+    # wh_data_only orders have no transit data to measure
+    candidates = np.flatnonzero(orders.values('status') != "wh_data_only")
+
+    # Get the ship_q method and country
+    ship_qs = orders.values('ship_q')[candidates]
+    countries = np.char.lower(orders.values('country'))
+
+    # Get the needed on time delivery deadline day
+    otd_day_list = lookup_otd_days(country_config, countries[candidates],
+                                   ship_qs)
+    has_otd_days = np.array([days is not None for days in otd_day_list],
+                            dtype=bool)
+    for index in np.flatnonzero(~has_otd_days):
+        print(f"Missing {ship_qs[index]} from "
+              f"{countries[candidates][index]} config!")
+
+    selected = candidates[has_otd_days]
+    measured = np.zeros(len(orders), dtype=bool)
+    measured[selected] = True
+    otd_days = [None] * len(orders)
+    for index, days in zip(candidates.tolist(), otd_day_list):
+        otd_days[index] = days
+
+    shipping_dates = orders.dates('ship_datetime')
+    latest_status_dates = orders.dates('delivery_datetime')
+
+    # Check num of business days, one call per country holiday calendar
+    num_business_days = np.zeros(len(orders), dtype=np.int64)
+    country_names, country_codes = np.unique(countries[selected],
+                                             return_inverse=True)
+    for code, country in enumerate(country_names):
+        in_country = selected[country_codes == code]
+        num_business_days[in_country] = calendars.count(
+            shipping_dates[in_country], latest_status_dates[in_country],
+            country=str(country))
+
+    return {
+        'order_numbers': orders.order_numbers,
+        'countries': countries,
+        'measured': measured,
+        'otd_days': otd_days,
+        'shipping_dates': shipping_dates,
+        'latest_status_dates': latest_status_dates,
+        'num_business_days': num_business_days
+    }
+
 
+def summarize_otd_orders(otd_orders, rows):
+    """
+    Count the classified orders at the given row positions, in that order.
+    Returns (otd_report_data, late_order_data)
+    """
     otd_report_data = {}
     otd_report_data.update({'country_data': {}})
+    otd_report_data.update({'bad_wh_data': []})
+
+    rows = rows[otd_orders['measured'][rows]]
+    order_numbers = otd_orders['order_numbers'][rows]
+    countries = otd_orders['countries'][rows]
+    shipping_dates = otd_orders['shipping_dates'][rows]
+    latest_status_dates = otd_orders['latest_status_dates'][rows]
+    num_business_days = otd_orders['num_business_days'][rows]
+    otd_day_list = [otd_orders['otd_days'][row] for row in rows.tolist()]
+    otd_days = np.array(otd_day_list)
+
+    # Negative business days mean the data is wonky.
+    is_valid = num_business_days >= 0
+    for index in np.flatnonzero(~is_valid):
+        otd_report_data['bad_wh_data'].append(order_numbers[index])
+
+    # Final sorting:
+    is_late = num_business_days > otd_days
+    country_names, country_codes = np.unique(countries, return_inverse=True)
+    record_otd_counts(otd_report_data, country_names, country_codes[is_valid],
+                      shipping_dates[is_valid], is_late[is_valid])
 
     late_order_data = []
+    for index in np.flatnonzero(is_valid & is_late):
+        update_late_order_data(order_numbers[index], countries[index],
+                               otd_day_list[index], shipping_dates[index],
+                               latest_status_dates[index], late_order_data)
 
-    for order, data in composite_dict.items():
-
-        if data['status'] == "wh_data_only":
-            continue
-
-        # Get the ship_q method and country
-        ship_q = data['ship_q']
-        country = data['country'].lower()
-
-        # Get the needed on time delivery deadline day
-        if ship_q not in country_config[country]['otd_days']:
-            print(f"Missing {ship_q} from {country} config!")
-            continue
-
-        otd_days = country_config[country]['otd_days'][ship_q]
-
-        # Get holidays
-        current_holidays = []
-        for holiday in holiday_data["all"]:
-            current_holidays.append(holiday)
-        if country in holiday_data:
-            current_holidays.extend(holiday_data[country])
-
-        # For each order, get the shipping date and latest status date
-        # Data is stored in datetime strings, but numpy requries iso strings
-        # hence the weird conversion
-        shipping_date = dt.datetime\
-                          .fromisoformat(data['ship_datetime'])\
-                          .date()\
-                          .isoformat()
-        latest_status_date = dt.datetime\
-                               .fromisoformat(data['delivery_datetime'])\
-                               .date()\
-                               .isoformat()
-
-        # Check num of business days:
-        num_business_days = busday_count(shipping_date, latest_status_date,
-                                         holidays=current_holidays)
-
-        # Negative business days mean the data is wonky.
-        if num_business_days < 0:
-            otd_report_data['bad_wh_data'].append(order)
-            continue
-
-        # If an order gets through ALL THAT... get the yyyy-mm dictionary key
-        date_key = shipping_date[:7]
-
-        # Final sorting:
-        if num_business_days <= otd_days:
-            dest_dict = 'on_time_deliveries'
-        else:
-            dest_dict = 'late_deliveries'
-            update_late_order_data(order, data, otd_days, late_order_data)
-
-        if country not in otd_report_data['country_data']:
-            temp_dict = {}
-            temp_dict.update({'on_time_deliveries': {}})
-            temp_dict.update({'late_deliveries': {}})
-
-            otd_report_data['country_data'].update({country: temp_dict})
+    return otd_report_data, late_order_data
 
-        if date_key in otd_report_data['country_data'][country][dest_dict]:
-            otd_report_data['country_data'][country][dest_dict][date_key] += 1
-        else:
-            otd_report_data['country_data'][country][dest_dict]\
-                .update({date_key: 1})
 
+def write_otd_report(otd_report_data, late_order_data,
+                     output_dir=REPORT_DIR):
     # Write out report data
-    with open(Path('./aop_report/Completed Reports/OTD Report.csv'),
+    with open(Path(output_dir) / 'OTD Report.csv',
               mode='w') as report_file:
         # Write main data in csv format:
         report_file.write('Late deliveries per month\n')
@@ -111,38 +158,81 @@ def prepare_otd_report(country_config, composite_dict):
                 report_file.write(f'{country},{str(month)},{str(value)}\n')
         report_file.write('\n')
 
-    export_late_data(late_order_data)
+    export_late_data(late_order_data, output_dir)
+
+
+def lookup_otd_days(country_config, countries, ship_qs):
+    """
+    Look up otd_days for each order's country and ship_q.
+    Returns one value per order, None where the country has no such ship_q
+    """
+    pairs = np.char.add(np.char.add(countries, "|"), ship_qs)
+    _, first_index, pair_codes = np.unique(pairs, return_index=True,
+                                           return_inverse=True)
+    pair_days = []
+    for index in first_index.tolist():
+        country_days = country_config[str(countries[index])]['otd_days']
+        pair_days.append(country_days.get(str(ship_qs[index])))
+    return [pair_days[code] for code in pair_codes.tolist()]
+
+
+def record_otd_counts(otd_report_data, country_names, country_codes,
+                      shipping_dates, is_late):
+    """
+    Group orders by country, on-time/late and the yyyy-mm of the shipping date
+    and add each group's count to otd_report_data['country_data']
+    """
+    if len(shipping_dates) == 0:
+        return
+
+    months = shipping_dates.astype('datetime64[M]').astype(np.int64)
+    first_month = months.min()
+    month_span = months.max() - first_month + 1
+    keys = (country_codes * 2 + is_late) * month_span + (months - first_month)
+
+    unique_keys, counts = first_seen_counts(keys)
+    for key, count in zip(unique_keys.tolist(), counts.tolist()):
+        group, month_offset = divmod(key, int(month_span))
+        code, late = divmod(group, 2)
+        country = str(country_names[code])
+        date_key = str(np.datetime64(int(first_month) + month_offset, 'M'))
+        dest_dict = 'late_deliveries' if late else 'on_time_deliveries'
+
+        if country not in otd_report_data['country_data']:
+            temp_dict = {}
+            temp_dict.update({'on_time_deliveries': {}})
+            temp_dict.update({'late_deliveries': {}})
+
+            otd_report_data['country_data'].update({country: temp_dict})
 
+        if date_key in otd_report_data['country_data'][country][dest_dict]:
+            otd_report_data['country_data'][country][dest_dict][date_key] += \
+                count
+        else:
+            otd_report_data['country_data'][country][dest_dict]\
+                .update({date_key: count})
 
-def update_late_order_data(order, data, paige_day_arg, late_order_data):
+
+def update_late_order_data(order, country, paige_day_arg, shipping_date,
+                           latest_status_date, late_order_data):
     # Late order: order_number, country, ship_date,
     #            delivery_date, paige_day
 
     temp_obj = {
         "order_number": order,
-        "country": data['country'].lower(),
+        "country": country,
         "paige_day": paige_day_arg,
-
-        "shipping_date": dt.datetime
-        .fromisoformat(data['ship_datetime'])
-        .date()
-        .isoformat(),
-
-        "latest_status_date": dt.datetime
-        .fromisoformat(data['delivery_datetime'])
-        .date()
-        .isoformat()
+        "shipping_date": shipping_date.item().isoformat(),
+        "latest_status_date": latest_status_date.item().isoformat()
     }
     late_order_data.append(temp_obj)
 
 
-def export_late_data(late_order_data):
-    p = Path("./aop_report/Completed Reports/Late Order Data.csv")
+def export_late_data(late_order_data, output_dir=REPORT_DIR):
+    p = Path(output_dir) / "Late Order Data.csv"
     with open(p, mode="w", encoding="utf-8-sig", newline='') as f:
-        iterator = iter(late_order_data)
-        curr_record = next(iterator)
-        writer = csv.DictWriter(f, fieldnames=curr_record.keys())
+        # Just the header when no order was late
+        writer = csv.DictWriter(f, fieldnames=LATE_ORDER_FIELDS)
         writer.writeheader()
-        writer.writerow(curr_record)
-        for record in iterator:
+        for record in late_order_data:
             writer.writerow(record)
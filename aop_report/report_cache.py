@@ -0,0 +1,192 @@
+"""
+Report results per month file, kept between runs so months whose orders
+have not changed are not worked out again.
+
+Each month file gets one entry in REPORT_CACHE_DIR holding, for every
+report it was prepared for, the results of all of the month's clean
+orders in the form the summarize_* functions return them. An entry is only
+used while the month file and the config files the reports read
+(CONFIG_FILES) hash the same as when it was written, and only for a date
+range holding every dated order of the month.
+
+Results of several months are merged in month order, which gives the same
+reports as summarizing the orders of those months together: counts are
+added, and groups and late orders keep the order they are first met in.
+"""
+from pathlib import Path
+import hashlib
+import json
+import os
+from prepare_c2f_report import empty_c2f_results
+
+REPORT_CACHE_DIR = Path("./Program Data/report_cache")
+# Raise this when a report changes what it counts,
+# so every entry written before is ignored
+CACHE_VERSION = 1
+CONFIG_FILES = ("countries.json", "warehouses.json", "holidays.json")
+
+
+def file_hash(path, digest=None):
+    """
+    sha256 of a file's bytes, added to digest when given
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    with open(path, mode="rb") as hashed_file:
+        for block in iter(lambda: hashed_file.read(2 ** 20), b""):
+            digest.update(block)
+    return digest
+
+
+class ReportCache:
+    """
+    The cached report results of each month file
+    """
+
+    def __init__(self, config_dir="./Shared Config Files",
+                 cache_dir=REPORT_CACHE_DIR):
+        digest = hashlib.sha256(f"version {CACHE_VERSION}".encode("ascii"))
+        for name in CONFIG_FILES:
+            file_hash(Path(config_dir) / name, digest)
+        self.config_hash = digest.hexdigest()
+        self.cache_dir = Path(cache_dir)
+        self.month_hashes = {}
+
+    def entry_path(self, month_path):
+        return self.cache_dir / Path(month_path).name
+
+    def read(self, month_path):
+        """
+        The month file's entry, or None if it has none or it is out of date.
+        The month file is hashed here, and write uses that hash, so the
+        results written are those of the file as it was read
+        """
+        month_hash = file_hash(month_path).hexdigest()
+        self.month_hashes.update({str(month_path): month_hash})
+        return self.read_entry(month_path, month_hash)
+
+    def write(self, month_path, order_numbers, timestamps, reports):
+        """
+        Write the month file's entry:
+            order_numbers   its clean orders, in file order
+            timestamps      their order_timestamp values, None if undated
+            reports         {report name: cached_results(...)}
+        Reports cached for the same file and config before are kept
+        """
+        month_hash = self.month_hashes.get(str(month_path))
+        if month_hash is None:
+            month_hash = file_hash(month_path).hexdigest()
+
+        previous = self.read_entry(month_path, month_hash)
+        if previous is not None:
+            previous["reports"].update(reports)
+            reports = previous["reports"]
+
+        dated = [timestamp for timestamp in timestamps
+                 if timestamp is not None]
+        entry = {
+            "month_hash": month_hash,
+            "config_hash": self.config_hash,
+            "first_timestamp": min(dated) if dated else None,
+            "last_timestamp": max(dated) if dated else None,
+            "order_numbers": list(order_numbers),
+            "reports": reports
+        }
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        entry_path = self.entry_path(month_path)
+        temp_path = entry_path.with_suffix(".tmp")
+        with open(temp_path, mode="w", encoding="utf-8") as entry_f:
+            json.dump(entry, entry_f)
+        os.replace(temp_path, entry_path)
+
+    def read_entry(self, month_path, month_hash):
+        """
+        The entry written for this month file content and config, if any
+        """
+        entry_path = self.entry_path(month_path)
+        if not entry_path.is_file():
+            return None
+        try:
+            with open(entry_path, mode="r", encoding="utf-8") as entry_f:
+                entry = json.load(entry_f)
+        except ValueError:
+            return None
+        if entry.get("month_hash") != month_hash or \
+           entry.get("config_hash") != self.config_hash:
+            return None
+        return entry
+
+
+def covers_month(first_timestamp, last_timestamp, start, end):
+    """
+    Whether [start, end), in whole seconds, holds every dated order of a
+    month whose order_timestamp values run from first to last
+    """
+    if first_timestamp is None:
+        return True
+    return start <= first_timestamp and last_timestamp < end
+
+
+def cached_results(report_name, results):
+    """
+    A report's summarize_* results in the form they are cached and merged.
+    The C2F lists of warehouses and countries come from config, so are
+    left out
+    """
+    if report_name == "c2f":
+        wh_dict, _, country_dict, _ = results
+        return [wh_dict, country_dict]
+    return list(results)
+
+
+def merge_results(report_name, month_results, country_config_data,
+                  warehouse_config_data):
+    """
+    Merge months' cached_results, in month order, into the arguments
+    the report's writer takes
+    """
+    if report_name == "otd":
+        otd_report_data = {}
+        otd_report_data.update({'country_data': {}})
+        otd_report_data.update({'bad_wh_data': []})
+        late_order_data = []
+        for month_report_data, month_late_orders in month_results:
+            add_counts(otd_report_data['country_data'],
+                       month_report_data['country_data'])
+            otd_report_data['bad_wh_data'] += month_report_data['bad_wh_data']
+            late_order_data += month_late_orders
+        return otd_report_data, late_order_data
+
+    if report_name == "dwell":
+        summary_dict = {}
+        order_dict = {}
+        for month_summary, month_orders in month_results:
+            add_counts(summary_dict, month_summary)
+            for order_num, status in month_orders.items():
+                if order_num not in order_dict:
+                    order_dict.update({order_num: status})
+        return summary_dict, order_dict
+
+    wh_dict, wh_list, country_dict, country_list = empty_c2f_results(
+        country_config_data, warehouse_config_data)
+    for month_wh_dict, month_country_dict in month_results:
+        add_counts(wh_dict, month_wh_dict)
+        add_counts(country_dict, month_country_dict)
+    return wh_dict, wh_list, country_dict, country_list
+
+
+def add_counts(total, counts):
+    """
+    Add nested {key: ... {key: count}} counts into total.
+    Keys total does not have yet are added after the ones it has
+    """
+    for key, value in counts.items():
+        if isinstance(value, dict):
+            if key not in total:
+                total.update({key: {}})
+            add_counts(total[key], value)
+        elif key in total:
+            total[key] += value
+        else:
+            total.update({key: value})
@@ -0,0 +1,419 @@
+from pathlib import Path
+import datetime as dt
+import json
+import sys
+import numpy as np
+from helper_functions import REPORT_DIR
+from business_calendar import load_calendar_registry
+from order_store import as_order_store, OrderStore
+from prepare_otd_report import compute_otd_report, write_otd_report, \
+    classify_otd_orders, summarize_otd_orders
+from prepare_dwell_time_report import compute_dwell_report, \
+    write_dwell_report, classify_dwell_orders, summarize_dwell_orders
+from prepare_c2f_report import compute_c2f_report, write_report_data, \
+    classify_c2f_orders, summarize_c2f_orders
+from report_cache import ReportCache, covers_month, cached_results, \
+    merge_results
+from instrumentation import span
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Data Handling"))
+from load_program_data import (  # noqa: E402
+    read_program_data, combine_clean_data, month_file_names, MONTH_DIR)
+from month_index import MonthCache, order_timestamp  # noqa: E402
+
+REPORT_NAMES = ("otd", "dwell", "c2f")
+
+
+def run_reports(report_names, country_config_data, warehouse_config_data,
+                composite_dictionary, calendars, output_dir=REPORT_DIR):
+    """
+    Prepare several aop reports from one read of the order data.
+
+    The orders are held once as an OrderStore, whose datetime columns
+    are parsed a single time and shared by all reports, and each report is
+    computed on whole columns. Reports are only written once all are
+    computed.
+    """
+    orders = as_order_store(composite_dictionary)
+
+    otd_results = None
+    if "otd" in report_names:
+        print("Preparing OTD Report")
+        with span("otd_report", rows=len(orders)):
+            otd_results = compute_otd_report(country_config_data, orders,
+                                             calendars)
+
+    dwell_results = None
+    if "dwell" in report_names:
+        print("Preparing Dwell Time Report")
+        with span("dwell_report", rows=len(orders)):
+            dwell_results = compute_dwell_report(
+                country_config_data, warehouse_config_data, orders,
+                calendars)
+
+    c2f_results = None
+    if "c2f" in report_names:
+        print("Preparing C2F Report")
+        with span("c2f_report", rows=len(orders)):
+            c2f_results = compute_c2f_report(
+                country_config_data, warehouse_config_data, orders,
+                calendars)
+
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    if otd_results is not None:
+        with span("write otd_report"):
+            write_otd_report(*otd_results, output_dir)
+    if dwell_results is not None:
+        with span("write dwell_report"):
+            write_dwell_report(*dwell_results, output_dir)
+    if c2f_results is not None:
+        with span("write c2f_report"):
+            write_report_data(*c2f_results, output_dir)
+
+
+def read_report_configs(config_dir="./Shared Config Files"):
+    """
+    Read countries.json and warehouses.json
+    """
+    with open(Path(config_dir) / 'countries.json', mode="r",
+              encoding="utf-8-sig") as json_file:
+        country_config_data = json.load(json_file)
+
+    with open(Path(config_dir) / 'warehouses.json', mode="r",
+              encoding="utf-8-sig") as json_file:
+        warehouse_config_data = json.load(json_file)
+
+    return country_config_data, warehouse_config_data
+
+
+class ReportJobRunner:
+    """
+    Runs report jobs, each a date range and a list of reports, without
+    asking the user anything.
+    Config files and calendars are read once, and each month file is read
+    the first time a job needs it and then kept for the jobs after it.
+
+    With use_cache, each month's results are kept in a report_cache.
+    ReportCache, and a later run takes them from there for months whose
+    file and config are unchanged instead of reading the month again.
+    """
+
+    def __init__(self, config_dir="./Shared Config Files", use_cache=False):
+        self.country_config_data, self.warehouse_config_data = \
+            read_report_configs(config_dir)
+        self.calendars = load_calendar_registry(config_dir)
+        self.month_cache = MonthCache()
+        self.report_cache = None
+        if use_cache:
+            self.report_cache = ReportCache(config_dir)
+
+    def run(self, start_dt, end_dt, report_names, output_dir=REPORT_DIR):
+        """
+        Prepare the reports for orders imported in [start_dt, end_dt)
+        """
+        if self.report_cache is not None:
+            self.run_many([(start_dt, end_dt, report_names, output_dir)])
+            return
+
+        print(f"\nReports for {start_dt.date()} to {end_dt.date()}")
+        with span("read_program_data") as stage:
+            raw_program_data = read_program_data(start_dt, end_dt,
+                                                 self.month_cache)
+            orders = OrderStore.from_dict(
+                combine_clean_data(raw_program_data))
+            stage.rows = len(orders)
+        run_reports(report_names, self.country_config_data,
+                    self.warehouse_config_data, orders, self.calendars,
+                    output_dir)
+
+    def run_many(self, jobs):
+        """
+        Run a list of (start_dt, end_dt, report_names, output_dir) jobs
+        from one load, e.g. every month, every quarter and year to date.
+
+        The months any job needs are read once, and each order in them is
+        classified once by every report any job asks for. Each job then
+        only counts the results of the orders in its own range, in the
+        same order a load of just that range would give them.
+
+        With the report cache, a job takes the results of a month from
+        the cache when its range holds the whole month, and months no job
+        needs to read are not loaded at all. Months that are read have
+        their results cached for the next run.
+        """
+        if len(jobs) == 0:
+            return
+
+        first_dt = min(start_dt for start_dt, _, _, _ in jobs)
+        last_dt = max(end_dt for _, end_dt, _, _ in jobs)
+        job_months = [set(month_file_names(start_dt, end_dt))
+                      for start_dt, end_dt, _, _ in jobs]
+        needed_months = set().union(*job_months)
+        job_ranges = [(epoch_seconds(start_dt), epoch_seconds(end_dt))
+                      for start_dt, end_dt, _, _ in jobs]
+        wanted = set().union(*(report_names for _, _, report_names, _
+                               in jobs))
+
+        month_paths = {}
+        for month_file in month_file_names(first_dt, last_dt):
+            if month_file not in needed_months:
+                continue
+            month_path = Path(MONTH_DIR + month_file)
+            if not month_path.is_file():
+                print(f"Warning! Missing file: {month_path.name}. "
+                      "Skipping.")
+                continue
+            month_paths.update({month_file: month_path})
+
+        # The cached months each job can use
+        cached = {}
+        job_cached = [set() for _ in jobs]
+        if self.report_cache is not None:
+            with span("read report_cache"):
+                for month_file, month_path in month_paths.items():
+                    entry = self.report_cache.read(month_path)
+                    if entry is None:
+                        continue
+                    cached.update({month_file: entry})
+                    for (_, _, report_names, _), months, (start, end), \
+                            cached_months in zip(jobs, job_months,
+                                                 job_ranges, job_cached):
+                        if month_file in months and \
+                           all(name in entry["reports"]
+                               for name in report_names) and \
+                           covers_month(entry["first_timestamp"],
+                                        entry["last_timestamp"],
+                                        start, end):
+                            cached_months.add(month_file)
+
+        # Whole month files are read when caching, for their entries.
+        # Each job still only counts the orders in its own range
+        if self.report_cache is not None:
+            load_start, load_end = dt.datetime.min, dt.datetime.max
+        else:
+            load_start, load_end = first_dt, last_dt
+
+        print(f"\nLoading {first_dt.date()} to {last_dt.date()}")
+        loaded = {}
+        with span("read_program_data") as stage:
+            for month_file, month_path in month_paths.items():
+                if all(month_file not in months or month_file in cached_months
+                       for months, cached_months in zip(job_months,
+                                                        job_cached)):
+                    continue
+                loaded.update({month_file: self.month_cache.read_range(
+                    month_path, load_start, load_end)["clean_data"]})
+
+            # An order in two month files is combined as the months are
+            # loaded together, which cached results cannot give
+            month_orders = [loaded[month_file].keys()
+                            if month_file in loaded
+                            else cached[month_file]["order_numbers"]
+                            for month_file in month_paths]
+            has_repeats = sum(len(numbers) for numbers in month_orders) != \
+                len(set().union(*month_orders))
+            if has_repeats:
+                job_cached = [set() for _ in jobs]
+                for month_file, month_path in month_paths.items():
+                    if month_file not in loaded:
+                        loaded.update({month_file: self.month_cache
+                                       .read_range(month_path, load_start,
+                                                   load_end)["clean_data"]})
+
+            # Every clean order of every loaded month, in load order.
+            # An order in two month files is listed twice
+            month_names = []
+            order_numbers = []
+            records = []
+            entry_months = []
+            for month_file in month_paths:
+                if month_file not in loaded:
+                    continue
+                clean_data = loaded[month_file]
+                order_numbers += clean_data.keys()
+                records += clean_data.values()
+                entry_months += [len(month_names)] * len(clean_data)
+                month_names.append(month_file)
+
+            orders = OrderStore.from_records(order_numbers, records)
+            stage.rows = len(orders)
+        entry_months = np.array(entry_months, dtype=np.int64)
+        timestamps = [order_timestamp(data) for data in records]
+        is_dated = np.array([timestamp is not None
+                             for timestamp in timestamps], dtype=bool)
+        timestamps = np.array([timestamp if timestamp is not None else 0
+                               for timestamp in timestamps], dtype=np.int64)
+
+        # Classify every order once for all jobs
+        classified = {}
+        if "otd" in wanted:
+            print("Preparing OTD Report")
+            with span("classify otd_report", rows=len(orders)):
+                classified.update({"otd": classify_otd_orders(
+                    self.country_config_data, orders, self.calendars)})
+        if "dwell" in wanted:
+            print("Preparing Dwell Time Report")
+            with span("classify dwell_report", rows=len(orders)):
+                classified.update({"dwell": classify_dwell_orders(
+                    self.country_config_data, self.warehouse_config_data,
+                    orders, self.calendars)})
+        if "c2f" in wanted:
+            print("Preparing C2F Report")
+            with span("classify c2f_report", rows=len(orders)):
+                classified.update({"c2f": classify_c2f_orders(
+                    self.country_config_data, self.warehouse_config_data,
+                    orders, self.calendars)})
+
+        # Every loaded month's results, cached for the next run
+        month_rows = {}
+        month_results = {}
+        if self.report_cache is not None and not has_repeats:
+            with span("write report_cache"):
+                for month_number, month_file in enumerate(month_names):
+                    rows = np.flatnonzero(entry_months == month_number)
+                    month_rows.update({month_file: rows})
+                    results = self._month_results(
+                        [name for name in REPORT_NAMES if name in wanted],
+                        classified, rows)
+                    month_results.update({month_file: results})
+                    if month_file in cached and \
+                       all(name in cached[month_file]["reports"]
+                           for name in results):
+                        continue
+                    self.report_cache.write(
+                        month_paths[month_file],
+                        [order_numbers[row] for row in rows.tolist()],
+                        [timestamp if dated else None
+                         for timestamp, dated in zip(
+                             timestamps[rows].tolist(),
+                             is_dated[rows].tolist())],
+                        results)
+
+        for (start_dt, end_dt, report_names, output_dir), months, \
+                (start, end), cached_months in zip(jobs, job_months,
+                                                   job_ranges, job_cached):
+            print(f"Writing reports for {start_dt.date()} to "
+                  f"{end_dt.date()}")
+            in_range = ~is_dated | ((timestamps >= start) &
+                                    (timestamps < end))
+            Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+            if self.report_cache is not None and not has_repeats:
+                # Month by month: cached, read whole or read in part
+                job_results = {name: [] for name in report_names}
+                for month_file in month_paths:
+                    if month_file not in months:
+                        continue
+                    if month_file in cached_months:
+                        results = cached[month_file]["reports"]
+                    else:
+                        rows = month_rows[month_file]
+                        if np.all(in_range[rows]):
+                            results = month_results[month_file]
+                        else:
+                            results = self._month_results(
+                                report_names, classified,
+                                rows[in_range[rows]])
+                    for name in report_names:
+                        job_results[name].append(results[name])
+
+                with span(f"reports {start_dt.date()} to {end_dt.date()}"):
+                    self._write_job(report_names, output_dir, {
+                        name: merge_results(name, job_results[name],
+                                            self.country_config_data,
+                                            self.warehouse_config_data)
+                        for name in report_names})
+                continue
+
+            in_months = np.array([name in months for name in month_names],
+                                 dtype=bool)
+            rows = np.flatnonzero(in_months[entry_months] & in_range)
+            if has_repeats:
+                # As when months are combined into one dictionary:
+                # the first month's position, the last month's data
+                positions = {}
+                for row in rows.tolist():
+                    positions.update({order_numbers[row]: row})
+                rows = np.array(list(positions.values()), dtype=np.int64)
+
+            with span(f"reports {start_dt.date()} to {end_dt.date()}",
+                      rows=len(rows)):
+                self._write_job(report_names, output_dir, {
+                    name: self._summarize(name, classified, rows)
+                    for name in report_names})
+
+    def _summarize(self, report_name, classified, rows):
+        """
+        A report's results for the classified orders at the given rows
+        """
+        if report_name == "otd":
+            return summarize_otd_orders(classified["otd"], rows)
+        if report_name == "dwell":
+            return summarize_dwell_orders(classified["dwell"], rows)
+        return summarize_c2f_orders(classified["c2f"], rows,
+                                    self.country_config_data,
+                                    self.warehouse_config_data)
+
+    def _month_results(self, report_names, classified, rows):
+        """
+        {report name: cached_results} for the classified orders at the
+        given rows of one month
+        """
+        results = {}
+        for report_name in report_names:
+            summary = self._summarize(report_name, classified, rows)
+            results.update({report_name: cached_results(report_name,
+                                                        summary)})
+        return results
+
+    def _write_job(self, report_names, output_dir, results):
+        if "otd" in report_names:
+            with span("write otd_report"):
+                write_otd_report(*results["otd"], output_dir)
+        if "dwell" in report_names:
+            with span("write dwell_report"):
+                write_dwell_report(*results["dwell"], output_dir)
+        if "c2f" in report_names:
+            with span("write c2f_report"):
+                write_report_data(*results["c2f"], output_dir)
+
+
+def epoch_seconds(datetime_obj):
+    return (datetime_obj - dt.datetime(1970, 1, 1)) // dt.timedelta(seconds=1)
+
+
+def read_job_file(job_file_path):
+    """
+    Read a job file:
+        {"jobs": [{"start": "2024-01-01", "end": "2024-02-01",
+                   "reports": ["otd", "dwell", "c2f"],
+                   "output_dir": "./aop_report/Completed Reports/2024-01"}]}
+    "reports" may be "all", and "output_dir" may be left out.
+    Returns a list of (start_dt, end_dt, report_names, output_dir)
+    """
+    with open(job_file_path, mode="r", encoding="utf-8-sig") as job_file:
+        job_data = json.load(job_file)
+
+    jobs = []
+    for job in job_data["jobs"]:
+        report_names = job.get("reports", "all")
+        if report_names == "all":
+            report_names = list(REPORT_NAMES)
+        for name in report_names:
+            if name not in REPORT_NAMES:
+                raise ValueError(f"Unknown report {name} in job file. "
+                                 f"Reports are {', '.join(REPORT_NAMES)}")
+        jobs.append((dt.datetime.fromisoformat(job["start"]),
+                     dt.datetime.fromisoformat(job["end"]),
+                     report_names,
+                     Path(job.get("output_dir", REPORT_DIR))))
+    return jobs
+
+
+def run_job_file(job_file_path, config_dir="./Shared Config Files",
+                 use_cache=False):
+    """
+    Run every job in a job file in this process, from one load
+    """
+    ReportJobRunner(config_dir, use_cache).run_many(
+        read_job_file(job_file_path))
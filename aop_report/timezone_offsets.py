@@ -0,0 +1,139 @@
+from bisect import bisect_right
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+import datetime as dt
+import numpy as np
+
+# Years the offset tables cover. Outside them the nearest year's
+# closing offset is used
+FIRST_YEAR = 2000
+LAST_YEAR = 2050
+
+EPOCH = dt.datetime(1970, 1, 1)
+ONE_SECOND = dt.timedelta(seconds=1)
+
+
+class ZoneOffsetTable:
+    """
+    The UTC offsets of one timezone, worked out once from zoneinfo.
+
+    Offsets only change at DST transitions, so the table is just the
+    transition instants and the offset in force after each one. Lookups are
+    a bisect for single values or numpy.searchsorted for whole arrays.
+
+    Wall clock (naive local) times are read the way zoneinfo reads them
+    with fold=0: times skipped in spring and repeated in autumn both take
+    the offset from before the transition.
+    """
+
+    def __init__(self, zone_name, first_year=FIRST_YEAR, last_year=LAST_YEAR):
+        self.zone_name = zone_name
+        zone = ZoneInfo(zone_name)
+
+        # Every UTC midnight in range, then the exact second of each change
+        start = dt.datetime(first_year, 1, 1)
+        day_count = (dt.datetime(last_year + 1, 1, 1) - start).days
+        first_offset = _utc_offset(zone, _seconds(start))
+
+        transitions = []
+        offsets = [first_offset]
+        for day in range(day_count):
+            day_start = _seconds(start) + day * 86400
+            day_offset = _utc_offset(zone, day_start + 86400)
+            if day_offset != offsets[-1]:
+                transitions.append(_find_transition(
+                    zone, day_start, day_start + 86400, offsets[-1]))
+                offsets.append(day_offset)
+
+        # utc_transitions[i] starts offsets[i + 1]
+        self.utc_transitions = transitions
+        self.offsets = offsets
+        self.wall_transitions = [
+            transition + max(before, after) for transition, before, after
+            in zip(transitions, offsets, offsets[1:])]
+
+        self._utc_array = np.array(self.utc_transitions, dtype=np.int64)
+        self._wall_array = np.array(self.wall_transitions, dtype=np.int64)
+        self._offset_array = np.array(self.offsets, dtype=np.int64)
+
+    def utc_offset(self, utc_datetime):
+        """
+        Offset in force at a naive UTC datetime, as a timedelta
+        """
+        index = bisect_right(self.utc_transitions, _seconds(utc_datetime))
+        return dt.timedelta(seconds=self.offsets[index])
+
+    def local_offset(self, wall_datetime):
+        """
+        Offset of a naive local datetime, as a timedelta
+        """
+        index = bisect_right(self.wall_transitions, _seconds(wall_datetime))
+        return dt.timedelta(seconds=self.offsets[index])
+
+    def utc_offsets(self, utc_times):
+        """
+        Offset in seconds for each value of a datetime64 array of UTC times
+        """
+        seconds = _to_seconds_array(utc_times)
+        return self._offset_array[
+            np.searchsorted(self._utc_array, seconds, side='right')]
+
+    def local_offsets(self, wall_times):
+        """
+        Offset in seconds for each value of a datetime64 array of
+        naive local times
+        """
+        seconds = _to_seconds_array(wall_times)
+        return self._offset_array[
+            np.searchsorted(self._wall_array, seconds, side='right')]
+
+    def to_local(self, utc_datetime):
+        """
+        Naive local datetime for a timezone aware datetime
+        """
+        utc_datetime = utc_datetime.astimezone(dt.timezone.utc)\
+            .replace(tzinfo=None)
+        return utc_datetime + self.utc_offset(utc_datetime)
+
+    def to_local_array(self, utc_times):
+        """
+        Local times for a datetime64 array of UTC times, in the array's
+        unit or seconds if that is coarser. NaT stays NaT
+        """
+        utc_times = np.asarray(utc_times, dtype='datetime64')
+        return utc_times + self.utc_offsets(utc_times)\
+            .astype('timedelta64[s]')
+
+
+@lru_cache(maxsize=None)
+def offset_table(zone_name):
+    """
+    The ZoneOffsetTable for a zone, built the first time it is asked for
+    """
+    return ZoneOffsetTable(zone_name)
+
+
+def _seconds(naive_datetime):
+    return (naive_datetime - EPOCH) // ONE_SECOND
+
+
+def _to_seconds_array(times):
+    return np.asarray(times).astype('datetime64[s]').astype(np.int64)
+
+
+def _utc_offset(zone, utc_seconds):
+    utc_datetime = dt.datetime.fromtimestamp(utc_seconds, dt.timezone.utc)
+    return int(utc_datetime.astimezone(zone).utcoffset().total_seconds())
+
+
+def _find_transition(zone, low, high, offset_before):
+    """
+    First second in (low, high] where the offset is no longer offset_before
+    """
+    while high - low > 1:
+        middle = (low + high) // 2
+        if _utc_offset(zone, middle) == offset_before:
+            low = middle
+        else:
+            high = middle
+    return high
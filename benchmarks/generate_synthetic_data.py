@@ -0,0 +1,358 @@
+"""
+Deterministic synthetic data for the benchmarks.
+
+Builds a workspace laid out like the real one:
+    Shared Config Files/     countries, warehouses, holidays, statuses,
+                             headers.json
+    Input Data/              data_extract, wh_pl and carrier_dpd CSVs
+    Program Data/data_by_month/
+                             month files (and their indexes) shaped like
+                             prepare_program_data's output
+plus the empty output folders the scripts write into.
+
+Orders are generated in fixed size chunks, each from its own seed, so the
+same tier and seed always give the same files and memory stays bounded at
+every size. Invoice times rise steadily through 2024 with the order
+number, so a month file can be written as soon as the chunks move past it.
+
+python benchmarks/generate_synthetic_data.py WORKSPACE --tier 100k
+"""
+from pathlib import Path
+import argparse
+import csv
+import datetime as dt
+import json
+import random
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / "Data Handling"))
+from month_index import write_indexed_month  # noqa: E402
+
+TIERS = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+
+CHUNK_ORDERS = 10_000
+# Orders per input CSV file, a whole number of chunks
+FILE_ORDERS = 250_000
+
+YEAR_START = dt.datetime(2024, 1, 1)
+YEAR_MINUTES = 366 * 24 * 60
+# Random delay in minutes added to each order's place in the year
+INVOICE_JITTER = 120
+
+WORKSPACE_DIRS = ("Shared Config Files", "Input Data/data_extract",
+                  "Input Data/wh_pl", "Input Data/carrier_dpd",
+                  "Program Data/data_by_month", "Program Data/combined_files",
+                  "Program Data/Input Data Errors/batch_errors",
+                  "Data Handling/Input Data Errors",
+                  "aop_report/Completed Reports",
+                  "Transit Time Report/completed_reports")
+
+COUNTRIES = {"poland": "pl_wh", "germany": "pl_wh", "italy": "pl_wh",
+             "france": "pl_wh", "moldova": "pl_wh", "uk": "uk_wh",
+             "israel": "uk_wh"}
+# DataExtract ship_to_country codes. EO rows name the country in
+# ship_to_addr_3, and USA is not a configured country
+COUNTRY_CODES = ("EO", "GBR", "MDA", "DEU", "ITA", "ISR", "FRA", "POL",
+                 "USA")
+CODE_COUNTRIES = {"EO": "poland", "GBR": "uk", "MDA": "moldova",
+                  "DEU": "germany", "ITA": "italy", "ISR": "israel",
+                  "FRA": "france", "POL": "poland",
+                  "USA": "missing from prepare_program_data"}
+DELIVERED_STATUSES = ("Delivered", "Delivered to neighbour",
+                      "Parcel shop delivery")
+OTHER_STATUSES = ("In transit", "Returned to sender")
+
+WH_DATETIME_FORMAT = "%d/%m/%Y %H:%M"
+DATA_EXTRACT_FIELDS = ("order_number", "dist_id", "order_verify_init",
+                       "invoice_date", "invoice_time", "ship_to_country",
+                       "ship_to_addr_3", "ship_via")
+WH_FIELDS = ("Order", "Imported", "Shipped")
+CARRIER_FIELDS = ("Shipment Reference", "Latest Status", "Processed Date",
+                  "First Delivery Date")
+
+
+def generate_workspace(workspace, order_count, seed=1,
+                       inputs=True, months=True):
+    workspace = Path(workspace)
+    for directory in WORKSPACE_DIRS:
+        (workspace / directory).mkdir(parents=True, exist_ok=True)
+    write_config_files(workspace / "Shared Config Files")
+
+    input_writer = InputFileWriter(workspace / "Input Data") \
+        if inputs else None
+    month_writer = MonthFileWriter(
+        workspace / "Program Data/data_by_month") if months else None
+
+    for chunk_start in range(0, order_count, CHUNK_ORDERS):
+        chunk = generate_chunk(chunk_start,
+                               min(CHUNK_ORDERS, order_count - chunk_start),
+                               order_count, seed)
+        if input_writer is not None:
+            input_writer.write(chunk_start, chunk)
+        if month_writer is not None:
+            month_writer.add(chunk)
+
+    if input_writer is not None:
+        input_writer.close()
+    if month_writer is not None:
+        month_writer.close()
+
+
+def write_config_files(config_dir):
+    countries = {country: {"warehouse": warehouse,
+                           "otd_days": {"stand": 3, "prem": 1},
+                           "carrier_slas": {"stand": 3, "prem": 1}}
+                 for country, warehouse in COUNTRIES.items()}
+    warehouses = {
+        "warehouse_locations": ["pl_wh", "uk_wh", "cz_wh"],
+        "holidays": {"all": ["2024-01-01", "2024-12-25", "2024-12-26"],
+                     "pl_wh": ["2024-05-01", "2024-05-03", "2024-11-11"],
+                     "uk_wh": ["2024-05-06", "2024-08-26"],
+                     "cz_wh": ["2024-07-05"]},
+        "warehouse_swap_dates": {"germany": {"date": "2024-06-01",
+                                             "swap_to": "cz_wh"}}
+    }
+    holidays = {"all": ["2024-01-01", "2024-12-25"],
+                "poland": ["2024-05-01", "2024-05-03", "2024-11-11"],
+                "uk": ["2024-05-06", "2024-08-26"]}
+    headers = {
+        "normal_headers": ["import_datetime", "ship_datetime",
+                           "delivery_datetime", "latest_status"],
+        "data_extract": {"overwrite": False},
+        "wh_pl": {"order_number": "Order", "import_datetime": "Imported",
+                  "ship_datetime": "Shipped",
+                  "datetime_format": WH_DATETIME_FORMAT, "overwrite": False},
+        "carrier_dpd": {"order_number": "Shipment Reference",
+                        "delivery_datetime": "First Delivery Date",
+                        "latest_status": "Latest Status",
+                        "datetime_format": "iso", "overwrite": True}
+    }
+
+    for name, data in (("countries.json", countries),
+                       ("warehouses.json", warehouses),
+                       ("holidays.json", holidays),
+                       ("headers.json", headers)):
+        with open(config_dir / name, mode="w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
+
+    with open(config_dir / "statuses.csv", mode="w",
+              encoding="utf-8", newline="") as f:
+        f.write("status_message\n")
+        for status in DELIVERED_STATUSES:
+            f.write(status + "\n")
+
+
+def generate_chunk(chunk_start, count, order_count, seed):
+    """
+    A list of orders, each a dict of its raw values:
+    the invoice, import, ship and delivery datetimes (None when an
+    input file is missing the order) and its DataExtract fields
+    """
+    rng = random.Random(f"{seed}-{chunk_start}")
+    orders = []
+    for index in range(chunk_start, chunk_start + count):
+        minute = index * YEAR_MINUTES // order_count + \
+            rng.randrange(0, INVOICE_JITTER)
+        invoice = YEAR_START + dt.timedelta(minutes=minute)
+        code = rng.choice(COUNTRY_CODES)
+        order = {
+            "order_number": str(10_000_000 + index),
+            "dist_id": str(rng.randrange(1, 100_000)),
+            "verified": rng.random() < 0.02,
+            "invoice": invoice,
+            "time_missing": rng.random() < 0.05,
+            "code": code,
+            "ship_via": rng.choice(("Standard", "Premium")),
+            "import": None,
+            "ship": None,
+            "delivery": None,
+            "status": None,
+            "utc_delivery": False
+        }
+        # A few orders never reach the warehouse
+        if rng.random() >= 0.03:
+            order["import"] = invoice + dt.timedelta(
+                minutes=rng.randrange(0, 30 * 60))
+            order["ship"] = order["import"] + dt.timedelta(
+                minutes=rng.randrange(60, 90 * 60))
+            order["status"] = rng.choice(DELIVERED_STATUSES * 3 +
+                                         OTHER_STATUSES)
+            if rng.random() >= 0.05:
+                order["delivery"] = order["ship"] + dt.timedelta(
+                    minutes=rng.randrange(-3 * 60, 200 * 60))
+                order["utc_delivery"] = rng.random() < 0.1
+        orders.append(order)
+    return orders
+
+
+class InputFileWriter:
+    """
+    Writes the chunks out as Input Data CSVs, FILE_ORDERS orders a file
+    """
+
+    def __init__(self, input_dir):
+        self.input_dir = input_dir
+        self.files = []
+        self.file_number = None
+
+    def write(self, chunk_start, chunk):
+        file_number = chunk_start // FILE_ORDERS
+        if file_number != self.file_number:
+            self.close()
+            self.file_number = file_number
+            self.writers = [
+                self._open("data_extract", f"extract_{file_number}",
+                           DATA_EXTRACT_FIELDS),
+                self._open("wh_pl", f"wh_{file_number}", WH_FIELDS),
+                self._open("carrier_dpd", f"dpd_{file_number}",
+                           CARRIER_FIELDS)]
+
+        extract_writer, wh_writer, carrier_writer = self.writers
+        for order in chunk:
+            invoice = order["invoice"]
+            extract_writer.writerow((
+                order["order_number"], order["dist_id"],
+                "AB" if order["verified"] else "",
+                invoice.date().isoformat(),
+                "::" if order["time_missing"] else invoice.time().isoformat(),
+                order["code"], "Poland" if order["code"] == "EO" else "",
+                order["ship_via"]))
+
+            if order["import"] is None:
+                continue
+            wh_writer.writerow((
+                order["order_number"],
+                order["import"].strftime(WH_DATETIME_FORMAT),
+                order["ship"].strftime(WH_DATETIME_FORMAT)))
+            carrier_writer.writerow((
+                "DT" + order["order_number"] + "_DOTERRA",
+                order["status"], order["ship"].isoformat(),
+                carrier_delivery_string(order)))
+
+    def close(self):
+        for file in self.files:
+            file.close()
+        self.files = []
+
+    def _open(self, input_type, name, fields):
+        file = open(self.input_dir / input_type / f"{name}.csv", mode="w",
+                    encoding="utf-8-sig", newline="")
+        self.files.append(file)
+        writer = csv.writer(file)
+        writer.writerow(fields)
+        return writer
+
+
+def carrier_delivery_string(order):
+    if order["delivery"] is None:
+        return ""
+    if order["utc_delivery"]:
+        # Warsaw summer time, near enough for synthetic data
+        return (order["delivery"] - dt.timedelta(hours=2)).isoformat() + \
+            "+00:00"
+    return order["delivery"].isoformat()
+
+
+class MonthFileWriter:
+    """
+    Sorts orders into month files the way prepare_program_data would,
+    writing each month once the chunks have moved past it
+    """
+
+    def __init__(self, month_dir):
+        self.month_dir = month_dir
+        self.months = {}
+
+    def add(self, chunk):
+        for order in chunk:
+            if order["import"] is None:
+                continue
+            month = f"{order['import'].year}-{order['import'].month}"
+            month_data = self.months.setdefault(month, {
+                "clean_data": {}, "dirty_data": {}, "fyi_data": {}})
+            tier, record = month_record(order)
+            month_data[tier].update({order["order_number"]: record})
+
+        # Imports follow invoices, and no later order is invoiced before
+        # this chunk's first invoice less its random delay. So no later
+        # order imports into a month that ended before then
+        earliest = chunk[0]["invoice"] - dt.timedelta(minutes=INVOICE_JITTER)
+        for month in list(self.months.keys()):
+            year, month_number = (int(part) for part in month.split("-"))
+            if (year, month_number) < (earliest.year, earliest.month):
+                self._write(month)
+
+    def close(self):
+        for month in list(self.months.keys()):
+            self._write(month)
+
+    def _write(self, month):
+        write_indexed_month(self.month_dir / f"{month}.json",
+                            self.months.pop(month))
+
+
+def month_record(order):
+    """
+    The tier and record prepare_program_data would file the order under
+    """
+    invoice = order["invoice"]
+    if order["time_missing"]:
+        invoice = dt.datetime.combine(invoice.date(), dt.time(0, 0))
+    country = CODE_COUNTRIES[order["code"]]
+    record = {
+        "delivery_datetime": "",
+        "latest_status": order["status"],
+        "id": order["dist_id"],
+        "country": country,
+        "invoice_datetime": invoice.isoformat(),
+        "ship_q": "stand" if order["ship_via"] == "Standard" else "prem",
+        "import_datetime": order["import"].isoformat(),
+        "ship_datetime": order["ship"].isoformat()
+    }
+    if order["delivery"] is not None:
+        record["delivery_datetime"] = order["delivery"].isoformat()
+
+    if order["verified"]:
+        del record["id"], record["country"], record["invoice_datetime"], \
+            record["ship_q"]
+        record.update({"error_code": "No DataExtract Data"})
+        return "dirty_data", record
+    if country not in COUNTRIES:
+        record.update({"error_code": f"Invalid Country: {country}"})
+        return "dirty_data", record
+    if order["delivery"] is None:
+        record.update({"status": "wh_data_only"})
+        return "clean_data", record
+    if order["delivery"] < order["ship"]:
+        record.update({"error_code": "Delivered Before Shipped: "
+                       f"Shipped: {record['ship_datetime']}, "
+                       f"Delivered: {record['delivery_datetime']}"})
+        return "dirty_data", record
+    if order["status"] not in DELIVERED_STATUSES:
+        record.update({"error_code": "Unknown Delivery Status: "
+                       f"{order['status']}"})
+        return "dirty_data", record
+
+    record.update({"status": "clean"})
+    return "clean_data", record
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a synthetic workspace for the benchmarks")
+    parser.add_argument("workspace", type=Path)
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--tier", choices=list(TIERS.keys()), default="10k")
+    size.add_argument("--orders", type=int, help="exact number of orders")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-inputs", action="store_true",
+                        help="skip the Input Data CSVs")
+    parser.add_argument("--no-months", action="store_true",
+                        help="skip the data_by_month files")
+    args = parser.parse_args()
+
+    order_count = args.orders or TIERS[args.tier]
+    print(f"Generating {order_count:,} orders in {args.workspace}")
+    generate_workspace(args.workspace, order_count, args.seed,
+                       inputs=not args.no_inputs,
+                       months=not args.no_months)
@@ -0,0 +1,278 @@
+"""
+Time and memory profile each stage of the pipeline on synthetic data.
+
+Stages, run in order inside one process:
+    ingest   jsonify_data, combine_data, group_input_data,
+             run_error_checks, update_program_data
+    load     read_program_data, write_combined_orders
+    reports  read_combined_orders, otd_report, dwell_time_report,
+             c2f_report, transit_time_report
+
+The workspace is made by generate_synthetic_data.py if it does not exist.
+The ingest stages rebuild data_by_month from the Input Data CSVs; without
+them the load and report stages use the generated month files.
+
+Results are written as json: one entry per stage with its wall and CPU
+seconds, rows, rows per second and peak memory. --compare prints each
+stage against an earlier results file.
+
+python benchmarks/run_benchmarks.py --tier 100k
+python benchmarks/run_benchmarks.py --tier 1m --stages load reports \\
+    --compare benchmarks/results/1m-20240101-120000.json
+"""
+from contextlib import redirect_stdout
+from pathlib import Path
+import argparse
+import datetime as dt
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+for script_dir in ("Data Handling", "aop_report", "transit_time_report"):
+    sys.path.append(str(REPO_DIR / script_dir))
+import prepare_program_data as ingestion  # noqa: E402
+import load_program_data as loading  # noqa: E402
+from order_store import read_combined_orders  # noqa: E402
+from business_calendar import load_calendar_registry  # noqa: E402
+from instrumentation import peak_rss_mb  # noqa: E402
+from prepare_otd_report import prepare_otd_report  # noqa: E402
+from prepare_dwell_time_report import prepare_dwell_time_report  # noqa: E402
+from prepare_c2f_report import prepare_c2f_report  # noqa: E402
+from prepare_transit_time_report import \
+    prepare_transit_time_report  # noqa: E402
+from generate_synthetic_data import TIERS, generate_workspace  # noqa: E402
+
+STAGE_GROUPS = ("ingest", "load", "reports")
+WORKSPACE_DIR = REPO_DIR / "benchmarks" / "workspaces"
+RESULTS_DIR = REPO_DIR / "benchmarks" / "results"
+
+LOAD_START = dt.datetime(2024, 1, 1)
+LOAD_END = dt.datetime(2025, 2, 1)
+
+
+class StageTimer:
+    """
+    Runs stages one at a time and keeps their measurements.
+    Anything a stage prints is swallowed unless verbose is set
+    """
+
+    def __init__(self, trace_memory=False, verbose=False):
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.stages = []
+
+    def run(self, name, function, *args, rows=None):
+        """
+        Call function(*args) and record it as a stage.
+        rows: the number of rows the stage handles, or a function of
+        its return value that gives it
+        """
+        print(f"{name:<24}", end="", flush=True)
+        if self.trace_memory:
+            tracemalloc.start()
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if self.verbose:
+            result = function(*args)
+        else:
+            with redirect_stdout(io.StringIO()):
+                result = function(*args)
+        wall_seconds = time.perf_counter() - wall_start
+        cpu_seconds = time.process_time() - cpu_start
+
+        traced_peak_mb = None
+        if self.trace_memory:
+            traced_peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+
+        if callable(rows):
+            rows = rows(result)
+        self.stages.append({
+            "name": name,
+            "wall_seconds": round(wall_seconds, 4),
+            "cpu_seconds": round(cpu_seconds, 4),
+            "rows": rows,
+            "rows_per_second": round(rows / wall_seconds, 1)
+            if rows is not None and wall_seconds > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "traced_peak_mb": round(traced_peak_mb, 2)
+            if traced_peak_mb is not None else None
+        })
+        rate = self.stages[-1]["rows_per_second"]
+        print(f"{wall_seconds:9.3f}s" +
+              (f"  {rate:14,.0f} rows/s" if rate is not None else ""))
+        return result
+
+
+def run_ingest_stages(timer):
+    with open(Path("./Shared Config Files/headers.json"),
+              mode="r", encoding="utf-8-sig") as json_file:
+        headers_dict = json.load(json_file)
+
+    month_dir = Path(ingestion.MONTH_DIR)
+    shutil.rmtree(month_dir, ignore_errors=True)
+    month_dir.mkdir(parents=True)
+
+    input_data = timer.run(
+        "jsonify_data", ingestion.read_input_data, headers_dict,
+        rows=lambda data: sum(len(orders) for orders in data.values()))
+    combined_data = timer.run("combine_data", ingestion.combine_data,
+                              input_data, headers_dict, rows=len)
+    grouped_data = timer.run("group_input_data", ingestion.group_input_data,
+                             combined_data, rows=len(combined_data))
+    sorted_data = timer.run(
+        "run_error_checks", ingestion.run_error_checks, grouped_data,
+        rows=sum(len(orders) for orders in grouped_data.values()))
+    timer.run("update_program_data", ingestion.update_program_data,
+              sorted_data,
+              rows=sum(len(orders) for month_data in sorted_data.values()
+                       for orders in month_data.values()))
+
+
+def run_load_stages(timer):
+    raw_program_data = timer.run(
+        "read_program_data", loading.read_program_data,
+        LOAD_START, LOAD_END,
+        rows=lambda data: sum(len(orders) for month_data in data.values()
+                              for orders in month_data.values()))
+    timer.run("write_combined_orders", loading.prepare_program_data,
+              raw_program_data,
+              rows=len(loading.combine_clean_data(raw_program_data)))
+
+
+def run_report_stages(timer):
+    orders = timer.run("read_combined_orders", read_combined_orders,
+                       rows=len)
+    with open(Path('./Shared Config Files/countries.json'), mode="r",
+              encoding="utf-8-sig") as json_file:
+        country_config_data = json.load(json_file)
+    with open(Path('./Shared Config Files/warehouses.json'), mode="r",
+              encoding="utf-8-sig") as json_file:
+        warehouse_config_data = json.load(json_file)
+    calendars = load_calendar_registry()
+
+    timer.run("otd_report", prepare_otd_report, country_config_data,
+              orders, calendars, rows=len(orders))
+    timer.run("dwell_time_report", prepare_dwell_time_report, orders,
+              country_config_data, calendars, rows=len(orders))
+    timer.run("c2f_report", prepare_c2f_report, country_config_data,
+              warehouse_config_data, orders, calendars, rows=len(orders))
+    timer.run("transit_time_report", prepare_transit_time_report, "",
+              calendars, rows=len(orders))
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(old_results, new_results):
+    """
+    Print each stage's wall time against an earlier run
+    """
+    old_stages = {stage["name"]: stage for stage in old_results["stages"]}
+    print(f"\nCompared with {old_results.get('git_commit')} "
+          f"({old_results.get('orders'):,} orders)")
+    for stage in new_results["stages"]:
+        old_stage = old_stages.get(stage["name"])
+        if old_stage is None or old_stage["wall_seconds"] == 0:
+            continue
+        ratio = stage["wall_seconds"] / old_stage["wall_seconds"]
+        print(f"{stage['name']:<24}{old_stage['wall_seconds']:9.3f}s -> "
+              f"{stage['wall_seconds']:9.3f}s  x{ratio:.2f}")
+
+
+def main(order_count, tier_name, workspace, stage_groups, output_path,
+         seed=1, regenerate=False, trace_memory=False, verbose=False,
+         compare_path=None):
+    workspace = Path(workspace).resolve()
+    if regenerate and workspace.is_dir():
+        shutil.rmtree(workspace)
+    if not workspace.is_dir():
+        print(f"Generating {order_count:,} orders in {workspace}")
+        generate_workspace(workspace, order_count, seed)
+
+    timer = StageTimer(trace_memory, verbose)
+    previous_dir = Path.cwd()
+    # The scripts read and write relative to the workspace
+    os.chdir(workspace)
+    try:
+        if "ingest" in stage_groups:
+            run_ingest_stages(timer)
+        if "load" in stage_groups:
+            run_load_stages(timer)
+        if "reports" in stage_groups:
+            run_report_stages(timer)
+    finally:
+        os.chdir(previous_dir)
+
+    results = {
+        "tier": tier_name,
+        "orders": order_count,
+        "seed": seed,
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "run_at": dt.datetime.now().isoformat(timespec="seconds"),
+        "trace_memory": trace_memory,
+        "stages": timer.stages
+    }
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, mode="w", encoding="utf-8") as results_file:
+        json.dump(results, results_file, indent=4)
+    print(f"\nResults written to {output_path}")
+
+    if compare_path is not None:
+        with open(compare_path, mode="r", encoding="utf-8") as old_file:
+            compare_results(json.load(old_file), results)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark each pipeline stage on synthetic data")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--tier", choices=list(TIERS.keys()), default="10k")
+    size.add_argument("--orders", type=int, help="exact number of orders")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workspace", type=Path,
+                        help="synthetic workspace, made if missing "
+                             "(default: benchmarks/workspaces/<tier>-<seed>)")
+    parser.add_argument("--regenerate", action="store_true",
+                        help="generate the workspace again")
+    parser.add_argument("--stages", nargs="+", choices=STAGE_GROUPS,
+                        default=list(STAGE_GROUPS))
+    parser.add_argument("--output", type=Path,
+                        help="results file (default: benchmarks/results/"
+                             "<tier>-<date>-<time>.json)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record each stage's peak python "
+                             "allocations with tracemalloc (slower)")
+    parser.add_argument("--compare", type=Path,
+                        help="earlier results file to compare against")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show what the stages print")
+    args = parser.parse_args()
+
+    order_count = args.orders or TIERS[args.tier]
+    tier_name = args.tier if args.orders is None else str(args.orders)
+    workspace = args.workspace or WORKSPACE_DIR / f"{tier_name}-{args.seed}"
+    output_path = args.output or RESULTS_DIR / (
+        f"{tier_name}-{dt.datetime.now():%Y%m%d-%H%M%S}.json")
+
+    main(order_count, tier_name, workspace, args.stages, output_path,
+         args.seed, args.regenerate, args.trace_memory, args.verbose,
+         args.compare)
@@ -1,70 +1,360 @@
+import argparse
+import csv
 import json
 import datetime as dt
 from pathlib import Path
-import numpy as np
 import sys
+import numpy as np
+
+# Shared report helpers live alongside the aop report scripts
+sys.path.append(str(Path(__file__).resolve().parent.parent / "aop_report"))
+from business_calendar import load_calendar_registry  # noqa: E402
+from order_store import OrderStore, read_combined_orders  # noqa: E402
+from helper_functions import to_day_array  # noqa: E402
+from instrumentation import span, start_tracing, finish_tracing, \
+    add_trace_arguments  # noqa: E402
 
+REPORT_DIR = Path("./Transit Time Report/completed_reports/")
+INPUT_DIR = Path("./Input Data/")
+STATUSES_PATH = Path("./Shared Config Files/statuses.csv")
 
-def prepare_transit_time_report(input_file_path=""):
-    with open(Path("./Shared Config Files/holidays.json"),
-              "r", newline='', encoding="utf-8-sig") as f:
-        holiday_data = json.load(f)
+# Carrier export mode: valid rows whose business days are counted in one go
+CARRIER_CHUNK_ROWS = 10000
+ERROR_BUCKETS = ("unknown_tracking_message", "order_not_delivered",
+                 "none_or_invalid_ship_date", "none_or_invalid_delivery_date",
+                 "ship_date_after_delivery_date")
+
+# Summary statistics per country, carrier and month
+PERCENTILES = (50, 90, 95, 99)
+# Histogram columns: "<=0", "1", ... up to HISTOGRAM_DAYS - 1, then the rest
+HISTOGRAM_DAYS = 10
+
+
+def prepare_transit_time_report(input_file_path="", calendars=None):
+    """
+    Write the transit time of every order with transit data, in business
+    days of its country, and a summary of them per country, carrier
+    (ship_q) and month shipped: count, mean, percentiles and a histogram.
+    Business days are counted for all orders at once, with one
+    busday_count call per country calendar
+    """
+    if calendars is None:
+        calendars = load_calendar_registry()
 
     # Read in input data
-    order_data = {}
+    # Either a combined json file or a columnar store directory
     if input_file_path == "":
-        input_path = Path(
-            "./Program Data/combined_files/combined-filtered.json")
+        order_data = read_combined_orders()
+    elif Path(input_file_path).is_dir():
+        order_data = OrderStore.load(input_file_path)
     else:
-        input_path = Path(input_file_path)
-    with open(input_path, mode="r", encoding="utf-8-sig", newline='') as file:
-        order_data = json.load(file)
+        with open(Path(input_file_path), mode="r", encoding="utf-8-sig",
+                  newline='') as file:
+            order_data = OrderStore.from_dict(json.load(file))
 
     # Record transit time
-    wh_data_only_count = 0
-    result_dictionary = {}
-    for order, data in order_data.items():
-        if data['status'] == "wh_data_only":
-            wh_data_only_count += 1
-            continue
-        record_transit_time(order, data, result_dictionary, holiday_data)
+    transit_orders = classify_transit_orders(order_data, calendars)
+    wh_data_only_count = len(order_data) - len(transit_orders['days'])
 
     # Write results to completed report
-    with open(Path("./Transit Time Report/completed_reports/"
-                   f"{dt.date.today().isoformat()}.txt"),
-              mode="w") as report_file:
+    report_name = dt.date.today().isoformat()
+    write_transit_report(transit_orders, wh_data_only_count, len(order_data),
+                         REPORT_DIR / f"{report_name}.txt")
+    write_transit_summary(summarize_transit_times(transit_orders),
+                          REPORT_DIR / f"{report_name} summary.csv")
+
+    print("Report Complete!")
+
+
+def classify_transit_orders(orders, calendars):
+    """
+    Transit times of every order that is not wh_data_only, as columns in
+    the order of the report: by country, then carrier, then month shipped,
+    each in the order first seen, and orders in store order within those.
+        order_numbers, countries (lower case), carriers,
+        months      'yyyy-m' of the ship date
+        groups      index of the order's (country, carrier, month) group,
+                    numbered in report order
+        days        business days in transit
+    """
+    selected = np.flatnonzero(orders.values('status') != "wh_data_only")
+    countries = np.char.lower(orders.values('country')[selected])
+    ship_dates = orders.dates('ship_datetime')[selected]
+    delivery_dates = orders.dates('delivery_datetime')[selected]
+
+    # Code for business days, one call per country calendar
+    days = np.zeros(len(selected), dtype=np.int64)
+    country_names, country_codes = np.unique(countries, return_inverse=True)
+    for code, country in enumerate(country_names):
+        in_country = country_codes == code
+        days[in_country] = calendars.count(
+            ship_dates[in_country], delivery_dates[in_country],
+            country=str(country))
+
+    return order_transit_rows(orders.order_numbers[selected], countries,
+                              orders.values('ship_q')[selected],
+                              ship_dates, days)
+
+
+def order_transit_rows(order_numbers, countries, carriers, ship_dates, days):
+    """
+    Put matching arrays of transit times in report order, and number their
+    (country, carrier, month shipped) groups. See classify_transit_orders
+    """
+    ship_months = ship_dates.astype('datetime64[M]').astype(np.int64)
+
+    # Nested first seen order: country, carrier within the country,
+    # month within the carrier
+    country_names, country_codes = np.unique(countries, return_inverse=True)
+    carrier_names, carrier_codes = np.unique(carriers, return_inverse=True)
+    pair_keys = country_codes * len(carrier_names) + carrier_codes
+    month_offsets = ship_months - (ship_months.min() if len(days) else 0)
+    group_keys = pair_keys * (int(month_offsets.max(initial=0)) + 1) + \
+        month_offsets
+    report_order = np.lexsort((np.arange(len(days)),
+                               first_seen_ranks(group_keys),
+                               first_seen_ranks(pair_keys),
+                               first_seen_ranks(country_codes)))
+
+    group_keys = group_keys[report_order]
+    is_new_group = np.ones(len(group_keys), dtype=bool)
+    is_new_group[1:] = group_keys[1:] != group_keys[:-1]
+    ship_months = ship_months[report_order]
+
+    return {
+        'order_numbers': np.asarray(order_numbers)[report_order],
+        'countries': np.asarray(countries)[report_order],
+        'carriers': np.asarray(carriers)[report_order],
+        'months': np.array([f"{month // 12 + 1970}-{month % 12 + 1}"
+                            for month in ship_months.tolist()], dtype=str),
+        'groups': np.cumsum(is_new_group) - 1,
+        'days': np.asarray(days)[report_order]
+    }
+
+
+def first_seen_ranks(keys):
+    """
+    For each integer key, the rank of its value by first appearance
+    """
+    _, first_index, inverse = np.unique(keys, return_index=True,
+                                        return_inverse=True)
+    return np.argsort(np.argsort(first_index, kind='stable'))[inverse]
+
+
+def summarize_transit_times(transit_orders):
+    """
+    One summary per (country, carrier, month) group, in report order:
+    (country, carrier, month, count, mean, percentiles, histogram counts).
+    Percentiles interpolate linearly between the closest ranks, as
+    numpy.percentile and spreadsheet PERCENTILE.INC do
+    """
+    groups = transit_orders['groups']
+    days = transit_orders['days']
+    if len(groups) == 0:
+        return []
+    group_count = int(groups[-1]) + 1
+
+    counts = np.bincount(groups, minlength=group_count)
+    means = np.bincount(groups, weights=days, minlength=group_count) / counts
+
+    # Days sorted within each group, and where each group starts
+    sorted_days = days[np.lexsort((days, groups))].astype(float)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    percentiles = []
+    for percentile in PERCENTILES:
+        rank = (counts - 1) * percentile / 100
+        lower = np.floor(rank).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        fraction = rank - lower
+        percentiles.append(
+            sorted_days[starts + lower] * (1 - fraction) +
+            sorted_days[starts + upper] * fraction)
+
+    bins = np.clip(days, 0, HISTOGRAM_DAYS)
+    histograms = np.bincount(groups * (HISTOGRAM_DAYS + 1) + bins,
+                             minlength=group_count * (HISTOGRAM_DAYS + 1))\
+        .reshape(group_count, HISTOGRAM_DAYS + 1)
+
+    firsts = starts.tolist()
+    return [(str(transit_orders['countries'][first]),
+             str(transit_orders['carriers'][first]),
+             str(transit_orders['months'][first]),
+             count, mean, group_percentiles, histogram)
+            for first, count, mean, group_percentiles, histogram in zip(
+                firsts, counts.tolist(), means.tolist(),
+                np.array(percentiles).T.tolist(), histograms.tolist())]
+
+
+def write_transit_report(transit_orders, wh_data_only_count, order_count,
+                         report_path):
+    with open(report_path, mode="w") as report_file:
         report_file.write("Transit Time Report\n")
         report_file.write("-"*60+"\n")
-        no_transit_percent = (wh_data_only_count / len(order_data)) * 100
+        no_transit_percent = (wh_data_only_count / order_count) * 100
         report_file.write("% of orders without transit data: "
                           f"{no_transit_percent:.2f}%\n")
-        report_file.write(f"{wh_data_only_count} / {len(order_data)} orders\n")
+        report_file.write(f"{wh_data_only_count} / {order_count} orders\n")
         report_file.write("-"*60+"\n")
         report_file.write("Data\n")
         report_file.write("-"*60+"\n")
         report_file.write("country,carrier_code,date_stamp,"
                           "order,bus_days_in_transit\n")
-        for ctry in result_dictionary.keys():
-            carrier_codes = result_dictionary[ctry].keys()
-            for carrier in carrier_codes:
-                date_stamps = result_dictionary[ctry][carrier].keys()
-                for date in date_stamps:
-                    order_data = result_dictionary[ctry][carrier][date].items()
-                    for order, days_in_transit in order_data:
-                        report_file.write(f"{ctry},{carrier},{date},"
-                                          f"{order},{days_in_transit}")
-                        report_file.write('\n')
+        for ctry, carrier, date, order, days_in_transit in zip(
+                transit_orders['countries'].tolist(),
+                transit_orders['carriers'].tolist(),
+                transit_orders['months'].tolist(),
+                transit_orders['order_numbers'].tolist(),
+                transit_orders['days'].tolist()):
+            report_file.write(f"{ctry},{carrier},{date},"
+                              f"{order},{days_in_transit}\n")
+
+
+def write_transit_summary(summaries, summary_path):
+    """
+    Write summarize_transit_times as a csv, one row per group.
+    Histogram columns count orders by business days in transit
+    """
+    histogram_headers = ["<=0"] + \
+        [str(days) for days in range(1, HISTOGRAM_DAYS)] + \
+        [f"{HISTOGRAM_DAYS}+"]
+    with open(summary_path, mode="w", encoding="utf-8-sig",
+              newline="") as summary_file:
+        summary_file.write(
+            "country,carrier_code,date_stamp,count,mean," +
+            ",".join(f"p{percentile}" for percentile in PERCENTILES) + "," +
+            ",".join(histogram_headers) + "\n")
+        for country, carrier, month, count, mean, percentiles, histogram \
+                in summaries:
+            summary_file.write(
+                f"{country},{carrier},{month},{count},{mean:.2f}," +
+                ",".join(f"{value:.2f}" for value in percentiles) + "," +
+                ",".join(str(value) for value in histogram) + "\n")
+
+
+def prepare_carrier_transit_report(export_paths=(), country="",
+                                   calendars=None):
+    """
+    Transit times straight from carrier export csv files, for a same day
+    check without running the ingestion pipeline.
+
+    export_paths: csv files, or directories of them. By default every
+                  ./Input Data/carrier_* directory. The carrier code is the
+                  directory name without "carrier_"
+    country: the holiday calendar business days are counted with, and the
+             report's country column. Exports have no country, so by
+             default only weekends are skipped
+
+    Rows are read one at a time and checked with has_error; an order's
+    first row is the one used, as in ingestion. Rows that fail go to the
+    error buckets, written as json next to the report and its summary
+    """
+    if calendars is None:
+        calendars = load_calendar_registry()
+    statuses_dict = read_carrier_statuses()
+
+    error_dict = {bucket: [] for bucket in ERROR_BUCKETS}
+    unique_orders_dict = {}
+    columns = {"order_numbers": [], "carriers": [], "ship_dates": [],
+               "days": []}
+    chunk = []
+    for carrier, file in iter_carrier_exports(export_paths):
+        print(f"    Now processing {file.name}")
+        with open(file, mode="r", encoding="utf-8-sig",
+                  newline="") as export_file:
+            for row in csv.DictReader(export_file):
+                if not has_error(row, unique_orders_dict, statuses_dict,
+                                 error_dict):
+                    chunk.append((carrier_order_number(row), carrier,
+                                  row['Processed Date'],
+                                  row['First Delivery Date']))
+                unique_orders_dict.update({carrier_order_number(row): ""})
+
+                if len(chunk) >= CARRIER_CHUNK_ROWS:
+                    count_carrier_chunk(chunk, columns, country, calendars)
+                    chunk = []
+    count_carrier_chunk(chunk, columns, country, calendars)
+
+    if len(unique_orders_dict) == 0:
+        print("No carrier export rows found")
+        return
+
+    transit_orders = order_transit_rows(
+        columns["order_numbers"], [country] * len(columns["days"]),
+        columns["carriers"],
+        np.array(columns["ship_dates"], dtype='datetime64[D]'),
+        np.array(columns["days"], dtype=np.int64))
+
+    report_name = f"{dt.date.today().isoformat()} carrier"
+    write_transit_report(transit_orders,
+                         len(unique_orders_dict) - len(columns["days"]),
+                         len(unique_orders_dict),
+                         REPORT_DIR / f"{report_name}.txt")
+    write_transit_summary(summarize_transit_times(transit_orders),
+                          REPORT_DIR / f"{report_name} summary.csv")
+    with open(REPORT_DIR / f"{report_name} errors.json", mode="w",
+              encoding="utf-8") as error_file:
+        json.dump(error_dict, error_file, indent=4)
 
     print("Report Complete!")
 
 
+def iter_carrier_exports(export_paths=()):
+    """
+    Yield (carrier code, csv file) for every export to read
+    """
+    if len(export_paths) == 0:
+        export_paths = sorted(path for path in INPUT_DIR.iterdir()
+                              if path.name.startswith("carrier_"))
+    for path in map(Path, export_paths):
+        files = sorted(path.iterdir()) if path.is_dir() else [path]
+        carrier_dir = path if path.is_dir() else path.parent
+        for file in files:
+            yield carrier_dir.name.replace("carrier_", "", 1), file
+
+
+def read_carrier_statuses(statuses_path=STATUSES_PATH):
+    """
+    {lower case status message: True if it means delivered}.
+    A blank is_delivered column marks a status as not delivered;
+    without that column every listed status is a delivery
+    """
+    statuses_dict = {}
+    with open(statuses_path, mode="r", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            statuses_dict.update({row["status_message"].lower():
+                                  row.get("is_delivered", "x") != ""})
+    return statuses_dict
+
+
+def count_carrier_chunk(chunk, columns, country, calendars):
+    """
+    Count the business days of a chunk of valid rows and add them to the
+    columns. Dates are the wall clock dates of the export
+    """
+    if len(chunk) == 0:
+        return
+    order_numbers, carriers, ship_strings, delivery_strings = zip(*chunk)
+    ship_dates = to_day_array(ship_strings)
+    days = calendars.count(ship_dates, to_day_array(delivery_strings),
+                           country=country or None)
+
+    columns["order_numbers"] += order_numbers
+    columns["carriers"] += carriers
+    columns["ship_dates"] += ship_dates.tolist()
+    columns["days"] += days.tolist()
+
+
+def carrier_order_number(order_data_dict):
+    return order_data_dict['Shipment Reference'].replace("DT", "")\
+                                                .replace("_DOTERRA", "")
+
+
 def has_error(order_data_dict, unique_orders_dict, statuses_dict, error_dict):
     """
     Check if an order has anything that would be an error.
     Update error handling dictionary, if so, and return true, otherwise false
     """
-    order_num = order_data_dict['Shipment Reference'].replace("DT", "")\
-                                                     .replace("_DOTERRA", "")
+    order_num = carrier_order_number(order_data_dict)
 
     if order_num in unique_orders_dict:
         return True
@@ -90,7 +380,7 @@ def has_error(order_data_dict, unique_orders_dict, statuses_dict, error_dict):
     # Ship date validity check
     try:
         ship_date = dt.datetime.fromisoformat(
-            order_data_dict['Processed Date'])
+            order_data_dict['Processed Date']).replace(tzinfo=None)
     except ValueError:
         temp_object = {
             order_num: order_data_dict['Processed Date'].lower()
@@ -101,7 +391,7 @@ def has_error(order_data_dict, unique_orders_dict, statuses_dict, error_dict):
     # Delivery date validity check
     try:
         delivery_date = dt.datetime.fromisoformat(
-            order_data_dict['First Delivery Date'])
+            order_data_dict['First Delivery Date']).replace(tzinfo=None)
     except ValueError:
         temp_object = {
             order_num: order_data_dict['First Delivery Date'].lower()
@@ -120,49 +410,34 @@ def has_error(order_data_dict, unique_orders_dict, statuses_dict, error_dict):
     return False
 
 
-def record_transit_time(order, data, result_dictionary, holiday_data):
-    """
-    Record the transit time into the result dictionary
-    """
-
-    country = data['country'].lower()
-    ship_to_code = data['ship_q']
-
-    ship_date = dt.datetime.fromisoformat(
-        data['ship_datetime'])
-    delivery_date = dt.datetime.fromisoformat(
-        data['delivery_datetime'])
-    time_stamp = f"{ship_date.year}-{ship_date.month}"
-
-    # Get holidays
-    current_holidays = []
-    for holiday in holiday_data["all"]:
-        current_holidays.append(holiday)
-    if country in holiday_data:
-        current_holidays.extend(holiday_data[country])
-
-    # Code for business days
-    days_in_transit = np.busday_count(ship_date.date(), delivery_date.date(),
-                                      holidays=current_holidays)
-
-    if country not in result_dictionary:
-        result_dictionary.update({country: {}})
-
-    if ship_to_code not in result_dictionary[country]:
-        result_dictionary[country].update({ship_to_code: {}})
-
-    if time_stamp not in result_dictionary[country][ship_to_code]:
-        result_dictionary[country][ship_to_code].update({time_stamp: {}})
-
-    temp_object = {order: days_in_transit}
-
-    result_dictionary[country][ship_to_code][time_stamp].update(temp_object)
-
-
 if __name__ == "__main__":
-    argv = sys.argv
-    if len(argv) > 1:
-        print("Passing in " + argv[1])
-        prepare_transit_time_report(argv[1])
-    else:
-        prepare_transit_time_report()
+    parser = argparse.ArgumentParser(
+        description="Prepare the transit time report")
+    parser.add_argument("input_file", nargs="?", default="",
+                        help="combined json file or order store directory "
+                             "(default: the loaded program data)")
+    parser.add_argument("--carrier-exports", nargs="*", type=Path,
+                        metavar="PATH",
+                        help="read carrier export csv files, or directories "
+                             "of them, instead of the program data. Without "
+                             "paths, every Input Data/carrier_* directory")
+    parser.add_argument("--country", default="",
+                        help="holiday calendar for --carrier-exports "
+                             "(default: weekends only)")
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    # Also traced when AOP_TRACE is set
+    start_tracing(args.trace, args.chrome_trace, args.trace_memory)
+    try:
+        with span("transit_time_report"):
+            if args.carrier_exports is not None:
+                prepare_carrier_transit_report(args.carrier_exports,
+                                               args.country.lower())
+            elif args.input_file != "":
+                print("Passing in " + args.input_file)
+                prepare_transit_time_report(args.input_file)
+            else:
+                prepare_transit_time_report()
+    finally:
+        finish_tracing()